@@ -1,6 +1,10 @@
 #! /bin/bash
 function help {
-    echo "Usage: $0 <backup|restore> <bucket> <volume|path>"
+    echo "Usage: $0 <backup|restore> <bucket> <volume|path> [options]"
+    echo "       $0 backup-many <bucket> <job file> [options]"
+    echo "       $0 list <bucket> [options]"
+    echo "       $0 info <bucket> <volume|path> [options]"
+    echo "       $0 benchmark [bucket] [options]"
     exit 1
 }
 
@@ -8,18 +12,60 @@ function expandPath {
     echo "$(cd "$(dirname "$1")"; pwd)/$(basename "$1")"
 }
 
-if [ -z "$1" -o -z "$2" -o -z "$3" ]; then 
+if [ "$1" = "benchmark" ]; then
+    docker run \
+        --rm -it \
+        -v "$HOME/.aws-backup:/config:ro" \
+        -v "$HOME/.cache/aws-backup:/cache:rw" \
+        mmittelb/aws-backup:latest "$@"
+    exit $?
+fi
+if [ -z "$1" -o -z "$2" ] || [ "$1" != "list" -a -z "$3" ]; then
     echo "Missing positional argument."
     help
 fi
 mode="$1"
 bucket="$2"
+if [ "$mode" = "list" ]; then
+    docker run \
+        --rm -it \
+        -v "$HOME/.aws-backup:/config:ro" \
+        -v "$HOME/.cache/aws-backup:/cache:rw" \
+        mmittelb/aws-backup:latest list "$bucket" "${@:3}"
+    exit $?
+fi
+if [ "$mode" = "backup-many" ]; then
+    # job file lists a volume or path per line, each is mounted separately
+    mounts=()
+    jobs=""
+    index=0
+    while read -r source; do
+        [ -z "$source" ] || [[ "$source" == \#* ]] && continue
+        if [ -d "$source" ]; then
+            absolute_path="$(expandPath "$source")"
+            filename="fs-backup/${absolute_path//\//_}"
+        else
+            absolute_path="$source"
+            filename="volume-backup/$source"
+        fi
+        mounts+=(-v "$absolute_path:/data/$index:ro")
+        jobs+="/data/$index $filename"$'\n'
+        index=$((index + 1))
+    done < "$3"
+    printf "%s" "$jobs" | docker run \
+        --rm -i \
+        "${mounts[@]}" \
+        -v "$HOME/.aws-backup:/config:ro" \
+        -v "$HOME/.cache/aws-backup:/cache:rw" \
+        mmittelb/aws-backup:latest backup-many "$bucket" - "${@:4}"
+    exit $?
+fi
 if [ "$mode" = "backup" ]; then
     mount_permission="ro"
 elif [ "$mode" = "restore" ]; then
     mount_permission="rw"
-else
-    echo "Choose backup or restore."
+elif [ "$mode" != "info" ]; then
+    echo "Choose backup, restore, list or info."
     help
 fi
 if [ -d $3 ]; then
@@ -33,9 +79,18 @@ else
     mount="$3:/data:$mount_permission"
     echo "local volume $absolute_path <-> s3 $bucket/$filename"
 fi
+if [ "$mode" = "info" ]; then
+    docker run \
+        --rm -it \
+        -v "$HOME/.aws-backup:/config:ro" \
+        -v "$HOME/.cache/aws-backup:/cache:rw" \
+        mmittelb/aws-backup:latest info "$bucket" "$filename" "${@:4}"
+    exit $?
+fi
 
 docker run \
     --rm -it \
     -v "$mount" \
     -v "$HOME/.aws-backup:/config:ro" \
-    mmittelb/aws-backup:latest "$mode" "$bucket" "$filename"
\ No newline at end of file
+    -v "$HOME/.cache/aws-backup:/cache:rw" \
+    mmittelb/aws-backup:latest "$mode" "$bucket" "$filename" "${@:4}"
\ No newline at end of file
@@ -0,0 +1,193 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Back up many directories in one run.
+
+Each job passes the stages pack, encrypt and upload. Every stage has its
+own number of slots, so while one job uploads the next one is encrypted
+and another one packed. All jobs share one bucket connector.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from logging import getLogger
+from pathlib import Path
+from threading import BoundedSemaphore
+from time import perf_counter
+from typing import IO, List, NamedTuple, Optional
+
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+from .compression import \
+    AUTO_CODEC, DEFAULT_CODEC, DEFAULT_TARGET_THROUGHPUT, read_sample, \
+    select_codec, tar_options
+from .mycrypt import encrypt
+from .storage import AWSBucket
+from .tar import pack
+
+logger = getLogger(__file__)
+
+
+class Job(NamedTuple):
+    """Directory to back up."""
+
+    path: Path
+    name: str
+
+
+class JobResult(NamedTuple):
+    """Outcome of a job."""
+
+    job: Job
+    # None on success
+    error: Optional[str]
+    seconds: float
+
+
+def read_jobs(textio: IO[str]) -> List[Job]:
+    """Parse job list.
+
+    Each line holds a directory and the name of its backup in the bucket,
+    separated by whitespace. Empty lines and lines starting with '#' are
+    ignored.
+
+    Args:
+        textio (IO[str]): readable job list
+
+    Raises:
+        ValueError: malformed line
+
+    Returns:
+        List[Job]: jobs in order
+    """
+    jobs = []
+    for number, line in enumerate(textio, 1):
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        fields = line.split()
+        if len(fields) != 2:
+            raise ValueError(
+                f"Line {number}: expected '<path> <name>', got '{line}'."
+            )
+        jobs.append(Job(Path(fields[0]), fields[1]))
+    return jobs
+
+
+def run_jobs(
+    aws: AWSBucket,
+    jobs: List[Job],
+    public_key: rsa.RSAPublicKey,
+    tmp_dir: Path,
+    pack_slots: int = 1,
+    encrypt_slots: int = 1,
+    upload_slots: int = 1,
+    workers: int = 1,
+    codec: str = DEFAULT_CODEC,
+    level: Optional[int] = None,
+    target_throughput: float = DEFAULT_TARGET_THROUGHPUT,
+    threads: Optional[int] = None
+) -> List[JobResult]:
+    """Run backup jobs through the stages pack, encrypt and upload.
+
+    Failing jobs do not affect the others. A job waits with its temporary
+    files for the next stage, so at most as many jobs as there are slots
+    in all stages are started at a time, which bounds disk usage.
+
+    Args:
+        aws (AWSBucket): shared bucket connector
+        jobs (List[Job]): jobs in order of priority
+        public_key (rsa.RSAPublicKey): public key to encrypt backups
+        tmp_dir (Path): directory of temporary archives
+        pack_slots (int, optional): Number of concurrent tar processes.
+            Defaults to 1.
+        encrypt_slots (int, optional): Number of concurrent encryptions.
+            Defaults to 1.
+        upload_slots (int, optional): Number of concurrent uploads.
+            Defaults to 1.
+        workers (int, optional): Number of encryption processes shared by
+            the encrypt slots. Defaults to 1.
+        codec (str, optional): Compression codec or "auto".
+            Defaults to DEFAULT_CODEC.
+        level (Optional[int], optional): Compression level.
+            Defaults to the codec's default level.
+        target_throughput (float, optional): Minimum throughput in MB/s of
+            the codec selected by "auto". Defaults to
+            DEFAULT_TARGET_THROUGHPUT.
+        threads (Optional[int], optional): Number of compressor threads
+            shared by the pack slots. Defaults to all cores per slot.
+
+    Returns:
+        List[JobResult]: results in order of jobs
+    """
+    started = BoundedSemaphore(pack_slots + encrypt_slots + upload_slots)
+    packing = BoundedSemaphore(pack_slots)
+    encrypting = BoundedSemaphore(encrypt_slots)
+    uploading = BoundedSemaphore(upload_slots)
+    tmp_dir.mkdir(parents=True, exist_ok=True)
+
+    def run(index: int, job: Job) -> JobResult:
+        start = perf_counter()
+        archive_path = tmp_dir/f"{index}.tar"
+        crypt_path = tmp_dir/f"{index}.tar.crypt"
+        error = None
+        try:
+            with started:
+                if not any(job.path.iterdir()):
+                    raise RuntimeError(
+                        "No point in backing up an empty volume."
+                    )
+                job_codec = codec
+                if codec == AUTO_CODEC:
+                    job_codec = select_codec(
+                        read_sample(job.path), target_throughput*1e6, workers
+                    )
+                with packing:
+                    logger.info("Packing %s.", job.path)
+                    pack(job.path, archive_path, tar_options(
+                        job_codec, level, threads=None if threads is None
+                        else max(1, threads // pack_slots)
+                    ))
+                with encrypting:
+                    logger.info("Encrypting %s.", job.path)
+                    encrypt(
+                        archive_path, public_key,
+                        workers=max(1, workers // encrypt_slots),
+                        metadata={"compression": job_codec}
+                    )
+                    archive_path.unlink()
+                with uploading:
+                    logger.info("Uploading %s to %s.", job.path, job.name)
+                    aws.upload(crypt_path, job.name)
+        except Exception as exc:  # pylint: disable=broad-except
+            logger.exception("Backup of %s failed.", job.path)
+            error = str(exc) or type(exc).__name__
+        finally:
+            archive_path.unlink(missing_ok=True)
+            crypt_path.unlink(missing_ok=True)
+        return JobResult(job, error, perf_counter() - start)
+
+    with ThreadPoolExecutor(max_workers=max(1, len(jobs))) as executor:
+        return list(executor.map(run, range(len(jobs)), jobs))
+
+
+def log_summary(results: List[JobResult]) -> None:
+    """Log outcome of each job.
+
+    Args:
+        results (List[JobResult]): results of run_jobs
+    """
+    for result in results:
+        if result.error is None:
+            logger.info(
+                "OK     %s -> %s (%.1f s)",
+                result.job.path, result.job.name, result.seconds
+            )
+        else:
+            logger.error(
+                "FAILED %s -> %s (%.1f s): %s",
+                result.job.path, result.job.name, result.seconds,
+                result.error
+            )
+    failed = sum(result.error is not None for result in results)
+    logger.info(
+        "%d of %d jobs succeeded.", len(results) - failed, len(results)
+    )
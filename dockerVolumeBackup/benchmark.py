@@ -0,0 +1,529 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Benchmark the stages of backup and restore on synthetic data.
+
+Datasets are generated from a fixed seed, so runs of different versions
+process the same bytes. Every stage runs in a fresh process, which makes
+its peak RSS and CPU time, including subprocesses like tar and encryption
+workers, independent of the other stages. Results are written as JSON to
+compare versions, e.g. after changing BLOCK_SIZE or the default codec.
+"""
+
+import json
+import os
+import platform
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from logging import getLogger
+from multiprocessing import get_context
+from pathlib import Path
+from random import Random
+from resource import RUSAGE_CHILDREN, getrusage
+from time import perf_counter
+from typing import \
+    Any, Callable, Dict, Iterator, List, NamedTuple, Optional, Sequence, \
+    Tuple
+
+from .compression import CODECS, is_available, tar_options
+from .frames import FRAME_SIZE
+from .metrics import apparent_size, cpu_seconds, peak_rss
+from .mycrypt import \
+    BLOCK_SIZE, decrypt, encrypt, gen_certificate, load_private_key, \
+    load_public_key
+from .storage import MiB, AWSBucket, TransferSettings
+from .tar import pack, unpack
+
+DATASETS = (
+    "small_files", "large_files", "compressible", "incompressible",
+    "mixed", "sparse"
+)
+# stages besides pack_<codec>
+STAGES = (
+    "pack", "unpack", "encrypt", "decrypt", "upload", "download",
+    "backup", "restore", "backup_stream", "restore_stream"
+)
+S3_STAGES = (
+    "upload", "download", "backup", "restore", "backup_stream",
+    "restore_stream"
+)
+DEFAULT_DATASET_SIZE = 64*MiB
+SEED = 0
+# compressible data uses 16 symbols, about 4 bits of entropy per byte
+TEXT_TABLE = bytes(b"etaoinshrdlu \n.,"[value % 16] for value in range(256))
+logger = getLogger(__file__)
+
+
+class Result(NamedTuple):
+    """Measurement of a stage on a dataset."""
+
+    dataset: str
+    stage: str
+    # bytes of the dataset, the throughput refers to them
+    size: int
+    seconds: float
+    # user and system time of the stage process and its subprocesses
+    cpu_seconds: float
+    # peak resident set size in bytes of the stage process or a subprocess
+    peak_rss: int
+
+
+def _write_data(
+    path: Path,
+    size: int,
+    rng: Random,
+    compressible: bool
+) -> None:
+    """Write reproducible file in pieces of one MiB.
+
+    Args:
+        path (Path): file to create
+        size (int): file size
+        rng (Random): seeded generator
+        compressible (bool): text like data instead of random bytes
+    """
+    with open(path, "wb") as bytesio:
+        for start in range(0, size, MiB):
+            data = rng.randbytes(min(MiB, size - start))
+            bytesio.write(data.translate(TEXT_TABLE) if compressible else data)
+
+
+def generate_dataset(kind: str, root: Path, size: int) -> int:
+    """Generate reproducible synthetic dataset.
+
+    Args:
+        kind (str): one of DATASETS
+        root (Path): directory to create
+        size (int): approximate size in bytes
+
+    Raises:
+        ValueError: unknown kind
+
+    Returns:
+        int: apparent size of all files in bytes
+    """
+    rng = Random(f"{SEED}-{kind}")
+    root.mkdir(parents=True)
+    total = 0
+    if kind == "small_files":
+        # 1 to 64 KiB, 100 files per directory
+        index = 0
+        while total < size:
+            directory = root/f"{index // 100:04d}"
+            directory.mkdir(exist_ok=True)
+            file_size = rng.randint(2**10, 2**16)
+            _write_data(
+                directory/f"{index:06d}", file_size, rng, rng.random() < 0.8
+            )
+            total += file_size
+            index += 1
+    elif kind == "large_files":
+        for index in range(2):
+            _write_data(root/f"{index}", size // 2, rng, True)
+            total += size // 2
+    elif kind in ("compressible", "incompressible"):
+        for index in range(16):
+            _write_data(
+                root/f"{index:02d}", size // 16, rng, kind == "compressible"
+            )
+            total += size // 16
+    elif kind == "mixed":
+        # incompressible media next to text, alternating per frame
+        for index in range(16):
+            with open(root/f"{index:02d}", "wb") as bytesio:
+                for start in range(0, size // 16, FRAME_SIZE):
+                    data = rng.randbytes(min(FRAME_SIZE, size // 16 - start))
+                    if start // FRAME_SIZE % 2:
+                        data = data.translate(TEXT_TABLE)
+                    bytesio.write(data)
+            total += size // 16
+    elif kind == "sparse":
+        # one data MiB per 16 MiB, the rest are holes
+        for index in range(4):
+            with open(root/f"{index}", "wb") as bytesio:
+                bytesio.truncate(size // 4)
+                for start in range(0, size // 4, 16*MiB):
+                    bytesio.seek(start)
+                    bytesio.write(rng.randbytes(min(MiB, size // 4 - start)))
+            total += size // 4
+    else:
+        raise ValueError(f"Unknown dataset {kind}.")
+    return total
+
+
+def _measure(
+    func: Callable[..., None],
+    args: Tuple
+) -> Tuple[float, float, int]:
+    """Run function and measure it. Runs in a fresh process.
+
+    Args:
+        func (Callable[..., None]): stage function
+        args (Tuple): its arguments
+
+    Returns:
+        Tuple[float, float, int]: wall seconds, CPU seconds and peak RSS
+            in bytes
+    """
+    cpu_start = cpu_seconds()
+    start = perf_counter()
+    func(*args)
+    seconds = perf_counter() - start
+    # subprocesses are forked from this fresh process
+    return seconds, cpu_seconds() - cpu_start, max(
+        peak_rss(), getrusage(RUSAGE_CHILDREN).ru_maxrss*1024
+    )
+
+
+def _pack(path: Path, archive_path: Path, codec: str) -> None:
+    """Stage packing with codec."""
+    pack(path, archive_path, tar_options(codec))
+
+
+def _unpack(archive_path: Path, target: Path) -> None:
+    """Stage unpacking uncompressed archive into target."""
+    os.chdir(target)
+    unpack(archive_path)
+
+
+def _encrypt(
+    archive_path: Path,
+    cert_path: Path,
+    block_size: int,
+    workers: int
+) -> None:
+    """Stage encryption of archive_path to archive_path.crypt."""
+    with open(cert_path, "rb") as bytesio:
+        public_key = load_public_key(bytesio)
+    encrypt(archive_path, public_key, block_size, workers)
+
+
+def _decrypt(
+    crypt_path: Path,
+    output_path: Path,
+    key_path: Path,
+    workers: int
+) -> None:
+    """Stage decryption."""
+    with open(key_path, "rb") as bytesio:
+        private_key = load_private_key(bytesio, None)
+    decrypt(private_key, crypt_path, output_path, workers)
+
+
+def _upload(
+    bucket: str,
+    settings: TransferSettings,
+    file_path: Path,
+    name: str
+) -> None:
+    """Stage upload."""
+    AWSBucket(bucket, settings).upload(file_path, name)
+
+
+def _download(
+    bucket: str,
+    settings: TransferSettings,
+    name: str,
+    file_path: Path
+) -> None:
+    """Stage download."""
+    AWSBucket(bucket, settings).download(name, file_path)
+
+
+def _run_main(
+    function: str,
+    settings: TransferSettings,
+    dirs: Dict[str, Path],
+    cwd: Path,
+    kwargs: Dict[str, Any]
+) -> None:
+    """Stage running backup or restore of the CLI.
+
+    Args:
+        function (str): backup or restore
+        settings (TransferSettings): transfer settings
+        dirs (Dict[str, Path]): DATA_DIR, CONFIG_DIR and CACHE_DIR
+        cwd (Path): working directory, restores unpack into it
+        kwargs (Dict[str, Any]): arguments
+    """
+    # pylint: disable=import-outside-toplevel
+    from . import main
+    for name, path in dirs.items():
+        setattr(main, name, path)
+    main.connect = lambda bucket, _: AWSBucket(bucket, settings)
+    for path in Path("/tmp").glob("backup.tar.bzip2*"):
+        path.unlink()
+    os.chdir(cwd)
+    getattr(main, function)(**kwargs)
+
+
+@contextmanager
+def local_s3() -> Iterator[Dict[str, Any]]:
+    """Run in-process moto server as S3 stand-in.
+
+    Requires the test dependency moto. Its CPU time is not attributed to
+    the measured stages, which run in other processes.
+
+    Yields:
+        Dict[str, Any]: transfer setting overrides to reach it
+    """
+    # pylint: disable=import-outside-toplevel
+    from moto.server import ThreadedMotoServer
+    for variable in ("AWS_ACCESS_KEY_ID", "AWS_SECRET_ACCESS_KEY"):
+        os.environ.setdefault(variable, "benchmark")
+    os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+    server = ThreadedMotoServer("127.0.0.1", 0, verbose=False)
+    server.start()
+    try:
+        host, port = server.get_host_and_port()
+        yield {"endpoint_url": f"http://{host}:{port}"}
+    finally:
+        server.stop()
+
+
+def run_benchmark(
+    work_dir: Path,
+    bucket: Optional[str],
+    settings: TransferSettings,
+    datasets: Sequence[str] = DATASETS,
+    stages: Sequence[str] = STAGES,
+    codecs: Sequence[str] = tuple(CODECS),
+    size: int = DEFAULT_DATASET_SIZE,
+    workers: int = 1,
+    block_size: int = BLOCK_SIZE
+) -> List[Result]:
+    """Generate datasets and measure stages on each of them.
+
+    Args:
+        work_dir (Path): scratch directory, removed afterwards
+        bucket (Optional[str]): bucket of S3 stages, which are skipped if
+            None
+        settings (TransferSettings): transfer settings of S3 stages
+        datasets (Sequence[str], optional): Datasets to generate.
+            Defaults to DATASETS.
+        stages (Sequence[str], optional): Stages to measure, "pack" once
+            per codec. Defaults to STAGES.
+        codecs (Sequence[str], optional): Codecs of the pack stage.
+            Defaults to all codecs.
+        size (int, optional): Approximate size of each dataset.
+            Defaults to DEFAULT_DATASET_SIZE.
+        workers (int, optional): Number of encryption processes.
+            Defaults to 1.
+        block_size (int, optional): Size of encryption blocks of the
+            encrypt stage. Defaults to BLOCK_SIZE.
+
+    Returns:
+        List[Result]: measurements
+    """
+    if bucket is None:
+        stages = [stage for stage in stages if stage not in S3_STAGES]
+    for codec in codecs:
+        if not is_available(codec):
+            logger.warning("Skipping codec %s, it is not installed.", codec)
+    codecs = [codec for codec in codecs if is_available(codec)]
+    results = []
+    work_dir.mkdir(parents=True)
+    config_dir = work_dir/"config"
+    config_dir.mkdir()
+    priv, pub = gen_certificate()
+    (config_dir/"key.pem").write_bytes(priv)
+    (config_dir/"cert.pem").write_bytes(pub)
+    context = get_context("spawn")
+
+    def measure(
+        dataset: str,
+        stage: str,
+        dataset_size: int,
+        func: Callable[..., None],
+        *args: Any,
+        record: bool = True
+    ) -> None:
+        # fresh process per stage, so peak RSS is that of the stage
+        with ProcessPoolExecutor(1, mp_context=context) as executor:
+            result = Result(
+                dataset, stage, dataset_size,
+                *executor.submit(_measure, func, args).result()
+            )
+        if not record:
+            # only prepares a later stage
+            return
+        logger.info(
+            "%-14s %-16s %8.1f MB/s %7.1f CPU s %7.1f MiB",
+            dataset, stage, dataset_size / result.seconds / 1e6,
+            result.cpu_seconds, result.peak_rss / MiB
+        )
+        results.append(result)
+
+    def check(
+        dataset: str,
+        stage: str,
+        dataset_size: int,
+        target: Path
+    ) -> None:
+        # failed restores only log errors, which would look fast
+        restored = apparent_size(target)
+        shutil.rmtree(target)
+        if restored != dataset_size:
+            raise RuntimeError(
+                f"Stage {stage} of {dataset} restored {restored} of "
+                f"{dataset_size} bytes."
+            )
+
+    try:
+        for dataset in datasets:
+            logger.info("Generating dataset %s.", dataset)
+            data_dir = work_dir/dataset
+            dataset_size = generate_dataset(dataset, data_dir, size)
+            archive_path = work_dir/"archive.tar"
+            crypt_path = work_dir/"archive.tar.crypt"
+            scratch = work_dir/"scratch"
+            pack(data_dir, archive_path)
+            if "pack" in stages:
+                for codec in codecs:
+                    measure(
+                        dataset, f"pack_{codec}", dataset_size, _pack,
+                        data_dir, work_dir/"packed", codec
+                    )
+                    (work_dir/"packed").unlink()
+            if "unpack" in stages:
+                scratch.mkdir()
+                measure(
+                    dataset, "unpack", dataset_size, _unpack,
+                    archive_path, scratch
+                )
+                check(dataset, "unpack", dataset_size, scratch)
+            if {"encrypt", "decrypt", "upload", "download"} & set(stages):
+                measure(
+                    dataset, "encrypt", dataset_size, _encrypt,
+                    archive_path, config_dir/"cert.pem", block_size, workers,
+                    record="encrypt" in stages
+                )
+            if "decrypt" in stages:
+                measure(
+                    dataset, "decrypt", dataset_size, _decrypt,
+                    crypt_path, work_dir/"decrypted", config_dir/"key.pem",
+                    workers
+                )
+                (work_dir/"decrypted").unlink()
+            if "upload" in stages or "download" in stages:
+                measure(
+                    dataset, "upload", dataset_size, _upload,
+                    bucket, settings, crypt_path, f"benchmark/{dataset}",
+                    record="upload" in stages
+                )
+            if "download" in stages:
+                measure(
+                    dataset, "download", dataset_size, _download,
+                    bucket, settings, f"benchmark/{dataset}",
+                    work_dir/"downloaded"
+                )
+                (work_dir/"downloaded").unlink()
+            crypt_path.unlink(missing_ok=True)
+            archive_path.unlink()
+            for stream in (False, True):
+                suffix = "_stream" if stream else ""
+                dirs = {
+                    "DATA_DIR": data_dir,
+                    "CONFIG_DIR": config_dir,
+                    "CACHE_DIR": work_dir/"cache"
+                }
+                name = f"benchmark/{dataset}{suffix}"
+                if "backup" + suffix in stages or \
+                        "restore" + suffix in stages:
+                    measure(
+                        dataset, "backup" + suffix, dataset_size, _run_main,
+                        "backup", settings, dirs, work_dir,
+                        {
+                            "bucket": bucket, "name": name, "stream": stream,
+                            "workers": workers
+                        },
+                        record="backup" + suffix in stages
+                    )
+                if "restore" + suffix in stages:
+                    scratch.mkdir()
+                    (scratch/"empty").mkdir()
+                    measure(
+                        dataset, "restore" + suffix, dataset_size,
+                        _run_main, "restore", settings,
+                        {**dirs, "DATA_DIR": scratch/"empty"}, scratch,
+                        {
+                            "bucket": bucket, "name": name, "stream": stream,
+                            "workers": workers
+                        }
+                    )
+                    check(dataset, "restore" + suffix, dataset_size, scratch)
+            shutil.rmtree(data_dir)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+        for path in Path("/tmp").glob("backup.tar.bzip2*"):
+            path.unlink()
+    return results
+
+
+def write_report(
+    path: Path,
+    results: List[Result],
+    parameters: Dict[str, Any]
+) -> None:
+    """Write results as JSON.
+
+    Args:
+        path (Path): report file
+        results (List[Result]): measurements
+        parameters (Dict[str, Any]): settings of the run
+    """
+    report = {
+        "created": datetime.now(timezone.utc).isoformat(),
+        "host": {
+            "platform": platform.platform(),
+            "python": platform.python_version(),
+            "cpus": os.cpu_count()
+        },
+        "parameters": parameters,
+        "results": [
+            {
+                "dataset": result.dataset,
+                "stage": result.stage,
+                "bytes": result.size,
+                "seconds": round(result.seconds, 4),
+                "mb_per_s": round(result.size / result.seconds / 1e6, 2),
+                "cpu_seconds": round(result.cpu_seconds, 3),
+                "peak_rss_mib": round(result.peak_rss / MiB, 1)
+            }
+            for result in results
+        ]
+    }
+    path.write_text(json.dumps(report, indent=2), encoding="utf-8")
+
+
+def compare_reports(
+    baseline: Dict[str, Any],
+    report: Dict[str, Any]
+) -> List[str]:
+    """Compare throughput and peak RSS of two reports.
+
+    Args:
+        baseline (Dict[str, Any]): earlier report
+        report (Dict[str, Any]): current report
+
+    Returns:
+        List[str]: a line per measurement present in both
+    """
+    earlier = {
+        (result["dataset"], result["stage"]): result
+        for result in baseline["results"]
+    }
+    lines = []
+    for result in report["results"]:
+        old = earlier.get((result["dataset"], result["stage"]))
+        if old is None:
+            continue
+        lines.append(
+            f"{result['dataset']:14} {result['stage']:16} "
+            f"{old['mb_per_s']:8.1f} -> {result['mb_per_s']:8.1f} MB/s "
+            f"({result['mb_per_s'] / old['mb_per_s'] - 1:+6.1%}) "
+            f"{old['peak_rss_mib']:7.1f} -> "
+            f"{result['peak_rss_mib']:7.1f} MiB"
+        )
+    return lines
@@ -0,0 +1,162 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Split a memory limit between the buffers of a streaming pipeline.
+
+Every stage of a pipeline holds a bounded number of buffers: frames being
+compressed, blocks being encrypted and parts being uploaded, or ranges
+being downloaded and blocks being decrypted. A stage whose buffers are all
+in use blocks its producer. plan_memory sizes these windows, so that all
+of them together stay within max_memory of the transfer settings.
+Encryption and compression get at most a quarter each, the transfer gets
+the rest, since it is the stage that falls behind when S3 is slow.
+"""
+
+from logging import getLogger
+from typing import Any, Dict, NamedTuple, Optional
+
+from .frames import FRAME_SIZE
+from .mycrypt import BLOCKS_IN_FLIGHT_PER_WORKER
+from .storage import MAX_PARTS, MiB, TransferSettings
+
+# S3 minimum size of all but the last part
+MIN_PART_SIZE = 5*MiB
+MIN_RANGE_SIZE = MiB
+# blocks outside the windows: read buffers, pipes and the block being sealed
+RESERVED_BLOCKS = 4
+logger = getLogger(__file__)
+
+
+class MemoryPlan(NamedTuple):
+    """Buffer windows of a pipeline."""
+
+    # transfer settings with part size, range size and concurrency fitted
+    settings: TransferSettings
+    blocks_in_flight: int
+    frames_in_flight: int
+    # bytes of all windows
+    size: int
+
+    def report(self) -> Dict[str, Any]:
+        """Summarize plan for run reports.
+
+        Returns:
+            Dict[str, Any]: JSON serializable windows
+        """
+        limit = self.settings.max_memory
+        return {
+            "max_memory_mib": None if limit is None else round(limit / MiB),
+            "planned_mib": round(self.size / MiB, 1),
+            "blocks_in_flight": self.blocks_in_flight,
+            "frames_in_flight": self.frames_in_flight,
+            "part_size_mib": round(self.settings.part_size / MiB, 1),
+            "range_size_mib": round(self.settings.range_size / MiB, 1),
+            "max_concurrency": self.settings.max_concurrency
+        }
+
+
+def plan_memory(
+    settings: TransferSettings,
+    block_size: int,
+    workers: int,
+    upload: bool = True,
+    framed: bool = False,
+    pipelines: int = 1,
+    stream_size: Optional[int] = None
+) -> MemoryPlan:
+    """Fit the buffer windows of a pipeline into settings.max_memory.
+
+    Windows are only shrunk, never grown beyond their defaults, except for
+    parts, which are enlarged until the stream fits into MAX_PARTS. Block
+    and frame windows are cut first to make room for such parts.
+
+    Args:
+        settings (TransferSettings): transfer settings
+        block_size (int): size of encryption blocks
+        workers (int): number of encryption and compression workers
+        upload (bool, optional): Plan an upload, else a download.
+            Defaults to True.
+        framed (bool, optional): Plan compressed frames as well.
+            Defaults to False.
+        pipelines (int, optional): Number of concurrent pipelines sharing
+            the limit, e.g. shards. Windows are planned per pipeline.
+            Defaults to 1.
+        stream_size (Optional[int], optional): Expected size of the
+            stream of each pipeline when uploading. Defaults to unknown.
+
+    Raises:
+        ValueError: max_memory is below the minimum of the pipeline, or
+            parts fitting into it would exceed MAX_PARTS
+
+    Returns:
+        MemoryPlan: windows of each pipeline, size of all
+    """
+    # every block in flight is held in plain and in cipher text, pipelines
+    # share the workers
+    blocks = BLOCKS_IN_FLIGHT_PER_WORKER*max(
+        1, -(-workers // max(pipelines, 1))
+    )
+    frames = 2*max(workers, 1) if framed else 0
+    part_size = settings.part_size
+    range_size = settings.range_size
+    concurrency = settings.max_concurrency
+    # smallest part size keeping the stream within MAX_PARTS
+    min_part_size = MIN_PART_SIZE
+    if upload and stream_size is not None:
+        min_part_size = max(MIN_PART_SIZE, -(-stream_size // MAX_PARTS))
+        part_size = max(part_size, min_part_size)
+    limit = settings.max_memory
+    if limit is not None:
+        limit //= max(pipelines, 1)
+        blocks = max(1, min(blocks, limit // 4 // (2*block_size)))
+        if framed:
+            frames = max(1, min(frames, limit // 4 // (2*FRAME_SIZE)))
+        rest = limit - (RESERVED_BLOCKS + 2*blocks)*block_size - \
+            2*frames*FRAME_SIZE
+        if upload:
+            # room for parts fitting the stream into MAX_PARTS, at least
+            # one being uploaded, one being filled and one being joined
+            while rest < 3*min_part_size and (blocks > 1 or frames > 1):
+                blocks = max(1, blocks // 2)
+                frames = max(1, frames // 2) if framed else 0
+                rest = limit - (RESERVED_BLOCKS + 2*blocks)*block_size - \
+                    2*frames*FRAME_SIZE
+            # parts being uploaded, one being filled and one being joined
+            concurrency = max(1, min(concurrency, rest // part_size - 2))
+            part_size = max(
+                min_part_size, min(part_size, rest // (concurrency + 2))
+            )
+            transfer = (concurrency + 2)*part_size
+            if part_size < settings.part_size and stream_size is None:
+                logger.warning(
+                    "Parts of %.1f MiB limit streams to %.0f GiB.",
+                    part_size / MiB, part_size*MAX_PARTS / 2**30
+                )
+        else:
+            # twice the concurrency is prefetched, one is being read
+            concurrency = max(
+                1, min(concurrency, (rest // range_size - 1) // 2)
+            )
+            range_size = max(
+                MIN_RANGE_SIZE,
+                min(range_size, rest // (2*concurrency + 1))
+            )
+            transfer = (2*concurrency + 1)*range_size
+        if transfer > rest:
+            minimum = (limit - rest + transfer)*max(pipelines, 1)
+            raise ValueError(
+                f"max_memory must be at least {-(-minimum // MiB)} MiB."
+            )
+    else:
+        transfer = (concurrency + 2)*part_size if upload \
+            else (2*concurrency + 1)*range_size
+    return MemoryPlan(
+        settings._replace(
+            part_size=part_size, range_size=range_size,
+            max_concurrency=concurrency
+        ),
+        blocks, frames,
+        max(pipelines, 1)*(
+            (RESERVED_BLOCKS + 2*blocks)*block_size + 2*frames*FRAME_SIZE +
+            transfer
+        )
+    )
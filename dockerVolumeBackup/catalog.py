@@ -0,0 +1,287 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Local catalog of the backups in a bucket.
+
+The catalog records every file in the bucket except the chunk store with
+its size, modification time, ETag and codec. Listing backups reads only
+the catalog. A sync lists the bucket page by page and reads the plain
+text container header of new or changed files only. The continuation
+token is saved after every page, so an interrupted sync continues where it
+stopped.
+"""
+
+import json
+import re
+import sqlite3
+from io import BytesIO
+from logging import getLogger
+from pathlib import Path
+from struct import error as struct_error
+from typing import Any, Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+from .compression import LEGACY_CODEC
+from .dedup import CHUNK_PREFIX, LOCK_PREFIX
+from .documents import \
+    FILES_SUFFIX, INDEX_SUFFIX, MANIFEST_SUFFIX, SHARDS_SUFFIX
+from .mycrypt import HEADER_PREFETCH, AsymmetricFernetError, read_header
+from .storage import AWSBucket
+
+# names of increments of an incremental chain
+LEVEL_PATTERN = re.compile(r"(.*)\.\d{4}")
+# names of archives of a sharded backup
+SHARD_PATTERN = re.compile(r"(.*)\.shard\d{4}")
+logger = getLogger(__file__)
+
+
+class BackupInfo(NamedTuple):
+    """Backup and the files it consists of."""
+
+    name: str
+    # archive, framed, dedup, incremental or sharded
+    kind: str
+    # total size of files in bytes, without chunks of dedup backups
+    size: int
+    # ISO 8601 time of the last modified file
+    modified: str
+    # None if unknown, e.g. for dedup backups
+    codec: Optional[str]
+    # names and sizes of files
+    files: List[Tuple[str, int]]
+
+
+class Catalog:
+    """Local record of files in the bucket.
+
+    Deleting the database file forces a full sync.
+    """
+
+    def __init__(self, path: Path) -> None:
+        """Catalog constructor.
+
+        Args:
+            path (Path): SQLite database file
+        """
+        self._connection = sqlite3.connect(path)
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS files (name TEXT PRIMARY KEY, "
+            "size INTEGER, modified TEXT, etag TEXT, codec TEXT, "
+            "pass INTEGER)"
+        )
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS state "
+            "(key TEXT PRIMARY KEY, value TEXT)"
+        )
+
+    def _get_state(self, key: str, default: Any) -> Any:
+        """Read sync state.
+
+        Args:
+            key (str): state key
+            default (Any): value if unset
+
+        Returns:
+            Any: JSON value
+        """
+        row = self._connection.execute(
+            "SELECT value FROM state WHERE key = ?", (key,)
+        ).fetchone()
+        return default if row is None else json.loads(row[0])
+
+    def _set_state(self, key: str, value: Any) -> None:
+        """Write sync state.
+
+        Args:
+            key (str): state key
+            value (Any): JSON serializable value
+        """
+        self._connection.execute(
+            "INSERT OR REPLACE INTO state VALUES (?, ?)",
+            (key, json.dumps(value))
+        )
+
+    def _record(
+        self,
+        aws: AWSBucket,
+        obj: Dict[str, Any],
+        sync_pass: int
+    ) -> None:
+        """Record file, reading its header if it is new or changed.
+
+        Args:
+            aws (AWSBucket): bucket connector
+            obj (Dict[str, Any]): file from AWSBucket.list_page
+            sync_pass (int): number of the current sync
+        """
+        row = self._connection.execute(
+            "SELECT etag, codec FROM files WHERE name = ?", (obj["Key"],)
+        ).fetchone()
+        if row is not None and row[0] == obj["ETag"]:
+            codec = row[1]
+        else:
+            codec = _read_codec(aws, obj["Key"], obj["Size"])
+        self._connection.execute(
+            "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)",
+            (
+                obj["Key"], obj["Size"], obj["LastModified"].isoformat(),
+                obj["ETag"], codec, sync_pass
+            )
+        )
+
+    def sync(self, aws: AWSBucket) -> None:
+        """Bring catalog up to date with a listing of the bucket.
+
+        The chunk store and its locks are skipped. Files missing from a
+        complete listing are removed.
+
+        Args:
+            aws (AWSBucket): bucket connector
+        """
+        sync_pass = self._get_state("pass", 0)
+        # prefixes still to list with their continuation tokens
+        pending = self._get_state("pending", None)
+        if pending is None:
+            sync_pass += 1
+            pending = [["", None]]
+            self._set_state("pass", sync_pass)
+        else:
+            logger.info("Continuing interrupted sync.")
+        while pending:
+            prefix, token = pending[-1]
+            objects, prefixes, token = aws.list_page(prefix, "/", token)
+            for obj in objects:
+                self._record(aws, obj, sync_pass)
+            if token is None:
+                pending.pop()
+            else:
+                pending[-1][1] = token
+            pending.extend(
+                [common, None] for common in prefixes
+                if common not in (CHUNK_PREFIX, LOCK_PREFIX)
+            )
+            self._set_state("pending", pending)
+            self.commit()
+        self._connection.execute(
+            "DELETE FROM files WHERE pass < ?", (sync_pass,)
+        )
+        self._set_state("pending", None)
+        self.commit()
+
+    def update(self, aws: AWSBucket, names: Iterable[str]) -> None:
+        """Refresh single files without listing the bucket.
+
+        Args:
+            aws (AWSBucket): bucket connector
+            names (Iterable[str]): names of files in bucket
+        """
+        for name in names:
+            obj = aws.stat(name)
+            if obj is None:
+                self._connection.execute(
+                    "DELETE FROM files WHERE name = ?", (name,)
+                )
+            else:
+                self._record(aws, obj, self._get_state("pass", 0))
+        self.commit()
+
+    def is_synced(self) -> bool:
+        """Check if the last sync completed.
+
+        Returns:
+            bool: False if never synced or interrupted
+        """
+        return self._get_state("pass", 0) > 0 and \
+            self._get_state("pending", None) is None
+
+    def backups(self) -> List[BackupInfo]:
+        """Group files to backups.
+
+        Returns:
+            List[BackupInfo]: backups sorted by name
+        """
+        rows = self._connection.execute(
+            "SELECT name, size, modified, codec FROM files ORDER BY name"
+        ).fetchall()
+        names = {row[0] for row in rows}
+        groups: Dict[str, Dict[str, Any]] = {}
+        for name, size, modified, codec in rows:
+            base, kind = name, "framed" if codec == "framed" else "archive"
+            level = LEVEL_PATTERN.fullmatch(name)
+            shard = SHARD_PATTERN.fullmatch(name)
+            if name.endswith(MANIFEST_SUFFIX):
+                base, kind = name[:-len(MANIFEST_SUFFIX)], "dedup"
+            elif name.endswith(FILES_SUFFIX):
+                base, kind = name[:-len(FILES_SUFFIX)], "incremental"
+            elif level and level.group(1) + FILES_SUFFIX in names:
+                base, kind = level.group(1), "incremental"
+            elif name.endswith(SHARDS_SUFFIX):
+                base, kind = name[:-len(SHARDS_SUFFIX)], "sharded"
+            elif shard and shard.group(1) + SHARDS_SUFFIX in names:
+                base, kind = shard.group(1), "sharded"
+            elif name.endswith(INDEX_SUFFIX) and \
+                    name[:-len(INDEX_SUFFIX)] in names:
+                base, kind = name[:-len(INDEX_SUFFIX)], "framed"
+            group = groups.setdefault(
+                base,
+                {"kind": kind, "codec": None, "modified": "", "files": []}
+            )
+            # manifests and containers determine the kind of the backup
+            if kind != "archive":
+                group["kind"] = kind
+            if codec is not None and group["codec"] is None:
+                group["codec"] = codec
+            group["modified"] = max(group["modified"], modified)
+            group["files"].append((name, size))
+        return [
+            BackupInfo(
+                base, group["kind"],
+                sum(size for _, size in group["files"]), group["modified"],
+                group["codec"], group["files"]
+            )
+            for base, group in sorted(groups.items())
+        ]
+
+    def info(self, name: str) -> Optional[BackupInfo]:
+        """Look up backup.
+
+        Args:
+            name (str): name of backup in bucket
+
+        Returns:
+            Optional[BackupInfo]: backup, None if unknown
+        """
+        for backup in self.backups():
+            if backup.name == name:
+                return backup
+        return None
+
+    def commit(self) -> None:
+        """Persist changes."""
+        self._connection.commit()
+
+
+def _read_codec(aws: AWSBucket, name: str, size: int) -> Optional[str]:
+    """Read codec from the plain text container header.
+
+    Args:
+        aws (AWSBucket): bucket connector
+        name (str): name of file in bucket
+        size (int): size of file
+
+    Returns:
+        Optional[str]: codec, "framed" for framed backups, None for
+            documents and files of other programs
+    """
+    if name.endswith(
+        (INDEX_SUFFIX, MANIFEST_SUFFIX, FILES_SUFFIX, SHARDS_SUFFIX)
+    ):
+        return None
+    read_at, _ = aws.range_reader(name)
+    try:
+        version, metadata, _, _ = read_header(
+            BytesIO(read_at(0, min(HEADER_PREFETCH, size)))
+        )
+    except (AsymmetricFernetError, ValueError, struct_error):
+        return None
+    if version == 1:
+        return LEGACY_CODEC
+    return metadata.get("compression", LEGACY_CODEC)
@@ -0,0 +1,262 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Registry of compression codecs.
+
+Each codec compresses tar streams through an external program and single
+frames in process. The codec name is recorded in the container metadata,
+the codec id in each frame header, so restores pick the decoder on their
+own.
+"""
+
+import bz2
+import lzma
+import os
+from logging import getLogger
+from pathlib import Path
+from shutil import which
+from time import perf_counter
+from typing import IO, Callable, Dict, List, NamedTuple, Optional
+
+import lz4.frame
+import zstandard
+
+# codec of new backups
+DEFAULT_CODEC = "zstd"
+# codec of backups without compression metadata
+LEGACY_CODEC = "pbzip2"
+# pseudo codec choosing a codec by sampling the data
+AUTO_CODEC = "auto"
+# default throughput target of AUTO_CODEC in MB/s
+DEFAULT_TARGET_THROUGHPUT = 100
+SAMPLE_SIZE = 8*2**20
+SAMPLE_SIZE_PER_FILE = 2**18
+logger = getLogger(__file__)
+
+
+class Codec(NamedTuple):
+    """Compression codec."""
+
+    # id in frame headers
+    frame_id: int
+    # tar --use-compress-program, None for uncompressed
+    program: Optional[str]
+    default_level: int
+    compress: Callable[[bytes, int], bytes]
+    decompress: Callable[[bytes], bytes]
+    # readable decompressed stream of the program's output
+    decompress_stream: Callable[[IO[bytes]], IO[bytes]]
+    # program option setting the number of threads, None if single
+    # threaded
+    threads_option: Optional[str] = None
+
+
+def _store(data: bytes, _: int) -> bytes:
+    """Store data uncompressed."""
+    return bytes(data)
+
+
+def _xz_compress(data: bytes, level: int) -> bytes:
+    """Compress with xz."""
+    return lzma.compress(data, preset=level)
+
+
+def _zstd_compress(data: bytes, level: int) -> bytes:
+    """Compress with zstd."""
+    # compressor objects are not thread safe
+    return zstandard.ZstdCompressor(level=level).compress(data)
+
+
+def _zstd_decompress(data: bytes) -> bytes:
+    """Decompress zstd frame."""
+    return zstandard.ZstdDecompressor().decompress(data)
+
+
+def _lz4_compress(data: bytes, level: int) -> bytes:
+    """Compress with lz4."""
+    return lz4.frame.compress(data, compression_level=level)
+
+
+def _store_stream(bytesio: IO[bytes]) -> IO[bytes]:
+    """Read uncompressed stream."""
+    return bytesio
+
+
+def _bz2_stream(bytesio: IO[bytes]) -> IO[bytes]:
+    """Decompress bzip2 stream, also of pbzip2 with many streams."""
+    return bz2.open(bytesio, "rb")
+
+
+def _xz_stream(bytesio: IO[bytes]) -> IO[bytes]:
+    """Decompress xz stream."""
+    return lzma.open(bytesio, "rb")
+
+
+def _zstd_stream(bytesio: IO[bytes]) -> IO[bytes]:
+    """Decompress zstd stream, also of zstd -T0 with many frames."""
+    return zstandard.ZstdDecompressor().stream_reader(
+        bytesio, read_across_frames=True
+    )
+
+
+def _lz4_stream(bytesio: IO[bytes]) -> IO[bytes]:
+    """Decompress lz4 stream."""
+    return lz4.frame.open(bytesio, "rb")
+
+
+CODECS: Dict[str, Codec] = {
+    "none": Codec(0, None, 0, _store, bytes, _store_stream),
+    "pbzip2": Codec(
+        1, "pbzip2", 9, bz2.compress, bz2.decompress, _bz2_stream, "-p{}"
+    ),
+    "xz": Codec(
+        2, "xz -T0", 6, _xz_compress, lzma.decompress, _xz_stream, "-T{}"
+    ),
+    "zstd": Codec(
+        3, "zstd -T0", 3, _zstd_compress, _zstd_decompress, _zstd_stream,
+        "-T{}"
+    ),
+    "lz4": Codec(
+        4, "lz4", 1, _lz4_compress, lz4.frame.decompress, _lz4_stream
+    ),
+}
+
+
+def get_codec(name: str) -> Codec:
+    """Look up codec.
+
+    Args:
+        name (str): codec name
+
+    Raises:
+        ValueError: unknown codec, e.g. of a backup by a newer version
+
+    Returns:
+        Codec: codec
+    """
+    if name not in CODECS:
+        raise ValueError(f"Unknown codec {name}.")
+    return CODECS[name]
+
+
+def is_available(name: str) -> bool:
+    """Check if the program of a codec is installed.
+
+    Args:
+        name (str): codec name
+
+    Returns:
+        bool: True if tar can compress with the codec
+    """
+    program = get_codec(name).program
+    return program is None or which(program.split()[0]) is not None
+
+
+def tar_options(
+    name: str,
+    level: Optional[int] = None,
+    decompress: bool = False,
+    threads: Optional[int] = None
+) -> List[str]:
+    """Options making tar compress through the codec program.
+
+    Args:
+        name (str): codec name
+        level (Optional[int], optional): Compression level.
+            Defaults to the codec's default level.
+        decompress (bool, optional): Options for unpacking, which ignore
+            the level. Defaults to False.
+        threads (Optional[int], optional): Number of threads of the
+            program. Defaults to all cores.
+
+    Returns:
+        List[str]: tar options, empty for uncompressed archives
+    """
+    codec = get_codec(name)
+    if codec.program is None:
+        return []
+    program = codec.program
+    if threads is not None and codec.threads_option is not None:
+        # the last thread option wins
+        program += " " + codec.threads_option.format(threads)
+    if decompress:
+        return [f"-I{program}"]
+    if level is None:
+        level = codec.default_level
+    return [f"-I{program} -{level}"]
+
+
+def read_sample(root: Path, size: int = SAMPLE_SIZE) -> bytes:
+    """Read sample of the files below root.
+
+    Takes the beginning of many files rather than one large file, so the
+    sample reflects the mix of data.
+
+    Args:
+        root (Path): directory to sample
+        size (int, optional): Sample size. Defaults to SAMPLE_SIZE.
+
+    Returns:
+        bytes: sample, shorter if there is less data
+    """
+    parts = []
+    missing = size
+    for directory, _, file_names in os.walk(root):
+        for file_name in file_names:
+            path = Path(directory)/file_name
+            if path.is_symlink() or not path.is_file():
+                continue
+            try:
+                with open(path, "rb") as bytesio:
+                    data = bytesio.read(min(SAMPLE_SIZE_PER_FILE, missing))
+            except OSError:
+                continue
+            parts.append(data)
+            missing -= len(data)
+            if not missing:
+                return b"".join(parts)
+    return b"".join(parts)
+
+
+def select_codec(
+    sample: bytes,
+    target_throughput: float,
+    workers: int = 1
+) -> str:
+    """Choose the codec with the best ratio meeting a throughput target.
+
+    Each codec compresses and decompresses the sample at its default
+    level. The slower direction counts, as it bounds backup or restore.
+    Codecs whose program is not installed are skipped, as tar could not
+    compress with them.
+
+    Args:
+        sample (bytes): representative data, e.g. from read_sample
+        target_throughput (float): minimum throughput in bytes per second
+        workers (int, optional): Number of compressing threads, which
+            scale the measured throughput. Defaults to 1.
+
+    Returns:
+        str: codec name, "none" if no codec is fast enough
+    """
+    best = "none"
+    best_size = len(sample)
+    for name, codec in CODECS.items():
+        if not is_available(name):
+            logger.debug("Codec %s: %s not installed.", name, codec.program)
+            continue
+        start = perf_counter()
+        compressed = codec.compress(sample, codec.default_level)
+        middle = perf_counter()
+        codec.decompress(compressed)
+        end = perf_counter()
+        throughput = len(sample)*workers / max(
+            middle - start, end - middle, 1e-9
+        )
+        logger.debug(
+            "Codec %s: ratio %.3f, %.0f MB/s.",
+            name, len(compressed) / max(len(sample), 1), throughput / 1e6
+        )
+        if throughput >= target_throughput and len(compressed) < best_size:
+            best, best_size = name, len(compressed)
+    logger.info("Selected codec %s.", best)
+    return best
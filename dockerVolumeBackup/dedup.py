@@ -0,0 +1,513 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Deduplicating backup store based on content defined chunking.
+
+The tar stream is split into chunks at positions determined by the content,
+so unchanged data yields the same chunks even if data before it changed.
+Each chunk is compressed, encrypted and stored once as 'chunks/<id>'. A
+backup is a manifest listing its chunks.
+
+Backups and garbage collection exclude each other by documents under
+'locks/'. A backup writes its lock before it reads the marker of the last
+collection, which a collection writes before it lists the locks. One of
+both sees the other and stops. Every collection starts a new generation
+of the marker, which makes stale chunk indexes rebuild from the bucket.
+"""
+
+import hmac
+import json
+import re
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from hashlib import sha256
+from io import BytesIO
+from logging import getLogger
+from pathlib import Path
+from typing import \
+    IO, Any, Dict, Iterable, Iterator, List, Optional, Set, Tuple
+from uuid import uuid4
+
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+from .compression import DEFAULT_CODEC
+from .documents import MANIFEST_SUFFIX, download_document, upload_document
+from .frames import decode_frame, encode_frame
+from .mycrypt import AsymmetricFernetError, decrypt_stream, encrypt_stream
+from .storage import AWSBucket
+from .streams import parallel_map, read_exact
+from .tar import pack_stream, unpack_stream
+from .throttle import TokenBucket
+
+CHUNK_PREFIX = "chunks/"
+LOCK_PREFIX = "locks/"
+BACKUP_LOCK_PREFIX = LOCK_PREFIX + "backup-"
+GC_MARKER = LOCK_PREFIX + "gc"
+MIN_CHUNK_SIZE = 2**18
+MAX_CHUNK_SIZE = 2**22
+READ_SIZE = 2**20
+# Bytes are mapped to 16 pseudo random symbols. A chunk ends after the
+# anchor of five distinct symbols, which occurs every 16**5 bytes = 1 MiB
+# on average. Both steps run in C, unlike a byte wise rolling hash.
+SYMBOLS = bytes(
+    sha256(bytes([value])).digest()[0] & 0x0f for value in range(256)
+)
+ANCHOR = re.compile(bytes([0x01, 0x07, 0x0c, 0x03, 0x0e]))
+# Chunks younger than this are never collected, a margin on top of the
+# locks of running backups.
+GC_GRACE_PERIOD = timedelta(days=1)
+# Locks and running collections older than this are left over by crashed
+# runs and ignored.
+LOCK_EXPIRY = timedelta(days=7)
+logger = getLogger(__file__)
+
+
+class ConcurrentRunError(Exception):
+    """Backup and garbage collection of the chunk store overlap."""
+
+
+class ChunkIndex:
+    """Local record of chunks known to exist in the bucket.
+
+    Saves a request per chunk when deciding what to upload. The index is
+    filled from a bucket listing when empty or when a garbage collection
+    ran since, so deleting the index file forces a resync.
+    """
+
+    def __init__(self, path: Path) -> None:
+        """ChunkIndex constructor.
+
+        Args:
+            path (Path): SQLite database file
+        """
+        self._connection = sqlite3.connect(path)
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS chunks (id TEXT PRIMARY KEY)"
+        )
+        # generation of garbage collection the chunks were listed in
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS generation (id TEXT)"
+        )
+
+    @property
+    def generation(self) -> Optional[str]:
+        """Generation of garbage collection the index is valid for.
+
+        Returns:
+            Optional[str]: generation, None before the first collection
+        """
+        row = self._connection.execute(
+            "SELECT id FROM generation"
+        ).fetchone()
+        return None if row is None else row[0]
+
+    @generation.setter
+    def generation(self, generation: Optional[str]) -> None:
+        """Set generation of garbage collection.
+
+        Args:
+            generation (Optional[str]): generation
+        """
+        self._connection.execute("DELETE FROM generation")
+        self._connection.execute(
+            "INSERT INTO generation VALUES (?)", (generation,)
+        )
+
+    def __contains__(self, chunk_id: str) -> bool:
+        """Check if chunk is known.
+
+        Args:
+            chunk_id (str): chunk id
+
+        Returns:
+            bool: True if chunk exists in bucket
+        """
+        return self._connection.execute(
+            "SELECT 1 FROM chunks WHERE id = ?", (chunk_id,)
+        ).fetchone() is not None
+
+    def add(self, chunk_ids: Iterable[str]) -> None:
+        """Record chunks as existing.
+
+        Args:
+            chunk_ids (Iterable[str]): chunk ids
+        """
+        self._connection.executemany(
+            "INSERT OR IGNORE INTO chunks VALUES (?)",
+            ((chunk_id,) for chunk_id in chunk_ids)
+        )
+
+    def remove(self, chunk_ids: Iterable[str]) -> None:
+        """Forget chunks.
+
+        Args:
+            chunk_ids (Iterable[str]): chunk ids
+        """
+        self._connection.executemany(
+            "DELETE FROM chunks WHERE id = ?",
+            ((chunk_id,) for chunk_id in chunk_ids)
+        )
+
+    def sync(self, aws: AWSBucket, generation: Optional[str]) -> None:
+        """Fill index from bucket listing if empty or stale.
+
+        Args:
+            aws (AWSBucket): bucket connector
+            generation (Optional[str]): generation of the last garbage
+                collection
+        """
+        if generation == self.generation and \
+                self._connection.execute("SELECT 1 FROM chunks").fetchone():
+            return
+        logger.info("Building chunk index from bucket listing.")
+        self._connection.execute("DELETE FROM chunks")
+        self.add(
+            file_name.removeprefix(CHUNK_PREFIX)
+            for file_name in aws.list_files(CHUNK_PREFIX)
+        )
+        self.generation = generation
+        self.commit()
+
+    def commit(self) -> None:
+        """Persist changes."""
+        self._connection.commit()
+
+
+def _read_gc_marker(aws: AWSBucket) -> Dict[str, Any]:
+    """Read state of the last garbage collection.
+
+    Args:
+        aws (AWSBucket): bucket connector
+
+    Returns:
+        Dict[str, Any]: generation, whether it is running and its start
+            time, generation None if no collection ran yet
+    """
+    if aws.stat(GC_MARKER) is None:
+        return {"generation": None, "running": False, "started": None}
+    return json.loads(aws.download_bytes(GC_MARKER))
+
+
+def _write_gc_marker(
+    aws: AWSBucket,
+    generation: str,
+    running: bool,
+    started: datetime
+) -> None:
+    """Write state of a garbage collection.
+
+    Args:
+        aws (AWSBucket): bucket connector
+        generation (str): generation of the collection
+        running (bool): True while chunks may be deleted
+        started (datetime): start time of the collection
+    """
+    aws.upload_bytes(
+        json.dumps({
+            "generation": generation, "running": running,
+            "started": started.isoformat()
+        }).encode(),
+        GC_MARKER
+    )
+
+
+def _active_backups(aws: AWSBucket) -> List[str]:
+    """List locks of running deduplicated backups.
+
+    Args:
+        aws (AWSBucket): bucket connector
+
+    Returns:
+        List[str]: names of locks younger than LOCK_EXPIRY
+    """
+    expired = set(aws.list_files(
+        BACKUP_LOCK_PREFIX,
+        modified_before=datetime.now(timezone.utc) - LOCK_EXPIRY
+    ))
+    return [
+        lock for lock in aws.list_files(BACKUP_LOCK_PREFIX)
+        if lock not in expired
+    ]
+
+
+def chunk_stream(
+    bytesio_in: IO[bytes],
+    min_size: int = MIN_CHUNK_SIZE,
+    max_size: int = MAX_CHUNK_SIZE
+) -> Iterator[bytes]:
+    """Split stream into content defined chunks.
+
+    Args:
+        bytesio_in (IO[bytes]): readable stream
+        min_size (int, optional): Minimum chunk size except for the last
+            chunk. Defaults to MIN_CHUNK_SIZE.
+        max_size (int, optional): Maximum chunk size.
+            Defaults to MAX_CHUNK_SIZE.
+
+    Yields:
+        bytes: chunks
+    """
+    buffer = bytearray()
+    symbols = bytearray()
+    eof = False
+    while True:
+        while not eof and len(buffer) < max_size:
+            data = read_exact(bytesio_in, READ_SIZE)
+            eof = len(data) < READ_SIZE
+            buffer += data
+            symbols += data.translate(SYMBOLS)
+        if not buffer:
+            return
+        match = ANCHOR.search(symbols, min_size, max_size)
+        end = match.end() if match else min(len(buffer), max_size)
+        yield bytes(buffer[:end])
+        del buffer[:end]
+        del symbols[:end]
+
+
+def _chunk_key(public_key: rsa.RSAPublicKey) -> bytes:
+    """Key of chunk ids.
+
+    Chunk ids are keyed hashes, so the bucket does not reveal whether it
+    contains some known content.
+
+    Args:
+        public_key (rsa.RSAPublicKey): public key of backups
+
+    Returns:
+        bytes: key
+    """
+    return sha256(
+        b"chunk id" + public_key.public_bytes(
+            serialization.Encoding.DER,
+            serialization.PublicFormat.SubjectPublicKeyInfo
+        )
+    ).digest()
+
+
+def _chunk_id(key: bytes, chunk: bytes) -> str:
+    """Compute chunk id.
+
+    Args:
+        key (bytes): key from _chunk_key
+        chunk (bytes): chunk data
+
+    Returns:
+        str: chunk id
+    """
+    return hmac.new(key, chunk, sha256).hexdigest()
+
+
+def backup_dedup(
+    aws: AWSBucket,
+    path: Path,
+    name: str,
+    public_key: rsa.RSAPublicKey,
+    index: ChunkIndex,
+    workers: int = 1,
+    codec: str = DEFAULT_CODEC,
+    level: Optional[int] = None,
+    read_limit: Optional[TokenBucket] = None,
+    max_chunks_in_flight: Optional[int] = None
+) -> None:
+    """Upload chunks missing in the bucket and the manifest of the backup.
+
+    A lock in the bucket keeps garbage collection from deleting chunks the
+    backup reuses until the manifest is uploaded.
+
+    Args:
+        aws (AWSBucket): bucket connector
+        path (Path): directory to back up
+        name (str): name of backup in bucket
+        public_key (rsa.RSAPublicKey): public key to encrypt chunks
+        index (ChunkIndex): chunks existing in bucket
+        workers (int, optional): Number of threads compressing, encrypting
+            and uploading chunks. Defaults to 1.
+        codec (str, optional): Codec name. Defaults to DEFAULT_CODEC.
+        level (Optional[int], optional): Compression level.
+            Defaults to the codec's default level.
+        read_limit (Optional[TokenBucket], optional): Rate limit of the
+            archive stream. Defaults to unlimited.
+        max_chunks_in_flight (Optional[int], optional): Maximum number of
+            chunks being compressed, encrypted and uploaded. Defaults to two
+            per worker.
+
+    Raises:
+        ConcurrentRunError: garbage collection is running
+    """
+    key = _chunk_key(public_key)
+    manifest: List[Tuple[str, int]] = []
+    pending: Set[str] = set()
+    stored_bytes = 0
+
+    def store(item: Tuple[str, bytes]) -> str:
+        chunk_id, chunk = item
+        aws.upload_bytes(
+            b"".join(encrypt_stream(
+                BytesIO(encode_frame(chunk, codec, level)), public_key
+            )),
+            CHUNK_PREFIX + chunk_id
+        )
+        return chunk_id
+
+    def new_chunks(bytesio: IO[bytes]) -> Iterator[Tuple[str, bytes]]:
+        nonlocal stored_bytes
+        for chunk in chunk_stream(bytesio):
+            chunk_id = _chunk_id(key, chunk)
+            manifest.append((chunk_id, len(chunk)))
+            if chunk_id not in pending and chunk_id not in index:
+                pending.add(chunk_id)
+                stored_bytes += len(chunk)
+                yield chunk_id, chunk
+
+    lock = BACKUP_LOCK_PREFIX + uuid4().hex
+    aws.upload_bytes(json.dumps({"name": name}).encode(), lock)
+    try:
+        marker = _read_gc_marker(aws)
+        if marker["running"] and datetime.now(timezone.utc) - \
+                datetime.fromisoformat(marker["started"]) < LOCK_EXPIRY:
+            raise ConcurrentRunError(
+                f"Garbage collection started at {marker['started']} is "
+                "running."
+            )
+        index.sync(aws, marker["generation"])
+        with pack_stream(path, read_limit=read_limit) as archive, \
+                ThreadPoolExecutor(max_workers=workers) as executor:
+            for chunk_id in parallel_map(
+                executor, store, new_chunks(archive),
+                max_chunks_in_flight or 2*workers
+            ):
+                index.add((chunk_id,))
+        index.commit()
+        upload_document(
+            aws, name + MANIFEST_SUFFIX, {"chunks": manifest}, public_key
+        )
+    finally:
+        aws.delete([lock])
+    logger.info(
+        "Stored %d of %d chunks, %d of %d bytes.",
+        len(pending), len(manifest),
+        stored_bytes, sum(size for _, size in manifest)
+    )
+
+
+def restore_dedup(
+    aws: AWSBucket,
+    name: str,
+    private_key: rsa.RSAPrivateKey,
+    workers: int = 1
+) -> None:
+    """Download chunks of backup and unpack them into working directory.
+
+    Args:
+        aws (AWSBucket): bucket connector
+        name (str): name of backup in bucket
+        private_key (rsa.RSAPrivateKey): Private key used for encryption.
+        workers (int, optional): Number of threads downloading and
+            decrypting chunks. Defaults to 1.
+    """
+    key = _chunk_key(private_key.public_key())
+    manifest = download_document(aws, name + MANIFEST_SUFFIX, private_key)
+
+    def load(chunk_id: str) -> bytes:
+        chunk = decode_frame(b"".join(decrypt_stream(
+            private_key,
+            BytesIO(aws.download_bytes(CHUNK_PREFIX + chunk_id))
+        )))
+        if not hmac.compare_digest(_chunk_id(key, chunk), chunk_id):
+            raise AsymmetricFernetError(f"Chunk {chunk_id} is corrupt.")
+        return chunk
+
+    with ThreadPoolExecutor(max_workers=workers) as executor, \
+            unpack_stream() as archive:
+        for chunk in parallel_map(
+            executor, load,
+            (chunk_id for chunk_id, _ in manifest["chunks"]),
+            2*workers
+        ):
+            archive.write(chunk)
+
+
+def collect_garbage(
+    aws: AWSBucket,
+    private_key: rsa.RSAPrivateKey,
+    index: ChunkIndex,
+    dry_run: bool = False
+) -> List[str]:
+    """Delete chunks not referenced by any version of any manifest.
+
+    Nothing is deleted while deduplicated backups are running.
+
+    Args:
+        aws (AWSBucket): bucket connector
+        private_key (rsa.RSAPrivateKey): Private key used for encryption.
+        index (ChunkIndex): chunks existing in bucket
+        dry_run (bool, optional): Only report unreferenced chunks.
+            Defaults to False.
+
+    Raises:
+        ConcurrentRunError: deduplicated backups are running
+
+    Returns:
+        List[str]: ids of deleted chunks, of all unreferenced chunks on a
+            dry run
+    """
+    generation = uuid4().hex
+    started = datetime.now(timezone.utc)
+    if not dry_run:
+        _write_gc_marker(aws, generation, True, started)
+    try:
+        if not dry_run and (locks := _active_backups(aws)):
+            raise ConcurrentRunError(
+                f"{len(locks)} deduplicated backups are running, e.g. "
+                f"{locks[0]}."
+            )
+        referenced: Dict[str, None] = {}
+        for file_name, version_id in aws.list_versions(
+            exclude_prefixes=(CHUNK_PREFIX, LOCK_PREFIX)
+        ):
+            if file_name.endswith(MANIFEST_SUFFIX):
+                logger.debug(
+                    "Reading manifest %s %s.", file_name, version_id
+                )
+                referenced.update(
+                    (chunk_id, None)
+                    for chunk_id, _ in download_document(
+                        aws, file_name, private_key, version_id
+                    )["chunks"]
+                )
+        garbage = [
+            chunk_id
+            for chunk_id in (
+                file_name.removeprefix(CHUNK_PREFIX)
+                for file_name in aws.list_files(
+                    CHUNK_PREFIX, modified_before=started - GC_GRACE_PERIOD
+                )
+            )
+            if chunk_id not in referenced
+        ]
+        logger.info("%d unreferenced chunks.", len(garbage))
+        if not dry_run:
+            # the index of this host stays valid for the new generation
+            index.remove(garbage)
+            index.generation = generation
+            index.commit()
+            failed = {
+                file_name.removeprefix(CHUNK_PREFIX)
+                for file_name in aws.delete(
+                    CHUNK_PREFIX + chunk_id for chunk_id in garbage
+                )
+            }
+            if failed:
+                # chunks left in the bucket can still be reused
+                logger.warning("%d chunks were not deleted.", len(failed))
+                index.add(failed)
+                index.commit()
+                garbage = [
+                    chunk_id for chunk_id in garbage if chunk_id not in failed
+                ]
+    finally:
+        if not dry_run:
+            _write_gc_marker(aws, generation, False, started)
+    return garbage
@@ -0,0 +1,71 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Encrypted JSON documents stored next to backups, e.g. member indexes."""
+
+import bz2
+import json
+from io import BytesIO
+from typing import Any, Dict, Optional
+
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+from .mycrypt import decrypt_stream, encrypt_stream
+from .storage import AWSBucket
+from .streams import IteratorReader
+
+# suffix of the object holding the member index of a backup
+INDEX_SUFFIX = ".index"
+# suffix of the object holding the chunk manifest of a deduplicated backup
+MANIFEST_SUFFIX = ".dedup"
+# suffix of the object holding the file manifest of an incremental chain
+FILES_SUFFIX = ".files"
+# suffix of the object listing the archives of a sharded backup
+SHARDS_SUFFIX = ".shards"
+
+
+def upload_document(
+    aws: AWSBucket,
+    name: str,
+    document: Dict[str, Any],
+    public_key: rsa.RSAPublicKey
+) -> None:
+    """Compress, encrypt and upload JSON document.
+
+    File names and sizes are sensitive, so documents are encrypted like
+    the backups themselves.
+
+    Args:
+        aws (AWSBucket): bucket connector
+        name (str): name of file in bucket
+        document (Dict[str, Any]): JSON serializable document
+        public_key (rsa.RSAPublicKey): public key to encrypt symmetric key
+    """
+    data = bz2.compress(json.dumps(document, separators=(",", ":")).encode())
+    aws.upload_stream(
+        IteratorReader(encrypt_stream(BytesIO(data), public_key)),
+        name
+    )
+
+
+def download_document(
+    aws: AWSBucket,
+    name: str,
+    private_key: rsa.RSAPrivateKey,
+    version_id: Optional[str] = None
+) -> Dict[str, Any]:
+    """Download, decrypt and decompress JSON document.
+
+    Args:
+        aws (AWSBucket): bucket connector
+        name (str): name of file in bucket
+        private_key (rsa.RSAPrivateKey): Private key used for encryption.
+        version_id (Optional[str], optional): Version of document.
+            Defaults to the current version.
+
+    Returns:
+        Dict[str, Any]: document
+    """
+    data = b"".join(decrypt_stream(
+        private_key, BytesIO(aws.download_bytes(name, version_id))
+    ))
+    return json.loads(bz2.decompress(data))
@@ -0,0 +1,538 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Extract tar streams with parallel writers.
+
+tar extracts one file after the other, and for many small files the
+syscalls per file dominate a restore. The extractor decodes the stream
+once in the calling thread and hands the bodies of small files to writer
+threads, which create, write and chown, chmod and utime the file through
+its descriptor. Large files are written in the calling thread, where each
+write is large anyway, and so are sparse files, skipping their holes.
+Directories are created as they appear. Hard links and symlinks are
+created once all files are written, then the metadata of directories is
+applied deepest first, so extraction does not change their times again.
+Like tar, symlinks are created last, so no file is written through a
+symlink of the archive.
+
+In sync mode the extractor updates an existing tree. Files of the same
+size and modification time are skipped, other files are compared chunk by
+chunk and only differing chunks are written. Entries missing from the
+archive may be deleted.
+"""
+
+import os
+import shutil
+import tarfile
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import lru_cache
+from grp import getgrnam
+from logging import getLogger
+from pathlib import Path, PurePosixPath
+from pwd import getpwnam
+from threading import Lock, Thread
+from typing import \
+    IO, ContextManager, Deque, Dict, Iterator, List, Optional, Set, Tuple
+
+from .compression import get_codec, tar_options
+from .tar import unpack_stream
+
+# files up to this size are written by the writer threads
+SMALL_FILE_SIZE = 2**20
+# files read ahead per writer, which bounds memory to about
+# writers * FILES_PER_WRITER * SMALL_FILE_SIZE
+FILES_PER_WRITER = 4
+COPY_SIZE = 2**20
+logger = getLogger(__file__)
+
+
+@lru_cache(maxsize=None)
+def _owner(uname: str, gname: str, uid: int, gid: int) -> Tuple[int, int]:
+    """Look up owner like tar, by name first and by id otherwise.
+
+    Args:
+        uname (str): user name
+        gname (str): group name
+        uid (int): user id
+        gid (int): group id
+
+    Returns:
+        Tuple[int, int]: user and group id
+    """
+    try:
+        uid = getpwnam(uname).pw_uid if uname else uid
+    except KeyError:
+        pass
+    try:
+        gid = getgrnam(gname).gr_gid if gname else gid
+    except KeyError:
+        pass
+    return uid, gid
+
+
+class ParallelExtractor:
+    """Extract uncompressed tar streams below a directory."""
+
+    def __init__(
+        self,
+        root: Path,
+        writers: int = 4,
+        sync: bool = False,
+        delete: Optional[Path] = None
+    ) -> None:
+        """ParallelExtractor constructor.
+
+        Args:
+            root (Path): directory member names are relative to, e.g. the
+                working directory of tar
+            writers (int, optional): Number of writer threads.
+                Defaults to 4.
+            sync (bool, optional): Write only files which differ from the
+                existing ones. Defaults to False.
+            delete (Optional[Path], optional): Delete entries below this
+                directory which are not in the archive. Defaults to None.
+        """
+        self.root = root
+        self.writers = writers
+        self.sync = sync
+        self.delete = delete
+        # owners are only restored by root, as by tar
+        self._chown = os.geteuid() == 0
+        self._directories: Dict[Path, tarfile.TarInfo] = {}
+        self._created = {root}
+        # links by path in archive order, a later member replaces them
+        self._links: Dict[Path, tarfile.TarInfo] = {}
+        self._seen: Set[Path] = set()
+        self._lock = Lock()
+        self.files = 0
+        self.unchanged = 0
+        self.deleted = 0
+
+    def _path(self, name: str) -> Optional[Path]:
+        """Resolve member name below root.
+
+        Args:
+            name (str): member or hard link target name
+
+        Returns:
+            Optional[Path]: path, None if it would leave root
+        """
+        parts = [
+            part for part in PurePosixPath(name).parts
+            if part not in ("/", ".")
+        ]
+        if ".." in parts:
+            logger.warning("Skipping member outside of root: %s", name)
+            return None
+        return self.root.joinpath(*parts)
+
+    def _make_parents(self, path: Path) -> None:
+        """Create missing parent directories.
+
+        Args:
+            path (Path): path to be created
+        """
+        if path.parent not in self._created:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            self._created.add(path.parent)
+
+    def _set_metadata(
+        self,
+        target: "int | Path",
+        member: tarfile.TarInfo,
+        follow_symlinks: bool = True
+    ) -> None:
+        """Apply owner, mode and modification time.
+
+        Args:
+            target (int | Path): open file descriptor or path
+            member (tarfile.TarInfo): archived metadata
+            follow_symlinks (bool, optional): False to change a symlink
+                itself. Defaults to True.
+        """
+        if self._chown:
+            uid, gid = _owner(
+                member.uname, member.gname, member.uid, member.gid
+            )
+            os.chown(target, uid, gid, follow_symlinks=follow_symlinks)
+        # the mode of symlinks cannot be changed on Linux
+        if follow_symlinks:
+            os.chmod(target, member.mode)
+        os.utime(
+            target, (member.mtime, member.mtime),
+            follow_symlinks=follow_symlinks
+        )
+
+    def _remove(self, path: Path) -> None:
+        """Remove entry in the way, directories only in sync mode.
+
+        Args:
+            path (Path): file, link or directory
+        """
+        if path.is_dir() and not path.is_symlink():
+            if self.sync:
+                shutil.rmtree(path)
+        else:
+            path.unlink(missing_ok=True)
+
+    def _open(self, path: Path) -> int:
+        """Open file for writing without following a symlink.
+
+        The file is truncated unless in sync mode.
+
+        Args:
+            path (Path): file
+
+        Returns:
+            int: file descriptor opened for writing
+        """
+        flags = os.O_CREAT | os.O_NOFOLLOW | (
+            os.O_RDWR if self.sync else os.O_WRONLY | os.O_TRUNC
+        )
+        try:
+            return os.open(path, flags, 0o600)
+        except OSError:
+            # replace symlinks and other files in the way
+            self._remove(path)
+            return os.open(path, flags, 0o600)
+
+    def _unchanged(self, descriptor: int, member: tarfile.TarInfo) -> bool:
+        """Check in sync mode if the file has the archived size and time.
+
+        Args:
+            descriptor (int): open file
+            member (tarfile.TarInfo): archived metadata
+
+        Returns:
+            bool: True if the content need not be written
+        """
+        if not self.sync:
+            return False
+        status = os.fstat(descriptor)
+        if status.st_size != member.size or \
+                int(status.st_mtime) != int(member.mtime):
+            return False
+        with self._lock:
+            self.unchanged += 1
+        return True
+
+    def _write_at(self, descriptor: int, data: bytes, offset: int) -> None:
+        """Write chunk, in sync mode only if it differs from the file.
+
+        Args:
+            descriptor (int): open file
+            data (bytes): chunk
+            offset (int): position of chunk in file
+        """
+        if self.sync and os.pread(descriptor, len(data), offset) == data:
+            return
+        view = memoryview(data)
+        while view:
+            written = os.pwrite(descriptor, view, offset)
+            view = view[written:]
+            offset += written
+
+    def _write(
+        self,
+        path: Path,
+        member: tarfile.TarInfo,
+        data: bytes
+    ) -> None:
+        """Write small file, runs in a writer thread.
+
+        Args:
+            path (Path): file
+            member (tarfile.TarInfo): archived metadata
+            data (bytes): content
+        """
+        descriptor = self._open(path)
+        try:
+            if not self._unchanged(descriptor, member):
+                self._write_at(descriptor, data, 0)
+                os.ftruncate(descriptor, member.size)
+            self._set_metadata(descriptor, member)
+        finally:
+            os.close(descriptor)
+
+    def _copy(
+        self,
+        path: Path,
+        member: tarfile.TarInfo,
+        bytesio: IO[bytes]
+    ) -> None:
+        """Write large or sparse file in the calling thread.
+
+        Only the data extents of sparse members are written, so their
+        holes are restored.
+
+        Args:
+            path (Path): file
+            member (tarfile.TarInfo): archived metadata
+            bytesio (IO[bytes]): content
+        """
+        # the buffered member reader refuses to seek in a tar stream, its
+        # raw reader skips holes forward
+        source = getattr(bytesio, "raw", bytesio)
+        descriptor = self._open(path)
+        try:
+            if not self._unchanged(descriptor, member):
+                # holes are only recreated in a new file
+                if self.sync and member.sparse:
+                    os.ftruncate(descriptor, 0)
+                for offset, size in member.sparse or [(0, member.size)]:
+                    source.seek(offset)
+                    while size and \
+                            (data := source.read(min(size, COPY_SIZE))):
+                        self._write_at(descriptor, data, offset)
+                        offset += len(data)
+                        size -= len(data)
+                os.ftruncate(descriptor, member.size)
+            self._set_metadata(descriptor, member)
+        finally:
+            os.close(descriptor)
+
+    def extract(self, bytesio: IO[bytes]) -> None:
+        """Extract members of tar stream, except links.
+
+        Call finish once the whole archive is extracted.
+
+        Args:
+            bytesio (IO[bytes]): readable uncompressed tar stream
+
+        Raises:
+            tarfile.TarError: stream is no tar archive or truncated
+            OSError: a file could not be written
+        """
+        pending: Deque[Future] = deque()
+        # files being written by path, a later member waits for them
+        writing: Dict[Path, Future] = {}
+        with ThreadPoolExecutor(max_workers=self.writers) as executor, \
+                tarfile.open(fileobj=bytesio, mode="r|") as archive:
+            try:
+                for member in archive:
+                    path = self._path(member.name)
+                    if path is None:
+                        continue
+                    if path in writing:
+                        writing.pop(path).result()
+                    self._links.pop(path, None)
+                    self._seen.add(path)
+                    if member.isdir():
+                        if self.sync and (
+                            path.is_symlink() or path.exists()
+                            and not path.is_dir()
+                        ):
+                            path.unlink()
+                        path.mkdir(parents=True, exist_ok=True)
+                        self._created.add(path)
+                        self._directories[path] = member
+                        continue
+                    self._make_parents(path)
+                    if member.isreg():
+                        reader = archive.extractfile(member)
+                        if member.size > SMALL_FILE_SIZE or member.sparse:
+                            self._copy(path, member, reader)
+                        else:
+                            future = executor.submit(
+                                self._write, path, member, reader.read()
+                            )
+                            pending.append(future)
+                            writing[path] = future
+                            while len(pending) > \
+                                    self.writers*FILES_PER_WRITER:
+                                pending.popleft().result()
+                    elif member.islnk() or member.issym():
+                        self._links[path] = member
+                    elif member.ischr() or member.isblk() or \
+                            member.isfifo():
+                        self._remove(path)
+                        os.mknod(
+                            path, member.mode | (
+                                0o020000 if member.ischr() else
+                                0o060000 if member.isblk() else 0o010000
+                            ),
+                            os.makedev(member.devmajor, member.devminor)
+                        )
+                        self._set_metadata(path, member)
+                    self.files += 1
+                    if len(writing) > 2*self.writers*FILES_PER_WRITER:
+                        writing = {
+                            path: future for path, future in writing.items()
+                            if not future.done()
+                        }
+                while pending:
+                    pending.popleft().result()
+            finally:
+                for future in pending:
+                    future.cancel()
+
+    def _linked(self, path: Path, member: tarfile.TarInfo) -> bool:
+        """Check in sync mode if the link exists already.
+
+        Args:
+            path (Path): link
+            member (tarfile.TarInfo): archived link
+
+        Returns:
+            bool: True if the link need not be created
+        """
+        if not self.sync or not path.is_symlink() and not path.exists():
+            return False
+        if member.issym():
+            return path.is_symlink() and \
+                os.readlink(path) == member.linkname
+        target = self._path(member.linkname)
+        return target is not None and target.exists() and \
+            os.path.samestat(path.lstat(), target.lstat())
+
+    def _delete_missing(self) -> None:
+        """Delete entries below the delete directory not in the archive.
+
+        Raises:
+            FileNotFoundError: archive does not contain the directory,
+                which would delete everything below it
+        """
+        if self.delete not in self._seen:
+            raise FileNotFoundError(
+                f"Archive does not contain {self.delete}, not deleting."
+            )
+        for directory, directories, files in os.walk(self.delete):
+            for name in [*directories, *files]:
+                path = Path(directory)/name
+                if path not in self._seen:
+                    logger.debug("Deleting %s", path)
+                    self._remove(path)
+                    self.deleted += 1
+            # do not descend into deleted directories
+            directories[:] = [
+                name for name in directories
+                if (Path(directory)/name).is_dir()
+            ]
+
+    def finish(self) -> None:
+        """Create links, delete missing entries, set directory metadata."""
+        for path, member in self._links.items():
+            if self._linked(path, member):
+                with self._lock:
+                    self.unchanged += 1
+            elif member.issym():
+                self._remove(path)
+                os.symlink(member.linkname, path)
+            else:
+                target = self._path(member.linkname)
+                if target is not None:
+                    self._remove(path)
+                    os.link(target, path, follow_symlinks=False)
+            if member.issym():
+                self._set_metadata(path, member, follow_symlinks=False)
+        # deleting changes the times of directories
+        if self.delete is not None:
+            self._delete_missing()
+        for path in sorted(
+            self._directories, key=lambda path: len(path.parts),
+            reverse=True
+        ):
+            self._set_metadata(path, self._directories[path])
+
+
+@contextmanager
+def extract_stream(
+    writers: int = 4,
+    codec: Optional[str] = None,
+    root: Optional[Path] = None,
+    sync: bool = False,
+    delete: Optional[Path] = None
+) -> Iterator[IO[bytes]]:
+    """Extract tar archive written to the stream with parallel writers.
+
+    Like unpack_stream, existing files are overwritten. Links are created,
+    entries deleted and directory metadata applied only if the whole
+    archive was written without error.
+
+    Args:
+        writers (int, optional): Number of writer threads. Defaults to 4.
+        codec (Optional[str], optional): Codec the archive is compressed
+            with. Defaults to None for uncompressed.
+        root (Optional[Path], optional): Directory member names are
+            relative to. Defaults to the working directory.
+        sync (bool, optional): Write only files which differ from the
+            existing ones. Defaults to False.
+        delete (Optional[Path], optional): Delete entries below this
+            directory which are not in the archive. Defaults to None.
+
+    Raises:
+        tarfile.TarError: stream is no tar archive or truncated
+        OSError: a file could not be written
+
+    Yields:
+        IO[bytes]: writable archive stream
+    """
+    extractor = ParallelExtractor(root or Path.cwd(), writers, sync, delete)
+    read_descriptor, write_descriptor = os.pipe()
+    reader = open(read_descriptor, "rb")
+    writer = open(write_descriptor, "wb")
+    errors: List[BaseException] = []
+
+    def extract() -> None:
+        with reader:
+            try:
+                extractor.extract(
+                    get_codec(codec or "none").decompress_stream(reader)
+                )
+                # the end of archive padding, which tarfile does not read
+                while reader.read(COPY_SIZE):
+                    pass
+            except BaseException as error:  # pylint: disable=broad-except
+                errors.append(error)
+
+    thread = Thread(target=extract, daemon=True)
+    thread.start()
+    try:
+        try:
+            yield writer
+        finally:
+            try:
+                writer.close()
+            except BrokenPipeError:
+                pass
+            thread.join()
+    except BrokenPipeError:
+        # the extractor stopped reading, its error is the cause
+        if not errors:
+            raise
+    if errors:
+        raise errors[0]
+    extractor.finish()
+    if sync:
+        logger.info(
+            "Synced %d members, %d unchanged, %d deleted.",
+            extractor.files, extractor.unchanged, extractor.deleted
+        )
+    else:
+        logger.debug("Extracted %d members.", extractor.files)
+
+
+def open_extractor(
+    codec: str,
+    writers: int = 1,
+    sync: bool = False,
+    delete: Optional[Path] = None
+) -> ContextManager[IO[bytes]]:
+    """Unpack archive written to the stream with tar or parallel writers.
+
+    Args:
+        codec (str): codec name the archive is compressed with
+        writers (int, optional): Number of writer threads, 1 to unpack
+            with tar unless syncing. Defaults to 1.
+        sync (bool, optional): Write only files which differ from the
+            existing ones. Defaults to False.
+        delete (Optional[Path], optional): With sync, delete entries below
+            this directory which are not in the archive. Defaults to None.
+
+    Returns:
+        ContextManager[IO[bytes]]: writable archive stream
+    """
+    if writers > 1 or sync:
+        return extract_stream(writers, codec, sync=sync, delete=delete)
+    return unpack_stream(tar_options(codec, decompress=True))
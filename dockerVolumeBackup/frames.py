@@ -0,0 +1,270 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Compression in independently decodable frames.
+
+The stream is split into frames of FRAME_SIZE bytes that are compressed on
+their own. Together with the frame table any range of the uncompressed
+stream can be decoded without decompressing everything before it.
+"""
+
+import struct
+import zlib
+from bisect import bisect_right
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from logging import getLogger
+from typing import Callable, IO, Iterable, Iterator, List, Optional, Tuple
+
+from .compression import CODECS, DEFAULT_CODEC, get_codec
+from .streams import parallel_map, read_exact
+
+FRAME_SIZE = 4*2**20
+# codec, uncompressed size and compressed size
+FRAME_HEADER = struct.Struct(">BII")
+FRAME_CODECS = {codec.frame_id: codec for codec in CODECS.values()}
+STORED_CODEC = "none"
+# Frames whose sample shrinks less than this are stored uncompressed, e.g.
+# media or compressed logs. Set to None to compress all frames.
+INCOMPRESSIBLE_RATIO = 0.95
+SAMPLE_SLICES = 4
+SAMPLE_SLICE_SIZE = 2**14
+logger = getLogger(__file__)
+
+
+class FrameError(Exception):
+    """Frame decoding related error."""
+
+
+def is_compressible(data: bytes) -> bool:
+    """Estimate cheaply whether data is worth compressing.
+
+    Compresses a few slices spread over data with the fastest zlib level,
+    which costs about 1% of compressing a frame with bzip2.
+
+    Args:
+        data (bytes): uncompressed data
+
+    Returns:
+        bool: False if the sample shrinks less than INCOMPRESSIBLE_RATIO
+    """
+    if INCOMPRESSIBLE_RATIO is None:
+        return True
+    if len(data) <= SAMPLE_SLICES*SAMPLE_SLICE_SIZE:
+        sample = bytes(data)
+    else:
+        step = (len(data) - SAMPLE_SLICE_SIZE) // (SAMPLE_SLICES - 1)
+        sample = b"".join(
+            data[start:start + SAMPLE_SLICE_SIZE]
+            for start in range(0, SAMPLE_SLICES*step, step)
+        )
+    return len(zlib.compress(sample, 1)) < INCOMPRESSIBLE_RATIO*len(sample)
+
+
+def encode_frame(
+    data: bytes,
+    codec: str = DEFAULT_CODEC,
+    level: Optional[int] = None
+) -> bytes:
+    """Compress one frame.
+
+    Incompressible frames are stored, the codec in the frame header tells
+    decode_frame.
+
+    Args:
+        data (bytes): uncompressed data
+        codec (str, optional): Codec name. Defaults to DEFAULT_CODEC.
+        level (Optional[int], optional): Compression level.
+            Defaults to the codec's default level.
+
+    Returns:
+        bytes: frame header and compressed data
+    """
+    frame_codec = get_codec(codec)
+    compressed = None
+    if codec != STORED_CODEC and is_compressible(data):
+        compressed = frame_codec.compress(
+            data, frame_codec.default_level if level is None else level
+        )
+    if compressed is None or len(compressed) >= len(data):
+        frame_codec, compressed = get_codec(STORED_CODEC), bytes(data)
+    return FRAME_HEADER.pack(
+        frame_codec.frame_id, len(data), len(compressed)
+    ) + compressed
+
+
+def decode_frame(frame: bytes) -> bytes:
+    """Decompress one frame.
+
+    Args:
+        frame (bytes): frame header and compressed data
+
+    Raises:
+        FrameError: unknown codec or corrupt frame
+
+    Returns:
+        bytes: uncompressed data
+    """
+    codec, size, compressed_size = FRAME_HEADER.unpack_from(frame)
+    if codec not in FRAME_CODECS:
+        raise FrameError(f"Unknown codec {codec}.")
+    data = FRAME_CODECS[codec].decompress(
+        frame[FRAME_HEADER.size:FRAME_HEADER.size + compressed_size]
+    )
+    if len(data) != size:
+        raise FrameError("Frame is corrupt.")
+    return data
+
+
+def compress_frames(
+    bytesio_in: IO[bytes],
+    frame_table: List[Tuple[int, int]],
+    codec: str = DEFAULT_CODEC,
+    level: Optional[int] = None,
+    workers: int = 1,
+    on_frame: Optional[Callable[[bytes], None]] = None,
+    max_frames_in_flight: Optional[int] = None
+) -> Iterator[bytes]:
+    """Compress stream in independent frames.
+
+    Frames are compressed on a thread pool, the codecs release the GIL.
+
+    Args:
+        bytesio_in (IO[bytes]): readable uncompressed stream
+        frame_table (List[Tuple[int, int]]): receives uncompressed and
+            compressed offset of each frame
+        codec (str, optional): Codec name. Defaults to DEFAULT_CODEC.
+        level (Optional[int], optional): Compression level.
+            Defaults to the codec's default level.
+        workers (int, optional): Number of compressing threads.
+            Defaults to 1.
+        on_frame (Optional[Callable[[bytes], None]], optional): Called with
+            the uncompressed data of each frame, e.g. TarIndexer.feed.
+            Defaults to None.
+        max_frames_in_flight (Optional[int], optional): Maximum number of
+            frames being compressed. Defaults to two per worker.
+
+    Yields:
+        bytes: compressed frames
+    """
+    def read_frames() -> Iterator[bytes]:
+        while data := read_exact(bytesio_in, FRAME_SIZE):
+            if on_frame is not None:
+                on_frame(data)
+            yield data
+
+    offset = compressed_offset = 0
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for frame in parallel_map(
+            executor, partial(encode_frame, codec=codec, level=level),
+            read_frames(), max_frames_in_flight or 2*workers
+        ):
+            frame_table.append((offset, compressed_offset))
+            offset += FRAME_HEADER.unpack_from(frame)[1]
+            compressed_offset += len(frame)
+            yield frame
+
+
+def _read_frames(bytesio_in: IO[bytes]) -> Iterator[bytes]:
+    """Read compressed frames.
+
+    Args:
+        bytesio_in (IO[bytes]): readable compressed stream
+
+    Raises:
+        FrameError: stream is truncated
+
+    Yields:
+        bytes: frame header and compressed data
+    """
+    while header := read_exact(bytesio_in, FRAME_HEADER.size):
+        if len(header) != FRAME_HEADER.size:
+            raise FrameError("Compressed stream is truncated.")
+        size = FRAME_HEADER.unpack(header)[2]
+        data = read_exact(bytesio_in, size)
+        if len(data) != size:
+            raise FrameError("Compressed stream is truncated.")
+        yield header + data
+
+
+def decompress_frames(
+    bytesio_in: IO[bytes],
+    workers: int = 1,
+    max_frames_in_flight: Optional[int] = None
+) -> Iterator[bytes]:
+    """Decompress stream of frames.
+
+    Args:
+        bytesio_in (IO[bytes]): readable compressed stream
+        workers (int, optional): Number of decompressing threads.
+            Defaults to 1.
+        max_frames_in_flight (Optional[int], optional): Maximum number of
+            frames being decompressed. Defaults to two per worker.
+
+    Yields:
+        bytes: uncompressed data of each frame
+    """
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        yield from parallel_map(
+            executor, decode_frame, _read_frames(bytesio_in),
+            max_frames_in_flight or 2*workers
+        )
+
+
+def read_regions(
+    read_ranges: Callable[[Iterable[Tuple[int, int]]], Iterator[bytes]],
+    frame_table: List[Tuple[int, int]],
+    compressed_size: int,
+    regions: Iterable[Tuple[int, int]]
+) -> Iterator[bytes]:
+    """Decode regions of the uncompressed stream.
+
+    Only frames overlapping the regions are read and each of them once.
+
+    Args:
+        read_ranges (Callable[[Iterable[Tuple[int, int]]], Iterator[bytes]]):
+            reads (offset, size) ranges of the compressed stream in order,
+            e.g. SeekableDecryptor.read_ranges
+        frame_table (List[Tuple[int, int]]): uncompressed and compressed
+            offset of each frame
+        compressed_size (int): size of compressed stream
+        regions (Iterable[Tuple[int, int]]): sorted, non overlapping start
+            and end offsets in the uncompressed stream
+
+    Yields:
+        bytes: uncompressed data of regions in order
+    """
+    regions = list(regions)
+    offsets = [offset for offset, _ in frame_table]
+
+    def frame_of(offset: int) -> int:
+        return bisect_right(offsets, offset) - 1
+
+    needed = sorted({
+        frame
+        for start, end in regions
+        for frame in range(frame_of(start), frame_of(end - 1) + 1)
+    })
+    compressed_ends = [compressed for _, compressed in frame_table[1:]] + \
+        [compressed_size]
+    frames = zip(needed, read_ranges(
+        (
+            frame_table[frame][1],
+            compressed_ends[frame] - frame_table[frame][1]
+        )
+        for frame in needed
+    ))
+    current, data = -1, b""
+    for start, end in regions:
+        position = start
+        while position < end:
+            frame = frame_of(position)
+            while current != frame:
+                current, data = next(frames)
+                data = decode_frame(data)
+            chunk = data[
+                position - offsets[frame]:end - offsets[frame]
+            ]
+            if not chunk:
+                raise FrameError("Region exceeds compressed stream.")
+            position += len(chunk)
+            yield chunk
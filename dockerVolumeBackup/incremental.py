@@ -0,0 +1,337 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""File level incremental backups.
+
+A chain starts with a full backup. Each following backup packs only files
+that are new or changed since the previous one and records deleted files.
+The file manifest of the latest state and the chain are stored as an
+encrypted document next to the backups.
+"""
+
+import bz2
+import json
+import os
+import stat
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from hashlib import sha256
+from logging import getLogger
+from pathlib import Path
+from shutil import rmtree
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+from .compression import DEFAULT_CODEC
+from .documents import FILES_SUFFIX, download_document, upload_document
+from .frames import compress_frames, decompress_frames
+from .mycrypt import decrypt_stream, encrypt_stream
+from .storage import AWSBucket
+from .streams import IteratorReader
+from .tar import pack_files_stream, unpack_stream
+from .throttle import TokenBucket
+
+# name of the archive of each level, appended to the backup name
+LEVEL_SUFFIX = ".{:04d}"
+# fields of files recorded by scan_tree
+FILE_TYPE, FILE_SIZE, FILE_MTIME, FILE_INODE, FILE_DIGEST = range(5)
+HASH_BLOCK_SIZE = 2**20
+logger = getLogger(__file__)
+
+
+def _file_type(mode: int) -> str:
+    """Abbreviate file type.
+
+    Args:
+        mode (int): st_mode of file
+
+    Returns:
+        str: "d" directory, "f" regular file, "l" symlink or "o" other
+    """
+    if stat.S_ISDIR(mode):
+        return "d"
+    if stat.S_ISREG(mode):
+        return "f"
+    if stat.S_ISLNK(mode):
+        return "l"
+    return "o"
+
+
+def _walk(root: Path) -> Iterator[Tuple[str, os.stat_result]]:
+    """Walk directory tree without following symlinks.
+
+    Uses scandir, which avoids a stat call per entry to tell directories
+    apart.
+
+    Args:
+        root (Path): directory to walk
+
+    Yields:
+        Tuple[str, os.stat_result]: path relative to root and its lstat
+    """
+    stack = [""]
+    while stack:
+        relative = stack.pop()
+        with os.scandir(root/relative) as entries:
+            for entry in entries:
+                path = f"{relative}/{entry.name}" if relative else entry.name
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(path)
+                yield path, entry.stat(follow_symlinks=False)
+
+
+def _digest(path: Path) -> str:
+    """Hash file content.
+
+    Args:
+        path (Path): regular file
+
+    Returns:
+        str: sha256 hex digest
+    """
+    digest = sha256()
+    with open(path, "rb") as bytesio:
+        while data := bytesio.read(HASH_BLOCK_SIZE):
+            digest.update(data)
+    return digest.hexdigest()
+
+
+def scan_tree(
+    root: Path,
+    checksum: bool = False,
+    workers: int = 1
+) -> Dict[str, List[Any]]:
+    """Record type, size, mtime and inode of all files below root.
+
+    Args:
+        root (Path): directory to scan
+        checksum (bool, optional): Also hash the content of regular files.
+            Defaults to False.
+        workers (int, optional): Number of hashing threads. Defaults to 1.
+
+    Returns:
+        Dict[str, List[Any]]: fields of each path relative to root
+    """
+    files = {
+        path: [
+            _file_type(status.st_mode), status.st_size,
+            status.st_mtime_ns, status.st_ino, None
+        ]
+        for path, status in _walk(root)
+    }
+    if checksum:
+        regular = [
+            path for path, fields in files.items() if fields[FILE_TYPE] == "f"
+        ]
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for path, digest in zip(
+                regular, executor.map(lambda path: _digest(root/path), regular)
+            ):
+                files[path][FILE_DIGEST] = digest
+    return files
+
+
+def tree_size(files: Dict[str, List[Any]]) -> int:
+    """Sum sizes of the regular files of a manifest.
+
+    Hard links are counted once, like tar stores them.
+
+    Args:
+        files (Dict[str, List[Any]]): manifest from scan_tree
+
+    Returns:
+        int: size in bytes
+    """
+    return sum({
+        fields[FILE_INODE]: fields[FILE_SIZE]
+        for fields in files.values() if fields[FILE_TYPE] == "f"
+    }.values())
+
+
+def diff_trees(
+    previous: Dict[str, List[Any]],
+    current: Dict[str, List[Any]]
+) -> Tuple[List[str], List[str]]:
+    """Compare file manifests.
+
+    Content digests are only compared if both manifests contain them.
+
+    Args:
+        previous (Dict[str, List[Any]]): manifest of previous backup
+        current (Dict[str, List[Any]]): manifest of current state
+
+    Returns:
+        Tuple[List[str], List[str]]: sorted paths to pack and paths to
+            delete before unpacking. Files which changed their type are in
+            both lists.
+    """
+    changed = []
+    deleted = []
+    for path, fields in current.items():
+        old = previous.get(path)
+        if old is None:
+            changed.append(path)
+        elif old[FILE_TYPE] != fields[FILE_TYPE]:
+            changed.append(path)
+            deleted.append(path)
+        elif old[:FILE_DIGEST] != fields[:FILE_DIGEST] or (
+            None not in (old[FILE_DIGEST], fields[FILE_DIGEST])
+            and old[FILE_DIGEST] != fields[FILE_DIGEST]
+        ):
+            changed.append(path)
+    deleted.extend(path for path in previous if path not in current)
+    return sorted(changed), sorted(deleted)
+
+
+def apply_deletions(root: Path, deleted: List[str]) -> None:
+    """Delete paths below root, directories including their content.
+
+    Args:
+        root (Path): restored directory
+        deleted (List[str]): paths relative to root
+    """
+    for path in sorted(deleted, reverse=True):
+        path = root/path
+        if path.is_dir() and not path.is_symlink():
+            rmtree(path)
+        else:
+            path.unlink(missing_ok=True)
+
+
+def backup_incremental(
+    aws: AWSBucket,
+    root: Path,
+    name: str,
+    public_key: rsa.RSAPublicKey,
+    cache_path: Path,
+    checksum: bool = False,
+    workers: int = 1,
+    codec: str = DEFAULT_CODEC,
+    level: Optional[int] = None,
+    read_limit: Optional[TokenBucket] = None,
+    files: Optional[Dict[str, List[Any]]] = None,
+    max_blocks_in_flight: Optional[int] = None,
+    max_frames_in_flight: Optional[int] = None
+) -> str:
+    """Upload files changed since the previous backup of the chain.
+
+    The manifest is read from a local copy, so backups need no private
+    key. Starts a new chain with a full backup if there is no copy.
+
+    Args:
+        aws (AWSBucket): bucket connector
+        root (Path): directory to back up
+        name (str): name of chain in bucket
+        public_key (rsa.RSAPublicKey): public key to encrypt backups
+        cache_path (Path): local copy of the manifest
+        checksum (bool, optional): Detect changes by content hash too.
+            Defaults to False.
+        workers (int, optional): Number of compressing and encrypting
+            workers. Defaults to 1.
+        codec (str, optional): Codec name. Defaults to DEFAULT_CODEC.
+        level (Optional[int], optional): Compression level.
+            Defaults to the codec's default level.
+        read_limit (Optional[TokenBucket], optional): Rate limit of the
+            archive stream. Defaults to unlimited.
+        files (Optional[Dict[str, List[Any]]], optional): Manifest of root
+            from scan_tree, with digests if checksum is set. Defaults to
+            scanning root.
+        max_blocks_in_flight (Optional[int], optional): Maximum number of
+            blocks being encrypted. Defaults to BLOCKS_IN_FLIGHT_PER_WORKER
+            per worker.
+        max_frames_in_flight (Optional[int], optional): Maximum number of
+            frames being compressed. Defaults to two per worker.
+
+    Returns:
+        str: name of the uploaded increment in bucket
+    """
+    manifest: Dict[str, Any] = {"chain": [], "files": {}}
+    if cache_path.exists():
+        manifest = json.loads(bz2.decompress(cache_path.read_bytes()))
+    else:
+        logger.info("No manifest found, starting new chain.")
+
+    if files is None:
+        logger.info("Scanning files.")
+        files = scan_tree(root, checksum, workers)
+    changed, deleted = diff_trees(manifest["files"], files)
+    chain_level = len(manifest["chain"])
+    logger.info(
+        "Level %d: packing %d files, deleting %d files.",
+        chain_level, len(changed), len(deleted)
+    )
+
+    with pack_files_stream(
+        (root/path for path in changed), read_limit=read_limit
+    ) as archive:
+        aws.upload_stream(
+            IteratorReader(encrypt_stream(
+                IteratorReader(
+                    compress_frames(
+                        archive, [], codec, level, workers=workers,
+                        max_frames_in_flight=max_frames_in_flight
+                    )
+                ),
+                public_key, workers=workers,
+                max_blocks_in_flight=max_blocks_in_flight,
+                metadata={"compression": "framed"}
+            )),
+            name + LEVEL_SUFFIX.format(chain_level)
+        )
+    manifest["chain"].append({
+        "time": datetime.now(timezone.utc).isoformat(),
+        "packed": len(changed),
+        "deleted": deleted
+    })
+    manifest["files"] = files
+    upload_document(aws, name + FILES_SUFFIX, manifest, public_key)
+    # replace atomically, a torn copy would break the chain
+    partial_path = cache_path.with_name(cache_path.name + ".partial")
+    partial_path.write_bytes(bz2.compress(
+        json.dumps(manifest, separators=(",", ":")).encode()
+    ))
+    partial_path.replace(cache_path)
+    return name + LEVEL_SUFFIX.format(chain_level)
+
+
+def restore_incremental(
+    aws: AWSBucket,
+    root: Path,
+    name: str,
+    private_key: rsa.RSAPrivateKey,
+    level: Optional[int] = None,
+    workers: int = 1
+) -> None:
+    """Restore state of a chain by applying its backups in order.
+
+    Archives contain paths below root, so they are unpacked into the
+    working directory like full backups.
+
+    Args:
+        aws (AWSBucket): bucket connector
+        root (Path): restored directory
+        name (str): name of chain in bucket
+        private_key (rsa.RSAPrivateKey): Private key used for encryption.
+        level (Optional[int], optional): Restore state after this level.
+            Defaults to the latest.
+        workers (int, optional): Number of decrypting and decompressing
+            workers. Defaults to 1.
+    """
+    manifest = download_document(aws, name + FILES_SUFFIX, private_key)
+    chain = manifest["chain"][:None if level is None else level + 1]
+    for current, entry in enumerate(chain):
+        logger.info(
+            "Applying level %d of %d from %s.",
+            current, len(chain) - 1, entry["time"]
+        )
+        apply_deletions(root, entry["deleted"])
+        with unpack_stream() as archive:
+            for data in decompress_frames(
+                IteratorReader(decrypt_stream(
+                    private_key,
+                    aws.download_stream(name + LEVEL_SUFFIX.format(current)),
+                    workers=workers
+                )),
+                workers
+            ):
+                archive.write(data)
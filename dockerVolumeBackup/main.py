@@ -3,19 +3,65 @@
 """Backup and restore docker volumes."""
 # Created on Fri Jan 28 2022 by Merlin Mittelbach.
 
-from argparse import ArgumentParser
+import json
+import sys
+from argparse import ArgumentParser, ArgumentTypeError
+from io import BufferedReader
+from contextlib import nullcontext
 from getpass import getpass
+from importlib.util import find_spec
 from logging import DEBUG, INFO, Formatter, StreamHandler, getLogger
+from os import cpu_count
 from pathlib import Path
-from typing import Any, Dict
+from shutil import copyfileobj
+from typing import IO, Any, ContextManager, Dict, Iterable, List, Optional
 
+from botocore.exceptions import ClientError
+
+from .batch import log_summary, read_jobs, run_jobs
+from .benchmark import \
+    DATASETS, DEFAULT_DATASET_SIZE, STAGES, compare_reports, local_s3, \
+    run_benchmark, write_report
+from .budget import MemoryPlan, plan_memory
+from .catalog import Catalog
+from .compression import \
+    AUTO_CODEC, CODECS, DEFAULT_CODEC, DEFAULT_TARGET_THROUGHPUT, \
+    LEGACY_CODEC, read_sample, select_codec, tar_options
+from .dedup import \
+    ChunkIndex, ConcurrentRunError, backup_dedup, collect_garbage, \
+    restore_dedup
+from .documents import \
+    FILES_SUFFIX, INDEX_SUFFIX, MANIFEST_SUFFIX, SHARDS_SUFFIX, \
+    download_document, upload_document
+from .extract import open_extractor
+from .frames import \
+    FRAME_SIZE, compress_frames, decompress_frames, read_regions
+from .incremental import \
+    backup_incremental, restore_incremental, scan_tree, tree_size
+from .metrics import RunMetrics, Stage, apparent_size, run_report
 from .mycrypt import \
-    decrypt, encrypt, gen_certificate, load_public_key, prompt_private_key
-from .tar import pack_bzip2, unpack_bzip2
-from .storage import AWSBucket
+    BLOCK_SIZE, SeekableDecryptor, decrypt, encrypt, encrypt_stream, \
+    gen_certificate, load_public_key, open_decrypt_stream, \
+    prompt_private_key, read_header
+from .profiling import PROFILERS, Profiler
+from .rangecache import RangeCache
+from .resume import ResumeError, upload_resumable
+from .shards import backup_sharded, restore_sharded
+from .tar import \
+    MEMBER_END, MEMBER_OFFSET, TarIndexer, pack, pack_stream, \
+    select_members, unpack, unpack_stream
+from .storage import \
+    CHECKSUM_ALGORITHMS, CHECKSUM_MODES, MAX_POOL_CONNECTIONS, AWSBucket, \
+    load_transfer_settings
+from .streams import IteratorReader
+from .throttle import \
+    IONICE_CLASSES, TokenBucket, limit_cpu, lower_priority, rate_limit
+from .verify import log_results, verify_backup
 
 DATA_DIR = Path("/data/")
 CONFIG_DIR = Path("/config/")
+# writable state kept between runs, e.g. the chunk index
+CACHE_DIR = Path("/cache/")
 logger = getLogger(__file__)
 
 
@@ -54,46 +100,754 @@ def is_dir_empty(dirname: Path) -> bool:
         raise RuntimeError(f"{dirname} is not a directory.")
 
 
-def backup(bucket: str, name: str, **_: Dict[str, Any]) -> None:
-    """Pack and encrypt data in '/data/'. Then upload to AWS S3 storage.
+def open_chunk_index(bucket: str) -> ChunkIndex:
+    """Open chunk index of bucket in cache directory.
+
+    Args:
+        bucket (str): bucket name
+
+    Returns:
+        ChunkIndex: chunk index
+    """
+    CACHE_DIR.mkdir(exist_ok=True)
+    return ChunkIndex(CACHE_DIR/f"{bucket}.chunks.sqlite")
+
+
+def manifest_cache_path(bucket: str, name: str) -> Path:
+    """Local copy of the file manifest of an incremental chain.
+
+    Args:
+        bucket (str): bucket name
+        name (str): name of chain in bucket
+
+    Returns:
+        Path: path in cache directory
+    """
+    CACHE_DIR.mkdir(exist_ok=True)
+    return CACHE_DIR/f"{bucket}.{name.replace('/', '_')}.files"
+
+
+def checkpoint_cache_path(
+    bucket: str,
+    name: str,
+    suffix: str = ".upload"
+) -> Path:
+    """Checkpoint of a resumable transfer.
+
+    Args:
+        bucket (str): bucket name
+        name (str): name of file in bucket
+        suffix (str, optional): Kind of transfer. Defaults to ".upload".
+
+    Returns:
+        Path: path in cache directory
+    """
+    CACHE_DIR.mkdir(exist_ok=True)
+    return CACHE_DIR/f"{bucket}.{name.replace('/', '_')}{suffix}"
+
+
+def report_cache_path(bucket: str, name: str, operation: str) -> Path:
+    """Report of the last backup or restore of a file.
 
     Args:
-        cert (Path): path to certificate used for encryption.
         bucket (str): bucket name
+        name (str): name of file in bucket
+        operation (str): "backup" or "restore"
+
+    Returns:
+        Path: path in cache directory
     """
-    if is_dir_empty(DATA_DIR):
-        logger.error("No point in backing up an empty volume.")
+    CACHE_DIR.mkdir(exist_ok=True)
+    return CACHE_DIR/f"{bucket}.{name.replace('/', '_')}.{operation}.json"
+
+
+def open_catalog(bucket: str) -> Catalog:
+    """Open catalog of bucket in cache directory.
+
+    Args:
+        bucket (str): bucket name
+
+    Returns:
+        Catalog: catalog
+    """
+    CACHE_DIR.mkdir(exist_ok=True)
+    return Catalog(CACHE_DIR/f"{bucket}.catalog.sqlite")
+
+
+def update_catalog(aws: AWSBucket, bucket: str, names: List[str]) -> None:
+    """Record uploaded files in the catalog.
+
+    Backups may run with credentials which cannot read the bucket, so
+    failures are only logged.
+
+    Args:
+        aws (AWSBucket): bucket connector
+        bucket (str): bucket name
+        names (List[str]): names of uploaded files
+    """
+    try:
+        open_catalog(bucket).update(aws, names)
+    except ClientError as error:
+        logger.warning("Could not update catalog: %s", error)
+
+
+def connect(
+    bucket: str,
+    options: Dict[str, Any],
+    transfers: int = 1
+) -> AWSBucket:
+    """Connect to bucket, lowering the priority of the process if set.
+
+    Args:
+        bucket (str): bucket name
+        options (Dict[str, Any]): transfer settings from the CLI, which
+            override environment and config file
+        transfers (int, optional): Number of concurrent transfers sharing
+            the connection pool. Defaults to 1.
+
+    Returns:
+        AWSBucket: bucket connector
+    """
+    settings = load_transfer_settings(CONFIG_DIR/"transfer.ini", options)
+    if transfers > 1:
+        settings = settings._replace(
+            max_pool_connections=settings.max_pool_connections or max(
+                settings.max_concurrency*transfers, MAX_POOL_CONNECTIONS
+            )
+        )
+    lower_priority(settings.nice, settings.ionice, settings.throttle_hours)
+    aws = AWSBucket(bucket, settings)
+    if settings.cache_size is not None:
+        aws.cache = RangeCache(CACHE_DIR/"ranges", settings.cache_size)
+    return aws
+
+
+def log_cache(aws: AWSBucket) -> None:
+    """Log bytes read from the range cache, if there is one.
+
+    Args:
+        aws (AWSBucket): bucket connector
+    """
+    if aws.cache is not None:
+        logger.info(
+            "Range cache: %.1f MiB read from cache, %.1f MiB from S3.",
+            aws.cache.hits / 2**20, aws.cache.misses / 2**20
+        )
+
+
+def plan_pipeline(
+    aws: AWSBucket,
+    metrics: RunMetrics,
+    workers: int,
+    upload: bool = True,
+    framed: bool = False,
+    pipelines: int = 1,
+    stream_size: Optional[int] = None
+) -> Optional[MemoryPlan]:
+    """Fit the buffers of a backup or restore into max_memory.
+
+    The transfer settings of the connector are replaced by the fitted ones.
+
+    Args:
+        aws (AWSBucket): bucket connector
+        metrics (RunMetrics): run to report the plan in
+        workers (int): number of encryption processes
+        upload (bool, optional): Plan a backup, else a restore.
+            Defaults to True.
+        framed (bool, optional): Plan compressed frames as well.
+            Defaults to False.
+        pipelines (int, optional): Number of concurrent pipelines, e.g.
+            shards. Defaults to 1.
+        stream_size (Optional[int], optional): Expected size of the
+            uploaded stream of each pipeline. Defaults to unknown.
+
+    Returns:
+        Optional[MemoryPlan]: plan, None if max_memory is too small
+    """
+    try:
+        plan = plan_memory(
+            aws.settings, BLOCK_SIZE, workers, upload, framed, pipelines,
+            stream_size
+        )
+    except ValueError as error:
+        logger.error("%s", error)
+        metrics.success = False
+        return None
+    aws.settings = plan.settings
+    metrics.memory = plan.report()
+    if aws.settings.max_memory is not None:
+        logger.info(
+            "Buffers of %.0f MiB planned: %d blocks, %d frames and %d "
+            "requests of %.0f MiB in flight.",
+            plan.size / 2**20, plan.blocks_in_flight, plan.frames_in_flight,
+            plan.settings.max_concurrency, plan.settings.part_size / 2**20
+            if upload else plan.settings.range_size / 2**20
+        )
+    return plan
+
+
+def _upload_encrypted(
+    aws: AWSBucket,
+    bytesio: IO[bytes],
+    name: str,
+    public_key: Any,
+    workers: int,
+    metadata: Dict[str, Any],
+    checkpoint_path: Optional[Path],
+    max_blocks_in_flight: int
+) -> None:
+    """Encrypt and upload plain text stream.
+
+    Args:
+        aws (AWSBucket): bucket connector
+        bytesio (IO[bytes]): readable plain text stream
+        name (str): name of file in bucket
+        public_key (Any): public key to encrypt symmetric key
+        workers (int): number of encryption processes
+        metadata (Dict[str, Any]): container metadata
+        checkpoint_path (Optional[Path]): checkpoint of a resumable upload,
+            None for a plain stream upload
+        max_blocks_in_flight (int): maximum number of blocks being
+            encrypted
+    """
+    if checkpoint_path is None:
+        aws.upload_stream(
+            IteratorReader(encrypt_stream(
+                bytesio, public_key, workers=workers,
+                max_blocks_in_flight=max_blocks_in_flight, metadata=metadata
+            )),
+            name
+        )
     else:
+        upload_resumable(
+            aws, bytesio, name, public_key, checkpoint_path, workers,
+            metadata, max_blocks_in_flight
+        )
+
+
+def _backup_stream(
+    aws: AWSBucket,
+    name: str,
+    public_key: Any,
+    framed: bool,
+    workers: int,
+    codec: str,
+    compression_level: Optional[int],
+    checkpoint_path: Optional[Path],
+    stage: Stage,
+    plan: MemoryPlan,
+    threads: Optional[int] = None,
+    read_limit: Optional[TokenBucket] = None
+) -> None:
+    """Pack, encrypt and upload data in '/data/' without temporary files.
+
+    Args:
+        aws (AWSBucket): bucket connector
+        name (str): name of file in bucket
+        public_key (Any): public key to encrypt symmetric key
+        framed (bool): compress in frames and upload a member index
+        workers (int): number of encryption processes
+        codec (str): compression codec
+        compression_level (Optional[int]): compression level
+        checkpoint_path (Optional[Path]): checkpoint of a resumable upload,
+            None for a plain stream upload
+        stage (Stage): counts the archive before and after compression
+        plan (MemoryPlan): buffer windows of the pipeline
+        threads (Optional[int], optional): Number of compressor threads.
+            Defaults to all cores.
+        read_limit (Optional[TokenBucket], optional): Rate limit of the
+            archive stream. Defaults to unlimited.
+    """
+    if framed:
+        frame_table: List = []
+        indexer = TarIndexer()
+        with pack_stream(DATA_DIR, read_limit=read_limit) as archive:
+            _upload_encrypted(
+                aws,
+                stage.count(IteratorReader(compress_frames(
+                    stage.count(archive, progress=True), frame_table,
+                    codec, compression_level, workers=workers,
+                    on_frame=indexer.feed,
+                    max_frames_in_flight=plan.frames_in_flight
+                )), output=True),
+                name, public_key, workers, {"compression": "framed"},
+                checkpoint_path, plan.blocks_in_flight
+            )
+
+        logger.info("Uploading member index.")
+        upload_document(
+            aws, name + INDEX_SUFFIX,
+            {
+                "frame_size": FRAME_SIZE,
+                "frames": frame_table,
+                "members": indexer.close()
+            },
+            public_key
+        )
+    else:
+        # tar compresses, so only the compressed archive passes through
+        with pack_stream(
+            DATA_DIR, tar_options(codec, compression_level, threads=threads),
+            read_limit
+        ) as archive:
+            _upload_encrypted(
+                aws, stage.count(archive, output=True, progress=True), name,
+                public_key, workers, {"compression": codec}, checkpoint_path,
+                plan.blocks_in_flight
+            )
+
+
+def backup(
+    bucket: str,
+    name: str,
+    stream: bool = False,
+    workers: int = 1,
+    framed: bool = False,
+    dedup: bool = False,
+    incremental: bool = False,
+    checksum: bool = False,
+    codec: str = DEFAULT_CODEC,
+    compression_level: Optional[int] = None,
+    target_throughput: float = DEFAULT_TARGET_THROUGHPUT,
+    resume: bool = False,
+    shards: Optional[int] = None,
+    report: Optional[str] = None,
+    prometheus: Optional[str] = None,
+    profiler: Optional[Profiler] = None,
+    **options: Dict[str, Any]
+) -> None:
+    """Pack and encrypt data in '/data/'. Then upload to AWS S3 storage.
+
+    Args:
+        bucket (str): bucket name
+        name (str): name of file in bucket
+        stream (bool, optional): Pipe packing, encryption and upload
+            without temporary files. Defaults to False.
+        workers (int, optional): Number of encryption processes.
+            Defaults to 1.
+        framed (bool, optional): Compress in independent frames and upload
+            a member index, which allows restoring single files. Implies
+            stream. Defaults to False.
+        dedup (bool, optional): Upload only chunks not yet stored in the
+            bucket and a manifest. Defaults to False.
+        incremental (bool, optional): Upload only files changed since the
+            previous incremental backup. Defaults to False.
+        checksum (bool, optional): Detect changed files by content hash
+            too. Defaults to False.
+        codec (str, optional): Compression codec or "auto".
+            Defaults to DEFAULT_CODEC.
+        compression_level (Optional[int], optional): Compression level.
+            Defaults to the codec's default level.
+        target_throughput (float, optional): Minimum throughput in MB/s of
+            the codec selected by "auto". Defaults to
+            DEFAULT_TARGET_THROUGHPUT.
+        resume (bool, optional): Keep a checkpoint in the cache directory
+            and continue the upload of an interrupted run from it. Implies
+            stream. Defaults to False.
+        shards (Optional[int], optional): Split the data into this many
+            archives of similar size, which are packed, encrypted and
+            uploaded in parallel. Defaults to None for a single archive.
+        report (Optional[str], optional): JSON report file. Defaults to a
+            file per backup in the cache directory.
+        prometheus (Optional[str], optional): Prometheus text file of the
+            report. Defaults to None.
+        profiler (Optional[Profiler], optional): Running profiler, whose
+            profiles are written next to the report. Defaults to None.
+        options (Dict[str, Any]): transfer settings
+    """
+    with run_report(
+        "backup",
+        Path(report) if report else report_cache_path(bucket, name, "backup"),
+        Path(prometheus) if prometheus else None, profiler,
+        bucket=bucket, name=name
+    ) as metrics:
+        if sum(map(bool, (incremental, dedup, shards, framed or resume))) \
+                > 1 or checksum and not incremental:
+            logger.error(
+                "--incremental, --dedup, --shards and --framed or --resume "
+                "exclude each other, --checksum requires --incremental."
+            )
+            metrics.success = False
+            return
+        if is_dir_empty(DATA_DIR):
+            logger.error("No point in backing up an empty volume.")
+            metrics.success = False
+            return
         logger.info("Initialize AWS.")
-        aws = AWSBucket(bucket)
+        aws = connect(bucket, options, shards or 1)
+        settings = aws.settings
+        workers, threads = limit_cpu(
+            workers, settings.cpu_limit, settings.throttle_hours
+        )
+        read_limit = rate_limit(settings.read_limit, settings.throttle_hours)
+
+        # dedup uploads small chunks, so only parts need the size
+        data_size = files = None
+        if incremental or shards:
+            logger.info("Scanning files.")
+            with metrics.stage("scan") as stage:
+                files = scan_tree(DATA_DIR, incremental and checksum, workers)
+                stage.bytes_in = stage.bytes_out = tree_size(files)
+            data_size = stage.bytes_in
+        elif not dedup:
+            logger.info("Scanning data.")
+            with metrics.stage("scan") as stage:
+                stage.bytes_in = stage.bytes_out = apparent_size(DATA_DIR)
+            data_size = stage.bytes_in
+
+        # parts must fit the largest stream, incremental backups compress
+        # frames and dedup chunks are at most a frame each
+        plan = plan_pipeline(
+            aws, metrics, workers,
+            framed=(framed or incremental or dedup) and not shards,
+            pipelines=shards or 1,
+            stream_size=None if data_size is None
+            else -(-data_size // (shards or 1))
+        )
+        if plan is None:
+            return
 
         logger.info("Loading certificate.")
         with open(CONFIG_DIR/"cert.pem", "rb") as bytesio:
             public_key = load_public_key(bytesio)
 
-        logger.info("Packing data.")
-        pack_bzip2(DATA_DIR, Path("/tmp/backup.tar.bzip2"))
+        if codec == AUTO_CODEC:
+            logger.info("Selecting codec.")
+            with metrics.stage("select_codec"):
+                codec = select_codec(
+                    read_sample(DATA_DIR), target_throughput*1e6, workers
+                )
+
+        uploaded = [name]
+        if incremental:
+            with metrics.stage("incremental") as stage:
+                stage.bytes_in = data_size
+                uploaded = [
+                    name + FILES_SUFFIX,
+                    backup_incremental(
+                        aws, DATA_DIR, name, public_key,
+                        manifest_cache_path(bucket, name), checksum,
+                        workers, codec, compression_level, read_limit, files,
+                        plan.blocks_in_flight, plan.frames_in_flight
+                    )
+                ]
+        elif dedup:
+            logger.info("Packing, deduplicating and uploading data.")
+            with metrics.stage("dedup"):
+                try:
+                    backup_dedup(
+                        aws, DATA_DIR, name, public_key,
+                        open_chunk_index(bucket), workers, codec,
+                        compression_level, read_limit, plan.frames_in_flight
+                    )
+                except ConcurrentRunError as error:
+                    logger.error("%s", error)
+                    metrics.success = False
+                    return
+            uploaded = [name + MANIFEST_SUFFIX]
+        elif shards:
+            logger.info("Packing, encrypting and uploading %d shards.", shards)
+            with metrics.stage("pack_encrypt_upload", progress=True) as stage:
+                stage.bytes_in = data_size
+                uploaded = backup_sharded(
+                    aws, DATA_DIR, name, public_key, shards, workers, codec,
+                    compression_level, plan.blocks_in_flight,
+                    lambda archive: stage.count(
+                        archive, output=True, progress=True
+                    ),
+                    threads, read_limit, files
+                )
+        elif framed or stream or resume:
+            logger.info("Packing, encrypting and uploading data.")
+            checkpoint_path = checkpoint_cache_path(bucket, name) \
+                if resume else None
+            with metrics.stage(
+                "pack_encrypt_upload", data_size, progress=True
+            ) as stage:
+                stage.bytes_in = data_size
+                try:
+                    _backup_stream(
+                        aws, name, public_key, framed, workers, codec,
+                        compression_level, checkpoint_path, stage, plan,
+                        threads, read_limit
+                    )
+                except ResumeError as error:
+                    logger.warning("%s Starting over.", error)
+                    stage.bytes_in, stage.bytes_out = data_size, None
+                    _backup_stream(
+                        aws, name, public_key, framed, workers, codec,
+                        compression_level, checkpoint_path, stage, plan,
+                        threads, read_limit
+                    )
+                if aws.buffers is not None:
+                    stage.buffered = aws.buffers.peak
+            if framed:
+                uploaded.append(name + INDEX_SUFFIX)
+        else:
+            archive_path = Path("/tmp/backup.tar.bzip2")
+            crypt_path = Path("/tmp/backup.tar.bzip2.crypt")
+            logger.info("Packing data.")
+            with metrics.stage("pack") as stage:
+                pack(
+                    DATA_DIR, archive_path,
+                    tar_options(codec, compression_level, threads=threads)
+                )
+                stage.bytes_in = data_size
+                stage.bytes_out = archive_path.stat().st_size
 
-        logger.info("Encrypting data.")
-        encrypt(Path("/tmp/backup.tar.bzip2"), public_key)
+            logger.info("Encrypting data.")
+            with metrics.stage("encrypt") as stage:
+                encrypt(
+                    archive_path, public_key, workers=workers,
+                    metadata={"compression": codec},
+                    max_blocks_in_flight=plan.blocks_in_flight
+                )
+                stage.bytes_in = archive_path.stat().st_size
+                stage.bytes_out = crypt_path.stat().st_size
 
-        logger.info("Uploading data.")
-        aws.upload(Path("/tmp/backup.tar.bzip2.crypt"), name)
+            logger.info("Uploading data.")
+            with metrics.stage("upload") as stage:
+                aws.upload(crypt_path, name)
+                stage.bytes_in = stage.bytes_out = crypt_path.stat().st_size
 
+        update_catalog(aws, bucket, uploaded)
         logger.info("Sank you for travelling wis Deutsche Bahn.")
 
 
-def restore(bucket: str, name: str, **_: Dict[str, Any]) -> None:
+def backup_many(
+    bucket: str,
+    jobs: str,
+    pack_slots: int = 1,
+    encrypt_slots: int = 1,
+    upload_slots: int = 1,
+    workers: int = 1,
+    codec: str = DEFAULT_CODEC,
+    compression_level: Optional[int] = None,
+    target_throughput: float = DEFAULT_TARGET_THROUGHPUT,
+    **options: Dict[str, Any]
+) -> None:
+    """Back up directories of a job list. Exit with status 1 if any failed.
+
+    Args:
+        bucket (str): bucket name
+        jobs (str): path of job list, '-' for stdin
+        pack_slots (int, optional): Number of concurrent tar processes.
+            Defaults to 1.
+        encrypt_slots (int, optional): Number of concurrent encryptions.
+            Defaults to 1.
+        upload_slots (int, optional): Number of concurrent uploads.
+            Defaults to 1.
+        workers (int, optional): Number of encryption processes.
+            Defaults to 1.
+        codec (str, optional): Compression codec or "auto".
+            Defaults to DEFAULT_CODEC.
+        compression_level (Optional[int], optional): Compression level.
+            Defaults to the codec's default level.
+        target_throughput (float, optional): Minimum throughput in MB/s of
+            the codec selected by "auto". Defaults to
+            DEFAULT_TARGET_THROUGHPUT.
+        options (Dict[str, Any]): transfer settings
+    """
+    if jobs == "-":
+        job_list = read_jobs(sys.stdin)
+    else:
+        with open(jobs, encoding="utf-8") as textio:
+            job_list = read_jobs(textio)
+
+    logger.info("Initialize AWS.")
+    # uploads run concurrently on one connection pool
+    aws = connect(bucket, options, upload_slots)
+    workers, threads = limit_cpu(
+        workers, aws.settings.cpu_limit, aws.settings.throttle_hours
+    )
+
+    logger.info("Loading certificate.")
+    with open(CONFIG_DIR/"cert.pem", "rb") as bytesio:
+        public_key = load_public_key(bytesio)
+
+    results = run_jobs(
+        aws, job_list, public_key, Path("/tmp/backup-many"),
+        pack_slots, encrypt_slots, upload_slots, workers,
+        codec, compression_level, target_throughput, threads
+    )
+    log_summary(results)
+    update_catalog(
+        aws, bucket,
+        [result.job.name for result in results if result.error is None]
+    )
+    if any(result.error is not None for result in results):
+        sys.exit(1)
+
+
+def _unpack(
+    metadata: Dict[str, Any],
+    bytesio: IO[bytes],
+    workers: int,
+    max_frames_in_flight: Optional[int] = None,
+    writers: int = 1,
+    sync: bool = False,
+    delete: bool = False
+) -> None:
+    """Unpack decrypted backup into working directory.
+
+    Args:
+        metadata (Dict[str, Any]): container metadata
+        bytesio (IO[bytes]): readable decrypted backup
+        workers (int): number of decompressing threads
+        max_frames_in_flight (Optional[int], optional): Maximum number of
+            frames being decompressed. Defaults to two per worker.
+        writers (int, optional): Number of threads writing files, 1 to
+            unpack with tar. Defaults to 1.
+        sync (bool, optional): Write only files which differ from the
+            volume. Defaults to False.
+        delete (bool, optional): With sync, delete files of the volume
+            missing from the backup. Defaults to False.
+    """
+    options = {"sync": sync, "delete": DATA_DIR if delete else None}
+    if metadata.get("compression") == "framed":
+        with open_extractor("none", writers, **options) as archive:
+            for data in decompress_frames(
+                bytesio, workers, max_frames_in_flight
+            ):
+                archive.write(data)
+    else:
+        with open_extractor(
+            metadata.get("compression", LEGACY_CODEC), writers, **options
+        ) as archive:
+            copyfileobj(bytesio, archive)
+
+
+def _restore_paths(
+    aws: AWSBucket,
+    name: str,
+    private_key: Any,
+    paths: List[str],
+    workers: int
+) -> None:
+    """Restore members matching paths into working directory.
+
+    Fetches only the frames containing selected members using ranged GETs.
+
+    Args:
+        aws (AWSBucket): bucket connector
+        name (str): name of file in bucket
+        private_key (Any): Private key used for encryption.
+        paths (List[str]): glob patterns relative to '/data/'
+        workers (int): number of concurrent range requests
+    """
+    logger.info("Downloading member index.")
+    index = download_document(aws, name + INDEX_SUFFIX, private_key)
+    members = select_members(index["members"], paths, DATA_DIR)
+    logger.info("Restoring %d members.", len(members))
+
+    # merge adjacent members to few large regions
+    regions: List[List[int]] = []
+    for member in members:
+        if regions and member[MEMBER_OFFSET] <= regions[-1][1]:
+            regions[-1][1] = max(regions[-1][1], member[MEMBER_END])
+        else:
+            regions.append([member[MEMBER_OFFSET], member[MEMBER_END]])
+
+    decryptor = SeekableDecryptor(private_key, *aws.range_reader(name))
+    with unpack_stream() as archive:
+        for data in read_regions(
+            lambda ranges: decryptor.read_ranges(ranges, workers),
+            index["frames"], decryptor.size, regions
+        ):
+            archive.write(data)
+        # end of archive marker
+        archive.write(bytes(1024))
+
+
+def restore(
+    bucket: str,
+    name: str,
+    stream: bool = False,
+    workers: int = 1,
+    path: Optional[List[str]] = None,
+    dedup: bool = False,
+    incremental: bool = False,
+    level: Optional[int] = None,
+    resume: bool = False,
+    sharded: bool = False,
+    writers: int = 1,
+    sync: bool = False,
+    delete: bool = False,
+    report: Optional[str] = None,
+    prometheus: Optional[str] = None,
+    profiler: Optional[Profiler] = None,
+    **options: Dict[str, Any]
+) -> None:
     """Download backup, decrypt and unpack.
 
     Args:
-        cert (Path): path to certificate used for encryption.
         bucket (str): bucket name
         name (str): name of file in bucket
+        stream (bool, optional): Pipe download, decryption and unpacking
+            without temporary files. Defaults to False.
+        workers (int, optional): Number of decryption processes.
+            Defaults to 1.
+        path (Optional[List[str]], optional): Restore only files matching
+            these glob patterns from a framed backup. The volume need not
+            be empty. Defaults to None.
+        dedup (bool, optional): Restore deduplicated backup.
+            Defaults to False.
+        incremental (bool, optional): Restore chain of incremental
+            backups. Defaults to False.
+        level (Optional[int], optional): Restore state after this backup
+            of the chain. Defaults to the latest.
+        resume (bool, optional): Download into the cache directory and
+            fetch only ranges missing after an interrupted run. Ignores
+            stream. Defaults to False.
+        sharded (bool, optional): Restore sharded backup, all shards in
+            parallel. Defaults to False.
+        writers (int, optional): Number of threads writing restored
+            files, 1 to unpack with tar. Helps with many small files.
+            Defaults to 1.
+        sync (bool, optional): Restore into a non-empty volume, writing
+            only files which differ from the backup. Defaults to False.
+        delete (bool, optional): With sync, delete files missing from the
+            backup. Defaults to False.
+        report (Optional[str], optional): JSON report file. Defaults to a
+            file per backup in the cache directory.
+        prometheus (Optional[str], optional): Prometheus text file of the
+            report. Defaults to None.
+        profiler (Optional[Profiler], optional): Running profiler, whose
+            profiles are written next to the report. Defaults to None.
+        options (Dict[str, Any]): transfer settings
     """
-    if is_dir_empty(DATA_DIR):
+    with run_report(
+        "restore",
+        Path(report) if report
+        else report_cache_path(bucket, name, "restore"),
+        Path(prometheus) if prometheus else None, profiler,
+        bucket=bucket, name=name
+    ) as metrics:
+        if sync and (path or incremental or dedup or sharded) or \
+                delete and not sync:
+            logger.error(
+                "--sync only restores full backups, --delete requires --sync."
+            )
+            metrics.success = False
+            return
+        if not path and not sync and not is_dir_empty(DATA_DIR):
+            logger.error("Volume must be empty, or add --sync.")
+            metrics.success = False
+            return
         logger.info("Initialize AWS.")
-        aws = AWSBucket(bucket)
+        aws = connect(bucket, options)
+        workers, _ = limit_cpu(
+            workers, aws.settings.cpu_limit, aws.settings.throttle_hours
+        )
+        # compression is only known after reading the header, shards are
+        # planned after reading their manifest
+        plan: Optional[MemoryPlan] = None
+        if not sharded:
+            plan = plan_pipeline(
+                aws, metrics, workers, upload=False, framed=True
+            )
+            if plan is None:
+                return
 
         logger.info("Loading certificate.")
         with open(CONFIG_DIR/"cert.pem", "rb") as bytesio:
@@ -101,22 +855,378 @@ def restore(bucket: str, name: str, **_: Dict[str, Any]) -> None:
         private_key = prompt_private_key(CONFIG_DIR/"key.pem")
         if private_key is None:
             logger.error("Could not load private key.")
+            metrics.success = False
         elif private_key.public_key().public_numbers() != \
                 public_key.public_numbers():
             logger.error(
                 "Private key does not belong to public key."
             )
+            metrics.success = False
+        elif path:
+            with metrics.stage("restore_paths"):
+                _restore_paths(aws, name, private_key, path, workers)
+        elif incremental:
+            with metrics.stage("incremental"):
+                restore_incremental(
+                    aws, DATA_DIR, name, private_key, level, workers
+                )
+        elif dedup:
+            logger.info("Downloading and unpacking chunks.")
+            with metrics.stage("dedup"):
+                restore_dedup(aws, name, private_key, workers)
+        elif sharded:
+            manifest = download_document(
+                aws, name + SHARDS_SUFFIX, private_key
+            )
+            plan = plan_pipeline(
+                aws, metrics, workers, upload=False,
+                pipelines=len(manifest["shards"])
+            )
+            if plan is None:
+                return
+            logger.info("Downloading, decrypting and unpacking shards.")
+            with metrics.stage(
+                "download_decrypt_unpack", progress=True
+            ) as stage:
+                restore_sharded(
+                    aws, manifest, private_key, workers,
+                    plan.blocks_in_flight,
+                    lambda bytesio: stage.count(bytesio, progress=True),
+                    writers
+                )
+                stage.bytes_out = sum(
+                    shard["size"] for shard in manifest["shards"]
+                )
+        elif stream and not resume:
+            logger.info("Downloading, decrypting and unpacking backup.")
+            size = (aws.stat(name) or {}).get("Size")
+            with metrics.stage(
+                "download_decrypt_unpack", size, progress=True
+            ) as stage:
+                metadata, blocks = open_decrypt_stream(
+                    private_key,
+                    stage.count(aws.download_stream(name), progress=True),
+                    workers=workers,
+                    max_blocks_in_flight=plan.blocks_in_flight
+                )
+                _unpack(
+                    metadata,
+                    stage.count(
+                        BufferedReader(IteratorReader(blocks)), output=True
+                    ),
+                    workers, plan.frames_in_flight, writers, sync, delete
+                )
         else:
             logger.info("Downloading backup.")
-            aws.download(name, Path("/tmp/backup.tar.bzip2.crypt"))
+            archive_path = Path("/tmp/backup.tar.bzip2")
+            crypt_path = Path("/tmp/backup.tar.bzip2.crypt")
+            with metrics.stage("download") as stage:
+                if resume:
+                    journal_path = checkpoint_cache_path(
+                        bucket, name, ".download"
+                    )
+                    crypt_path = journal_path.with_suffix(".crypt")
+                    aws.download_resumable(name, crypt_path, journal_path)
+                else:
+                    aws.download(name, crypt_path)
+                stage.bytes_in = stage.bytes_out = crypt_path.stat().st_size
+            with open(crypt_path, "rb") as bytesio:
+                metadata = read_header(bytesio)[1]
 
             logger.info("Decrypting backup.")
-            decrypt(private_key, Path("/tmp/backup.tar.bzip2.crypt"))
+            with metrics.stage("decrypt") as stage:
+                decrypt(
+                    private_key, crypt_path, archive_path, workers=workers,
+                    max_blocks_in_flight=plan.blocks_in_flight
+                )
+                stage.bytes_in = crypt_path.stat().st_size
+                stage.bytes_out = archive_path.stat().st_size
+            if resume:
+                crypt_path.unlink()
 
             logger.info("Unpacking backup.")
-            unpack_bzip2(Path("/tmp/backup.tar.bzip2"))
+            with metrics.stage("unpack") as stage:
+                stage.bytes_in = archive_path.stat().st_size
+                if metadata.get("compression") == "framed" or \
+                        writers > 1 or sync:
+                    with open(archive_path, "rb") as bytesio:
+                        _unpack(
+                            metadata, bytesio, workers,
+                            plan.frames_in_flight, writers, sync, delete
+                        )
+                else:
+                    unpack(archive_path, tar_options(
+                        metadata.get("compression", LEGACY_CODEC),
+                        decompress=True
+                    ))
+        log_cache(aws)
+
+
+def _synced_catalog(
+    bucket: str,
+    sync: bool,
+    options: Dict[str, Any]
+) -> Catalog:
+    """Open catalog, syncing it if requested or never synced.
+
+    Args:
+        bucket (str): bucket name
+        sync (bool): sync with a bucket listing
+        options (Dict[str, Any]): transfer settings
+
+    Returns:
+        Catalog: catalog
+    """
+    catalog = open_catalog(bucket)
+    if sync or not catalog.is_synced():
+        logger.info("Syncing catalog.")
+        catalog.sync(connect(bucket, options))
+    return catalog
+
+
+def list_backups(
+    bucket: str,
+    sync: bool = False,
+    **options: Dict[str, Any]
+) -> None:
+    """Print backups in bucket from the local catalog.
+
+    Args:
+        bucket (str): bucket name
+        sync (bool, optional): Sync catalog with the bucket first.
+            Defaults to False.
+        options (Dict[str, Any]): transfer settings
+    """
+    for backup_info in _synced_catalog(bucket, sync, options).backups():
+        print(
+            f"{backup_info.modified[:19]}  {backup_info.kind:11}  "
+            f"{backup_info.codec or '-':6}  "
+            f"{backup_info.size / 2**20:10.1f} MiB  {backup_info.name}"
+        )
+
+
+def info(
+    bucket: str,
+    name: str,
+    sync: bool = False,
+    **options: Dict[str, Any]
+) -> None:
+    """Print details of a backup from the local catalog.
+
+    Args:
+        bucket (str): bucket name
+        name (str): name of backup in bucket
+        sync (bool, optional): Sync catalog with the bucket first.
+            Defaults to False.
+        options (Dict[str, Any]): transfer settings
+    """
+    backup_info = _synced_catalog(bucket, sync, options).info(name)
+    if backup_info is None:
+        logger.error("Unknown backup %s, try --sync.", name)
+        return
+    print(f"name:     {backup_info.name}")
+    print(f"kind:     {backup_info.kind}")
+    print(f"codec:    {backup_info.codec or '-'}")
+    print(f"size:     {backup_info.size} bytes")
+    print(f"modified: {backup_info.modified}")
+    print("files:")
+    for file_name, size in backup_info.files:
+        print(f"  {size:>14}  {file_name}")
+
+
+def gc(
+    bucket: str,
+    dry_run: bool = False,
+    **options: Dict[str, Any]
+) -> None:
+    """Delete chunks no deduplicated backup references.
+
+    Args:
+        bucket (str): bucket name
+        dry_run (bool, optional): Only report unreferenced chunks.
+            Defaults to False.
+        options (Dict[str, Any]): transfer settings
+    """
+    logger.info("Initialize AWS.")
+    aws = connect(bucket, options)
+    private_key = prompt_private_key(CONFIG_DIR/"key.pem")
+    if private_key is None:
+        logger.error("Could not load private key.")
     else:
-        logger.error("Volume must be empty.")
+        try:
+            collect_garbage(
+                aws, private_key, open_chunk_index(bucket), dry_run
+            )
+        except ConcurrentRunError as error:
+            logger.error("%s", error)
+
+
+def verify(
+    bucket: str,
+    names: Optional[List[str]] = None,
+    fast: bool = False,
+    unpack: bool = False,
+    workers: int = 1,
+    sync: bool = False,
+    report: Optional[str] = None,
+    prometheus: Optional[str] = None,
+    profiler: Optional[Profiler] = None,
+    **options: Dict[str, Any]
+) -> None:
+    """Check backups without restoring them. Exit with status 1 on damage.
+
+    Args:
+        bucket (str): bucket name
+        names (Optional[List[str]], optional): Names of backups in bucket.
+            Defaults to all backups of the catalog.
+        fast (bool, optional): Check only S3 checksums, block indexes,
+            first and last blocks and manifests. Defaults to False.
+        unpack (bool, optional): Also decompress and parse archives.
+            Defaults to False.
+        workers (int, optional): Number of decryption processes.
+            Defaults to 1.
+        sync (bool, optional): Sync catalog with the bucket first.
+            Defaults to False.
+        report (Optional[str], optional): JSON report file. Defaults to a
+            file in the cache directory.
+        prometheus (Optional[str], optional): Prometheus text file of the
+            report. Defaults to None.
+        profiler (Optional[Profiler], optional): Running profiler, whose
+            profiles are written next to the report. Defaults to None.
+        options (Dict[str, Any]): transfer settings
+    """
+    catalog = _synced_catalog(bucket, sync, options)
+    if names:
+        backups = [catalog.info(name) for name in names]
+        unknown = [
+            name for name, backup_info in zip(names, backups)
+            if backup_info is None
+        ]
+        if unknown:
+            logger.error("Unknown backup %s, try --sync.", unknown[0])
+            sys.exit(1)
+    else:
+        backups = catalog.backups()
+    label = names[0] if names and len(names) == 1 else "all"
+    with run_report(
+        "verify",
+        Path(report) if report
+        else report_cache_path(bucket, label, "verify"),
+        Path(prometheus) if prometheus else None, profiler,
+        bucket=bucket, name=label
+    ) as metrics:
+        logger.info("Initialize AWS.")
+        aws = connect(bucket, options)
+        workers, _ = limit_cpu(
+            workers, aws.settings.cpu_limit, aws.settings.throttle_hours
+        )
+        plan = plan_pipeline(aws, metrics, workers, upload=False, framed=True)
+        if plan is None:
+            return
+        private_key = prompt_private_key(CONFIG_DIR/"key.pem")
+        if private_key is None:
+            logger.error("Could not load private key.")
+            metrics.success = False
+            return
+
+        results = []
+        with metrics.stage("verify", progress=True) as stage:
+            for backup_info in backups:
+                logger.info("Verifying %s.", backup_info.name)
+                results += verify_backup(
+                    aws, backup_info, private_key, fast,
+                    workers=workers, unpack=unpack,
+                    max_blocks_in_flight=plan.blocks_in_flight,
+                    max_frames_in_flight=plan.frames_in_flight,
+                    count=lambda bytesio: stage.count(
+                        bytesio, progress=True
+                    )
+                )
+        log_results(results)
+        log_cache(aws)
+        metrics.success = all(result.error is None for result in results)
+    if not metrics.success:
+        sys.exit(1)
+
+
+def benchmark(
+    bucket: Optional[str] = None,
+    datasets: Iterable[str] = DATASETS,
+    stages: Iterable[str] = STAGES,
+    codecs: Iterable[str] = tuple(CODECS),
+    size: float = DEFAULT_DATASET_SIZE / 2**20,
+    workers: int = 1,
+    block_size: int = BLOCK_SIZE,
+    output: Optional[str] = None,
+    baseline: Optional[str] = None,
+    **options: Dict[str, Any]
+) -> None:
+    """Measure stages on synthetic datasets and write a JSON report.
+
+    Args:
+        bucket (Optional[str], optional): Bucket of S3 stages. Defaults to
+            a bucket in an in-process moto server if moto is installed.
+            S3 stages are skipped otherwise.
+        datasets (Iterable[str], optional): Datasets to generate.
+            Defaults to DATASETS.
+        stages (Iterable[str], optional): Stages to measure.
+            Defaults to STAGES.
+        codecs (Iterable[str], optional): Codecs of the pack stage.
+            Defaults to all codecs.
+        size (float, optional): Size of each dataset in MiB.
+            Defaults to DEFAULT_DATASET_SIZE.
+        workers (int, optional): Number of encryption processes.
+            Defaults to 1.
+        block_size (int, optional): Size of encryption blocks in bytes.
+            Defaults to BLOCK_SIZE.
+        output (Optional[str], optional): Report file. Defaults to
+            benchmark.json in the cache directory.
+        baseline (Optional[str], optional): Earlier report to compare
+            with. Defaults to None.
+        options (Dict[str, Any]): transfer settings
+    """
+    stand_in: ContextManager[Dict[str, Any]] = nullcontext({})
+    if bucket is None:
+        if find_spec("moto") is None:
+            logger.warning("Neither bucket nor moto given, skipping S3.")
+        else:
+            logger.info("Starting local S3 stand-in.")
+            stand_in = local_s3()
+    with stand_in as overrides:
+        settings = load_transfer_settings(
+            CONFIG_DIR/"transfer.ini", {**options, **overrides}
+        )
+        if overrides:
+            bucket = "benchmark"
+            AWSBucket(bucket, settings._replace(preflight=False)) \
+                .client.create_bucket(Bucket=bucket)
+        results = run_benchmark(
+            Path("/tmp/benchmark"), bucket, settings, list(datasets),
+            list(stages), list(codecs), int(size*2**20), workers,
+            block_size
+        )
+    CACHE_DIR.mkdir(exist_ok=True)
+    output_path = Path(output) if output else CACHE_DIR/"benchmark.json"
+    write_report(
+        output_path, results,
+        {
+            "size": int(size*2**20),
+            "workers": workers,
+            "block_size": block_size,
+            "frame_size": FRAME_SIZE,
+            "codecs": list(codecs),
+            "default_codec": DEFAULT_CODEC,
+            "transfer": settings._asdict()
+        }
+    )
+    logger.info("Wrote %s.", output_path)
+    if baseline:
+        with open(baseline, encoding="utf-8") as textio:
+            earlier = json.load(textio)
+        for line in compare_reports(
+            earlier, json.loads(output_path.read_text(encoding="utf-8"))
+        ):
+            print(line)
 
 
 def gen_cert(**_: Dict[str, Any]) -> None:
@@ -160,15 +1270,146 @@ def gen_cert(**_: Dict[str, Any]) -> None:
         logger.error("No output directory mounted.")
 
 
+def positive_int(value: str) -> int:
+    """Parse a count of at least one from the command line.
+
+    Args:
+        value (str): argument
+
+    Raises:
+        ArgumentTypeError: not a positive integer
+
+    Returns:
+        int: count
+    """
+    try:
+        count = int(value)
+    except ValueError:
+        count = 0
+    if count < 1:
+        raise ArgumentTypeError(f"Expected a positive integer, got {value}.")
+    return count
+
+
 def main():
     """Entrypoint."""
     parser = ArgumentParser(description=__doc__)
     parser.add_argument("-v", "--verbose", help="enable debug log")
     subparsers = parser.add_subparsers(help="Choose mode.", required=True)
 
+    # profiling option shared by all subparsers
+    profile_parser = ArgumentParser(add_help=False)
+    profile_parser.add_argument(
+        "--profile", nargs="?", const="auto", choices=PROFILERS,
+        help="Profile the command and snapshot memory allocations per "
+        "stage. Profiles are written next to the run report or to "
+        "/cache/<command>.profile/. auto samples with pyinstrument if "
+        "installed and uses cProfile otherwise."
+    )
+
+    # transfer options shared by subparsers accessing S3
+    transfer_parser = ArgumentParser(add_help=False)
+    transfer_group = transfer_parser.add_argument_group(
+        "transfer settings",
+        "Override [transfer] in /config/transfer.ini and AWS_BACKUP_* "
+        "environment variables."
+    )
+    transfer_group.add_argument(
+        "--part-size", type=float, help="Multipart part size in MiB."
+    )
+    transfer_group.add_argument(
+        "--max-concurrency", type=int,
+        help="Concurrent requests per transfer."
+    )
+    transfer_group.add_argument(
+        "--max-pool-connections", type=int,
+        help="Connections of the S3 client."
+    )
+    transfer_group.add_argument(
+        "--range-size", type=float, help="Ranged GET size in MiB."
+    )
+    transfer_group.add_argument(
+        "--checksum-algorithm", choices=CHECKSUM_ALGORITHMS,
+        help="Additional checksum stored with uploads and validated on "
+        "downloads."
+    )
+    transfer_group.add_argument(
+        "--checksums", choices=CHECKSUM_MODES,
+        help="When checksums are calculated and validated."
+    )
+    transfer_group.add_argument(
+        "--max-memory", type=float,
+        help="Memory in MiB for buffers of backup and restore pipelines. "
+        "Windows, parts and concurrency are reduced to fit."
+    )
+    transfer_group.add_argument(
+        "--cache-size", type=float,
+        help="Size in MiB of the local cache of downloaded ranges, which "
+        "repeated restores read instead of S3. Defaults to no cache."
+    )
+    transfer_group.add_argument(
+        "--endpoint-url", help="Alternative S3 endpoint, e.g. MinIO."
+    )
+    transfer_group.add_argument(
+        "--no-preflight", action="store_const", const=False,
+        dest="preflight",
+        help="Skip checking bucket and credentials on connect."
+    )
+
+    throttle_group = transfer_parser.add_argument_group(
+        "throttling",
+        "Keep backups from starving services on the same host. Override "
+        "[transfer] in /config/transfer.ini like the transfer settings."
+    )
+    throttle_group.add_argument(
+        "--upload-limit", type=float, help="Upload bandwidth in MiB/s."
+    )
+    throttle_group.add_argument(
+        "--download-limit", type=float, help="Download bandwidth in MiB/s."
+    )
+    throttle_group.add_argument(
+        "--read-limit", type=float,
+        help="Rate in MiB/s of the archive tar streams to streamed backups."
+    )
+    throttle_group.add_argument(
+        "--cpu-limit", type=int,
+        help="Cores for encryption workers and compressor threads. Caps "
+        "--workers."
+    )
+    throttle_group.add_argument(
+        "--nice", type=int,
+        help="Niceness of this process, tar and the compressors."
+    )
+    throttle_group.add_argument(
+        "--ionice", choices=list(IONICE_CLASSES),
+        help="I/O scheduling class of this process, tar and the "
+        "compressors."
+    )
+    throttle_group.add_argument(
+        "--throttle-hours", metavar="HH:MM-HH:MM",
+        help="Apply the limits above only at these hours of the day, "
+        "e.g. 08:00-20:00. Defaults to always."
+    )
+
+    # report options shared by backup and restore
+    report_parser = ArgumentParser(add_help=False)
+    report_group = report_parser.add_argument_group("run report")
+    report_group.add_argument(
+        "--report", type=str, default=None,
+        help="JSON report of stage timings, sizes and peak memory. "
+        "Defaults to /cache/<bucket>.<name>.<mode>.json."
+    )
+    report_group.add_argument(
+        "--prometheus", type=str, default=None,
+        help="Also write the report to this file in the Prometheus text "
+        "format, e.g. in the directory of the node exporter's textfile "
+        "collector."
+    )
+
     # backup subparser
     backup_parser = subparsers.add_parser(
-        "backup", help="Backup files mounted to /data/ to AWS S3 storage."
+        "backup", help="Backup files mounted to /data/ to AWS S3 storage.",
+        parents=[transfer_parser, report_parser, profile_parser]
     )
     backup_parser.set_defaults(func=backup)
     backup_parser.add_argument(
@@ -177,10 +1418,111 @@ def main():
     backup_parser.add_argument(
         "name", type=str, help="Name of file in bucket."
     )
+    backup_parser.add_argument(
+        "--stream", action="store_true",
+        help="Stream data from tar to S3 without temporary files."
+    )
+    backup_parser.add_argument(
+        "--workers", type=int, default=cpu_count(),
+        help="Number of encryption processes. Defaults to CPU count."
+    )
+    backup_parser.add_argument(
+        "--framed", action="store_true",
+        help="Compress in independent frames and upload a member index "
+        "to allow restoring single files. Implies --stream."
+    )
+    backup_parser.add_argument(
+        "--dedup", action="store_true",
+        help="Upload only chunks not yet stored in the bucket."
+    )
+    backup_parser.add_argument(
+        "--shards", type=positive_int, default=None,
+        help="Split data into this many archives of similar size, which "
+        "are packed, encrypted and uploaded in parallel. Restore with "
+        "--sharded."
+    )
+    backup_parser.add_argument(
+        "--incremental", action="store_true",
+        help="Upload only files changed since the previous incremental "
+        "backup. Starts a new chain if there is none in the cache."
+    )
+    backup_parser.add_argument(
+        "--checksum", action="store_true",
+        help="With --incremental, detect changes by content hash too."
+    )
+    backup_parser.add_argument(
+        "--codec", choices=[*CODECS, AUTO_CODEC], default=DEFAULT_CODEC,
+        help=f"Compression codec. Defaults to {DEFAULT_CODEC}. "
+        f"{AUTO_CODEC} picks the best compressing codec meeting "
+        "--target-throughput on a sample of the data."
+    )
+    backup_parser.add_argument(
+        "--compression-level", type=int, default=None,
+        help="Compression level of the codec."
+    )
+    backup_parser.add_argument(
+        "--target-throughput", type=float,
+        default=DEFAULT_TARGET_THROUGHPUT,
+        help="Minimum compression and decompression throughput in MB/s "
+        f"of --codec {AUTO_CODEC}. Defaults to {DEFAULT_TARGET_THROUGHPUT}."
+    )
+
+    backup_parser.add_argument(
+        "--resume", action="store_true",
+        help="Keep a checkpoint in /cache/ and continue an interrupted "
+        "upload of the same backup. Implies --stream."
+    )
+
+    # batch backup subparser
+    backup_many_parser = subparsers.add_parser(
+        "backup-many",
+        help="Backup many directories listed in a job file concurrently.",
+        parents=[transfer_parser, profile_parser]
+    )
+    backup_many_parser.set_defaults(func=backup_many)
+    backup_many_parser.add_argument(
+        "bucket", type=str, help="Select bucket to store backups."
+    )
+    backup_many_parser.add_argument(
+        "jobs", type=str,
+        help="Job file with a line '<path> <name in bucket>' per directory. "
+        "'-' reads stdin."
+    )
+    backup_many_parser.add_argument(
+        "--pack-slots", type=int, default=2,
+        help="Number of concurrent tar processes. Defaults to 2."
+    )
+    backup_many_parser.add_argument(
+        "--encrypt-slots", type=int, default=1,
+        help="Number of concurrent encryptions. Defaults to 1."
+    )
+    backup_many_parser.add_argument(
+        "--upload-slots", type=int, default=2,
+        help="Number of concurrent uploads. Defaults to 2."
+    )
+    backup_many_parser.add_argument(
+        "--workers", type=int, default=cpu_count(),
+        help="Number of encryption processes. Defaults to CPU count."
+    )
+    backup_many_parser.add_argument(
+        "--codec", choices=[*CODECS, AUTO_CODEC], default=DEFAULT_CODEC,
+        help=f"Compression codec. Defaults to {DEFAULT_CODEC}."
+    )
+    backup_many_parser.add_argument(
+        "--compression-level", type=int, default=None,
+        help="Compression level of the codec."
+    )
+    backup_many_parser.add_argument(
+        "--target-throughput", type=float,
+        default=DEFAULT_TARGET_THROUGHPUT,
+        help="Minimum compression and decompression throughput in MB/s "
+        f"of --codec {AUTO_CODEC}. Defaults to {DEFAULT_TARGET_THROUGHPUT}."
+    )
 
     # restore backup subparser
     restore_parser = subparsers.add_parser(
-        "restore", help="Restore files from AWS S3 storage to /data/."
+        "restore", help="Restore files from AWS S3 storage to /data/.",
+        parents=[transfer_parser, report_parser, profile_parser]
     )
     restore_parser.set_defaults(func=restore)
     restore_parser.add_argument(
@@ -189,10 +1531,186 @@ def main():
     restore_parser.add_argument(
         "name", type=str, help="Name of file in bucket."
     )
+    restore_parser.add_argument(
+        "--stream", action="store_true",
+        help="Stream data from S3 to tar without temporary files."
+    )
+    restore_parser.add_argument(
+        "--workers", type=int, default=cpu_count(),
+        help="Number of decryption processes. Defaults to CPU count."
+    )
+    restore_parser.add_argument(
+        "--path", action="append", metavar="GLOB",
+        help="Restore only files matching the glob pattern relative to "
+        "/data/ from a --framed backup. May be repeated. The volume need "
+        "not be empty."
+    )
+    restore_parser.add_argument(
+        "--dedup", action="store_true",
+        help="Restore backup created with --dedup."
+    )
+    restore_parser.add_argument(
+        "--sharded", action="store_true",
+        help="Restore backup created with --shards, all shards in parallel."
+    )
+    restore_parser.add_argument(
+        "--sync", action="store_true",
+        help="Restore a full backup into a non-empty volume. Files of the "
+        "same size and modification time are kept, others are compared "
+        "and only differing parts are written."
+    )
+    restore_parser.add_argument(
+        "--delete", action="store_true",
+        help="With --sync, delete files which are not in the backup."
+    )
+    restore_parser.add_argument(
+        "--writers", type=int, default=1,
+        help="Number of threads writing restored files. Speeds up volumes "
+        "with many small files. Defaults to 1, which unpacks with tar."
+    )
+    restore_parser.add_argument(
+        "--incremental", action="store_true",
+        help="Restore chain of backups created with --incremental."
+    )
+    restore_parser.add_argument(
+        "--level", type=int, default=None,
+        help="With --incremental, restore the state after this backup of "
+        "the chain. Defaults to the latest."
+    )
+    restore_parser.add_argument(
+        "--resume", action="store_true",
+        help="Download into /cache/ and fetch only the ranges missing "
+        "after an interrupted download. Ignores --stream."
+    )
+
+    # garbage collection subparser
+    gc_parser = subparsers.add_parser(
+        "gc", help="Delete chunks no deduplicated backup references.",
+        parents=[transfer_parser, profile_parser]
+    )
+    gc_parser.set_defaults(func=gc)
+    gc_parser.add_argument(
+        "bucket", type=str, help="Select bucket to clean up."
+    )
+    gc_parser.add_argument(
+        "--dry-run", action="store_true",
+        help="Only report unreferenced chunks."
+    )
+
+    # catalog subparsers
+    list_parser = subparsers.add_parser(
+        "list", help="List backups from the local catalog.",
+        parents=[transfer_parser, profile_parser]
+    )
+    list_parser.set_defaults(func=list_backups)
+    list_parser.add_argument(
+        "bucket", type=str, help="Select bucket to list."
+    )
+    list_parser.add_argument(
+        "--sync", action="store_true",
+        help="Sync catalog with the bucket first. Only new or changed "
+        "files are read."
+    )
+    info_parser = subparsers.add_parser(
+        "info", help="Show backup details from the local catalog.",
+        parents=[transfer_parser, profile_parser]
+    )
+    info_parser.set_defaults(func=info)
+    info_parser.add_argument(
+        "bucket", type=str, help="Select bucket of backup."
+    )
+    info_parser.add_argument(
+        "name", type=str, help="Name of backup in bucket."
+    )
+    info_parser.add_argument(
+        "--sync", action="store_true",
+        help="Sync catalog with the bucket first."
+    )
+
+    # verify subparser
+    verify_parser = subparsers.add_parser(
+        "verify", help="Check backups in AWS S3 storage without restoring "
+        "them.",
+        parents=[transfer_parser, report_parser, profile_parser]
+    )
+    verify_parser.set_defaults(func=verify)
+    verify_parser.add_argument(
+        "bucket", type=str, help="Select bucket of backups."
+    )
+    verify_parser.add_argument(
+        "names", type=str, nargs="*",
+        help="Names of backups in bucket. Defaults to all backups."
+    )
+    verify_parser.add_argument(
+        "--fast", action="store_true",
+        help="Check only the checksums S3 validated on upload, the block "
+        "index, first and last block of containers and that files "
+        "referenced by manifests exist."
+    )
+    verify_parser.add_argument(
+        "--unpack", action="store_true",
+        help="Also decompress and parse archives, discarding the data."
+    )
+    verify_parser.add_argument(
+        "--workers", type=int, default=cpu_count(),
+        help="Number of decryption processes. Defaults to CPU count."
+    )
+    verify_parser.add_argument(
+        "--sync", action="store_true",
+        help="Sync catalog with the bucket first."
+    )
+
+    # benchmark subparser
+    benchmark_parser = subparsers.add_parser(
+        "benchmark",
+        help="Measure throughput, CPU time and peak memory per stage on "
+        "synthetic data.",
+        parents=[transfer_parser, profile_parser]
+    )
+    benchmark_parser.set_defaults(func=benchmark)
+    benchmark_parser.add_argument(
+        "bucket", type=str, nargs="?",
+        help="Bucket of upload and download stages. Defaults to a local "
+        "moto server if installed."
+    )
+    benchmark_parser.add_argument(
+        "--datasets", nargs="+", choices=DATASETS, default=DATASETS,
+        help="Datasets to generate. Defaults to all."
+    )
+    benchmark_parser.add_argument(
+        "--stages", nargs="+", choices=STAGES, default=STAGES,
+        help="Stages to measure, pack once per codec. Defaults to all."
+    )
+    benchmark_parser.add_argument(
+        "--codecs", nargs="+", choices=list(CODECS), default=list(CODECS),
+        help="Codecs of the pack stage. Defaults to all."
+    )
+    benchmark_parser.add_argument(
+        "--size", type=float, default=DEFAULT_DATASET_SIZE / 2**20,
+        help="Size of each dataset in MiB. "
+        f"Defaults to {DEFAULT_DATASET_SIZE // 2**20}."
+    )
+    benchmark_parser.add_argument(
+        "--workers", type=int, default=cpu_count(),
+        help="Number of encryption processes. Defaults to CPU count."
+    )
+    benchmark_parser.add_argument(
+        "--block-size", type=int, default=BLOCK_SIZE,
+        help=f"Encryption block size in bytes. Defaults to {BLOCK_SIZE}."
+    )
+    benchmark_parser.add_argument(
+        "--output", type=str, default=None,
+        help="Report file. Defaults to /cache/benchmark.json."
+    )
+    benchmark_parser.add_argument(
+        "--baseline", type=str, default=None,
+        help="Earlier report to compare with."
+    )
 
     # generate certificate subparser
     gen_cert_parser = subparsers.add_parser(
-        "gencert", help="Generate self-signed certificate."
+        "gencert", help="Generate self-signed certificate.",
+        parents=[profile_parser]
     )
     gen_cert_parser.set_defaults(func=gen_cert)
 
@@ -211,7 +1729,20 @@ def main():
     )
 
     # run
-    args.func(**args.__dict__)
+    profiler = None
+    if args.profile:
+        try:
+            profiler = Profiler(args.profile)
+        except ValueError as error:
+            parser.error(str(error))
+        profiler.start()
+    try:
+        args.func(**args.__dict__, profiler=profiler)
+    finally:
+        # commands without run report
+        if profiler is not None and profiler.written is None:
+            CACHE_DIR.mkdir(exist_ok=True)
+            profiler.write(CACHE_DIR/f"{args.func.__name__}.profile")
 
 
 if __name__ == "__main__":
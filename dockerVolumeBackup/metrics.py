@@ -0,0 +1,593 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Per stage metrics and run reports of backups and restores.
+
+Every stage of a run records wall time, CPU time including subprocesses,
+bytes in and out and peak memory. The run is reported as JSON and
+optionally in the Prometheus text format, e.g. for the textfile collector
+of the node exporter. Streaming stages show a progress line.
+"""
+
+import json
+import os
+import stat
+import sys
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from io import RawIOBase
+from logging import getLogger
+from pathlib import Path
+from resource import RUSAGE_CHILDREN, RUSAGE_SELF, getrusage
+from threading import Lock
+from time import perf_counter, time
+from typing import IO, Any, Dict, Iterator, List, NamedTuple, Optional
+
+from .profiling import Profiler
+
+# seconds between progress lines on a terminal and in logs
+PROGRESS_INTERVAL = 0.5
+PROGRESS_LOG_INTERVAL = 60
+PROMETHEUS_PREFIX = "aws_backup"
+logger = getLogger(__file__)
+
+
+class StageMetrics(NamedTuple):
+    """Measurement of a finished stage."""
+
+    name: str
+    seconds: float
+    cpu_seconds: float
+    # None where the stage cannot observe its data
+    bytes_in: Optional[int]
+    bytes_out: Optional[int]
+    peak_rss: int
+    # peak bytes in the part buffers of a streamed upload
+    peak_buffered: Optional[int] = None
+
+    @property
+    def ratio(self) -> Optional[float]:
+        """Bytes in per byte out, the compression ratio of packing stages.
+
+        Returns:
+            Optional[float]: ratio, None if unknown
+        """
+        if not self.bytes_in or not self.bytes_out:
+            return None
+        return self.bytes_in / self.bytes_out
+
+    @property
+    def throughput(self) -> Optional[float]:
+        """Bytes in per second.
+
+        Returns:
+            Optional[float]: throughput, None if unknown
+        """
+        if self.bytes_in is None or not self.seconds:
+            return None
+        return self.bytes_in / self.seconds
+
+
+def apparent_size(root: Path) -> int:
+    """Sum sizes of the regular files below root without following links.
+
+    Hard links are counted once, like tar stores them.
+
+    Args:
+        root (Path): directory
+
+    Returns:
+        int: size in bytes
+    """
+    total = 0
+    inodes = set()
+    for directory, _, files in os.walk(root):
+        for file_name in files:
+            try:
+                status = os.lstat(os.path.join(directory, file_name))
+            except FileNotFoundError:
+                continue
+            if not stat.S_ISREG(status.st_mode):
+                continue
+            if status.st_nlink > 1:
+                if (status.st_dev, status.st_ino) in inodes:
+                    continue
+                inodes.add((status.st_dev, status.st_ino))
+            total += status.st_size
+    return total
+
+
+def reset_peak_rss() -> None:
+    """Restart the peak RSS of this process, if the kernel allows it."""
+    try:
+        with open("/proc/self/clear_refs", "w", encoding="ascii") as textio:
+            textio.write("5")
+    except OSError:
+        pass
+
+
+def peak_rss() -> int:
+    """Peak RSS of this process since start or the last reset.
+
+    ru_maxrss of the process survives exec and is never reset, VmHWM is.
+
+    Returns:
+        int: bytes
+    """
+    try:
+        with open("/proc/self/status", encoding="ascii") as textio:
+            for line in textio:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])*1024
+    except OSError:
+        pass
+    return getrusage(RUSAGE_SELF).ru_maxrss*1024
+
+
+def cpu_seconds() -> float:
+    """CPU time of this process and its finished subprocesses.
+
+    Returns:
+        float: user and system seconds
+    """
+    return sum(
+        usage.ru_utime + usage.ru_stime
+        for usage in (getrusage(RUSAGE_SELF), getrusage(RUSAGE_CHILDREN))
+    )
+
+
+def _format_size(size: float) -> str:
+    """Format size with binary prefix.
+
+    Args:
+        size (float): bytes
+
+    Returns:
+        str: e.g. "1.5 GiB"
+    """
+    for unit in ("B", "KiB", "MiB", "GiB"):
+        if size < 1024:
+            return f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} TiB"
+
+
+class Progress:
+    """Progress line with throughput and ETA.
+
+    On a terminal the line is redrawn in place, otherwise it is logged every
+    PROGRESS_LOG_INTERVAL seconds.
+    """
+
+    def __init__(
+        self,
+        label: str,
+        total: Optional[int] = None,
+        interactive: Optional[bool] = None
+    ) -> None:
+        """Progress constructor.
+
+        Args:
+            label (str): name of the stage
+            total (Optional[int], optional): Expected number of bytes.
+                Defaults to None, which shows no ETA.
+            interactive (Optional[bool], optional): Redraw a terminal line.
+                Defaults to whether stderr is a terminal.
+        """
+        self.label = label
+        self.total = total
+        self.done = 0
+        self._interactive = sys.stderr.isatty() \
+            if interactive is None else interactive
+        self._interval = PROGRESS_INTERVAL if self._interactive \
+            else PROGRESS_LOG_INTERVAL
+        self._start = perf_counter()
+        self._shown = self._start
+
+    def line(self) -> str:
+        """Describe progress.
+
+        Returns:
+            str: e.g. "backup: 1.0 GiB of 4.0 GiB, 50.0 MB/s, ETA 0:01:04"
+        """
+        seconds = perf_counter() - self._start
+        rate = self.done / seconds if seconds else 0.0
+        line = f"{self.label}: {_format_size(self.done)}"
+        if self.total:
+            line += f" of {_format_size(self.total)}"
+        line += f", {rate / 1e6:.1f} MB/s"
+        if self.total and rate:
+            eta = int(max(self.total - self.done, 0) / rate)
+            line += f", ETA {eta // 3600}:{eta // 60 % 60:02}:{eta % 60:02}"
+        return line
+
+    def update(self, size: int) -> None:
+        """Count processed bytes and show progress if it is due.
+
+        Args:
+            size (int): bytes processed since the last update
+        """
+        self.done += size
+        now = perf_counter()
+        if now - self._shown < self._interval:
+            return
+        self._shown = now
+        if self._interactive:
+            sys.stderr.write("\r\033[K" + self.line())
+            sys.stderr.flush()
+        else:
+            logger.info("%s", self.line())
+
+    def close(self) -> None:
+        """End the progress line."""
+        if self._interactive and self._shown > self._start:
+            sys.stderr.write("\r\033[K")
+            sys.stderr.flush()
+
+
+class _CountingReader(RawIOBase):
+    """Readable stream counting the bytes read from the wrapped stream."""
+
+    def __init__(
+        self,
+        bytesio: IO[bytes],
+        stage: "Stage",
+        field: str,
+        progress: Optional[Progress]
+    ) -> None:
+        """_CountingReader constructor.
+
+        Args:
+            bytesio (IO[bytes]): wrapped stream
+            stage (Stage): stage whose counter is increased
+            field (str): "bytes_in" or "bytes_out"
+            progress (Optional[Progress]): progress fed with the bytes
+        """
+        super().__init__()
+        self._bytesio = bytesio
+        self._stage = stage
+        self._field = field
+        self._progress = progress
+
+    def readable(self) -> bool:
+        """Stream is readable.
+
+        Returns:
+            bool: always True
+        """
+        return True
+
+    def readinto(self, buffer: memoryview) -> int:
+        """Read from wrapped stream.
+
+        Args:
+            buffer (memoryview): destination buffer
+
+        Returns:
+            int: number of bytes read, 0 on end of stream
+        """
+        data = self._bytesio.read(len(buffer))
+        size = len(data)
+        buffer[:size] = data
+        with self._stage.lock:
+            setattr(
+                self._stage, self._field,
+                (getattr(self._stage, self._field) or 0) + size
+            )
+            if self._progress is not None:
+                self._progress.update(size)
+        return size
+
+
+class Stage:
+    """Byte counters of a running stage.
+
+    Streams of one stage may be counted from several threads.
+    """
+
+    def __init__(self, name: str, progress: Optional[Progress]) -> None:
+        """Stage constructor.
+
+        Args:
+            name (str): name of the stage
+            progress (Optional[Progress]): progress line of the stage
+        """
+        self.name = name
+        self.bytes_in: Optional[int] = None
+        self.bytes_out: Optional[int] = None
+        self.buffered: Optional[int] = None
+        self.progress = progress
+        self.lock = Lock()
+
+    def count(
+        self,
+        bytesio: IO[bytes],
+        output: bool = False,
+        progress: bool = False
+    ) -> IO[bytes]:
+        """Count bytes read from a stream.
+
+        Args:
+            bytesio (IO[bytes]): readable stream
+            output (bool, optional): Count as output instead of input of the
+                stage. Defaults to False.
+            progress (bool, optional): Feed the progress line.
+                Defaults to False.
+
+        Returns:
+            IO[bytes]: readable stream
+        """
+        return _CountingReader(
+            bytesio, self, "bytes_out" if output else "bytes_in",
+            self.progress if progress else None
+        )
+
+
+class RunMetrics:
+    """Stages and outcome of a backup or restore."""
+
+    def __init__(
+        self,
+        operation: str,
+        profiler: Optional[Profiler] = None,
+        **labels: str
+    ) -> None:
+        """RunMetrics constructor.
+
+        Args:
+            operation (str): "backup" or "restore"
+            profiler (Optional[Profiler], optional): Running profiler split
+                at stage boundaries. Defaults to None.
+            labels (str): e.g. bucket and name, reported with the metrics
+        """
+        self.operation = operation
+        self.labels = labels
+        self._profiler = profiler
+        self.stages: List[StageMetrics] = []
+        # runs ending without result but without exception set it False
+        self.success = True
+        self.error: Optional[str] = None
+        # buffer windows of the pipeline, see plan_memory
+        self.memory: Optional[Dict[str, Any]] = None
+        self._started = time()
+        self._start = perf_counter()
+        self._seconds: Optional[float] = None
+
+    @contextmanager
+    def stage(
+        self,
+        name: str,
+        progress_total: Optional[int] = None,
+        progress: bool = False
+    ) -> Iterator[Stage]:
+        """Measure a stage. Failed stages are recorded as well.
+
+        Peak memory is the high water mark of this process during the stage
+        and the largest subprocess, if it exceeded all earlier ones.
+
+        Args:
+            name (str): name of the stage
+            progress_total (Optional[int], optional): Expected bytes of the
+                progress line. Defaults to None.
+            progress (bool, optional): Show a progress line.
+                Defaults to False.
+
+        Yields:
+            Stage: byte counters to fill
+        """
+        running = Stage(
+            name, Progress(name, progress_total) if progress else None
+        )
+        if self._profiler is not None:
+            self._profiler.mark(name)
+        children_rss = getrusage(RUSAGE_CHILDREN).ru_maxrss
+        reset_peak_rss()
+        cpu_start = cpu_seconds()
+        start = perf_counter()
+        try:
+            yield running
+        finally:
+            if running.progress is not None:
+                running.progress.close()
+            peak = peak_rss()
+            if getrusage(RUSAGE_CHILDREN).ru_maxrss > children_rss:
+                peak = max(peak, getrusage(RUSAGE_CHILDREN).ru_maxrss*1024)
+            self.stages.append(StageMetrics(
+                name, perf_counter() - start, cpu_seconds() - cpu_start,
+                running.bytes_in, running.bytes_out, peak, running.buffered
+            ))
+            logger.debug("Finished %s", self.stages[-1])
+            if self._profiler is not None:
+                self._profiler.mark(f"after_{name}")
+
+    def finish(self, error: Optional[BaseException] = None) -> None:
+        """Record the outcome of the run.
+
+        Args:
+            error (Optional[BaseException], optional): Exception which
+                ended the run. Defaults to None for success.
+        """
+        self._seconds = perf_counter() - self._start
+        if error is not None:
+            self.success = False
+            self.error = repr(error)
+
+    def report(self) -> Dict[str, Any]:
+        """Summarize run.
+
+        Returns:
+            Dict[str, Any]: JSON serializable report
+        """
+        seconds = perf_counter() - self._start \
+            if self._seconds is None else self._seconds
+        return {
+            "operation": self.operation,
+            **self.labels,
+            "started": datetime.fromtimestamp(
+                self._started, timezone.utc
+            ).isoformat(),
+            "seconds": round(seconds, 3),
+            "success": self.success,
+            "error": self.error,
+            "memory": self.memory,
+            "stages": [
+                {
+                    "stage": stage.name,
+                    "seconds": round(stage.seconds, 3),
+                    "cpu_seconds": round(stage.cpu_seconds, 3),
+                    "bytes_in": stage.bytes_in,
+                    "bytes_out": stage.bytes_out,
+                    "ratio": None if stage.ratio is None
+                    else round(stage.ratio, 3),
+                    "mb_per_s": None if stage.throughput is None
+                    else round(stage.throughput / 1e6, 2),
+                    "peak_rss_mib": round(stage.peak_rss / 2**20, 1),
+                    "peak_buffered_mib": None if stage.peak_buffered is None
+                    else round(stage.peak_buffered / 2**20, 1)
+                }
+                for stage in self.stages
+            ]
+        }
+
+    def write_json(self, path: Path) -> None:
+        """Write report as JSON.
+
+        Args:
+            path (Path): report file
+        """
+        _write_atomic(path, json.dumps(self.report(), indent=2) + "\n")
+
+    def write_prometheus(self, path: Path) -> None:
+        """Write report in the Prometheus text format.
+
+        The file is replaced atomically, as the textfile collector requires.
+
+        Args:
+            path (Path): file ending in .prom
+        """
+        labels = {"operation": self.operation, **self.labels}
+        report = self.report()
+        lines: List[str] = []
+
+        def add(
+            metric: str,
+            help_text: str,
+            samples: List[Any]
+        ) -> None:
+            name = f"{PROMETHEUS_PREFIX}_{metric}"
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} gauge")
+            for extra, value in samples:
+                if value is not None:
+                    lines.append(
+                        f"{name}{_format_labels({**labels, **extra})} "
+                        f"{value}"
+                    )
+
+        add("success", "1 if the last run succeeded.",
+            [({}, int(self.success))])
+        add("last_run_timestamp_seconds", "Start of the last run.",
+            [({}, round(self._started, 3))])
+        add("duration_seconds", "Wall time of the last run.",
+            [({}, report["seconds"])])
+        stages = [({"stage": stage.name}, stage) for stage in self.stages]
+        add("stage_duration_seconds", "Wall time of the stage.",
+            [(extra, round(stage.seconds, 3)) for extra, stage in stages])
+        add("stage_cpu_seconds", "CPU time of the stage.",
+            [(extra, round(stage.cpu_seconds, 3))
+             for extra, stage in stages])
+        add("stage_bytes_in", "Bytes consumed by the stage.",
+            [(extra, stage.bytes_in) for extra, stage in stages])
+        add("stage_bytes_out", "Bytes produced by the stage.",
+            [(extra, stage.bytes_out) for extra, stage in stages])
+        add("stage_peak_rss_bytes", "Peak resident memory of the stage.",
+            [(extra, stage.peak_rss) for extra, stage in stages])
+        add("stage_peak_buffered_bytes",
+            "Peak bytes in upload buffers of the stage.",
+            [(extra, stage.peak_buffered) for extra, stage in stages])
+        _write_atomic(path, "\n".join(lines) + "\n")
+
+
+def _format_labels(labels: Dict[str, str]) -> str:
+    """Format Prometheus labels.
+
+    Args:
+        labels (Dict[str, str]): label names and values
+
+    Returns:
+        str: e.g. '{bucket="b",name="n"}'
+    """
+    escaped = (
+        str(value).replace("\\", "\\\\").replace('"', '\\"')
+        .replace("\n", "\\n")
+        for value in labels.values()
+    )
+    return "{" + ",".join(
+        f'{name}="{value}"' for name, value in zip(labels, escaped)
+    ) + "}"
+
+
+def _write_atomic(path: Path, text: str) -> None:
+    """Replace file atomically.
+
+    Args:
+        path (Path): file
+        text (str): content
+    """
+    partial_path = path.with_name(path.name + ".partial")
+    partial_path.write_text(text, encoding="utf-8")
+    partial_path.replace(path)
+
+
+@contextmanager
+def run_report(
+    operation: str,
+    json_path: Optional[Path],
+    prometheus_path: Optional[Path] = None,
+    profiler: Optional[Profiler] = None,
+    **labels: str
+) -> Iterator[RunMetrics]:
+    """Record a run and write its report when it ends, even on failure.
+
+    Args:
+        operation (str): "backup" or "restore"
+        json_path (Optional[Path]): JSON report file, None for none
+        prometheus_path (Optional[Path], optional): Prometheus text file.
+            Defaults to None.
+        profiler (Optional[Profiler], optional): Running profiler, whose
+            profiles are written next to the JSON report.
+            Defaults to None.
+        labels (str): e.g. bucket and name
+
+    Yields:
+        RunMetrics: metrics to record stages in
+    """
+    metrics = RunMetrics(operation, profiler, **labels)
+    try:
+        yield metrics
+    except BaseException as error:
+        metrics.finish(error)
+        raise
+    else:
+        metrics.finish()
+    finally:
+        for path, write in (
+            (json_path, metrics.write_json),
+            (prometheus_path, metrics.write_prometheus)
+        ):
+            if path is not None:
+                try:
+                    write(path)
+                except OSError as error:
+                    logger.warning("Could not write report: %s", error)
+        if profiler is not None and json_path is not None:
+            profiler.write(json_path.with_name(json_path.stem + ".profile"))
+        for stage in metrics.stages:
+            logger.info(
+                "%s: %.1f s, %.1f s CPU, %s in, %s out, %.0f MiB peak",
+                stage.name, stage.seconds, stage.cpu_seconds,
+                "?" if stage.bytes_in is None
+                else _format_size(stage.bytes_in),
+                "?" if stage.bytes_out is None
+                else _format_size(stage.bytes_out),
+                stage.peak_rss / 2**20
+            )
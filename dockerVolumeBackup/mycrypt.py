@@ -3,12 +3,24 @@
 """Crypto."""
 # Created on Sun Feb 06 2022 by Merlin Mittelbach.
 
+import json
+import struct
+from collections import deque
+from concurrent.futures import \
+    Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime
+from functools import partial
 from getpass import getpass
+from hashlib import sha256
 from io import BytesIO
+from itertools import islice
 from logging import getLogger
+from multiprocessing import get_context
+from os import urandom
 from pathlib import Path
-from typing import Optional, Tuple
+from typing import \
+    IO, Any, Callable, Dict, Iterable, Iterator, Optional, Tuple, Union
 
 from cryptography.fernet import Fernet
 from cryptography import x509
@@ -17,6 +29,10 @@ from cryptography.hazmat.primitives import serialization
 from cryptography.hazmat.primitives.asymmetric import rsa
 from cryptography.hazmat.primitives.asymmetric.padding import MGF1, OAEP
 from cryptography.hazmat.primitives.hashes import SHA256
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+from .streams import \
+    BufferPool, parallel_map, read_exact, readinto_exact
 
 RSA_PUBLIC_EXPONENT = 65537
 RSA_KEY_SIZE = 4*2**10
@@ -26,7 +42,32 @@ PADDING = OAEP(
     label=None
 )
 BLOCK_SIZE = 2**20
+# Blocks in flight per worker of parallel encryption.
+BLOCKS_IN_FLIGHT_PER_WORKER = 2
+# Container version written by encrypt.
+VERSION = 2
+# v2 containers start with MAGIC. v1 containers start with the RSA
+# encrypted key, which matches by chance with probability 2**-64.
+MAGIC = b"DVBCRYPT"
+NONCE_SIZE = 12
+# v2 block header: nonce, flags and cipher text length
+BLOCK_HEADER_SIZE = NONCE_SIZE + 1 + 4
+FLAG_FINAL = 0x01
+TAG_SIZE = 16
+# v2 containers end with an index of (cipher text offset, plain text offset)
+# per block followed by the footer: block count, plain text size, magic.
+INDEX_ENTRY = struct.Struct(">QQ")
+FOOTER = struct.Struct(">QQ8s")
+INDEX_MAGIC = b"DVBINDEX"
+# Bytes fetched at once when reading the header of a seekable container.
+HEADER_PREFETCH = 2**16
 logger = getLogger(__file__)
+# cipher instance of worker process
+_worker_cipher: Union[Fernet, AESGCM, None] = None
+# cipher instances of worker process of a pool shared by streams, by key
+_worker_ciphers: Dict[Tuple[bytes, int], Union[Fernet, AESGCM]] = {}
+# keys whose ciphers a shared worker keeps, e.g. one per shard
+MAX_WORKER_CIPHERS = 64
 
 
 class AsymmetricFernetError(Exception):
@@ -83,55 +124,854 @@ def load_private_key(
         return private_key
 
 
-def encrypt(
-    file_path: Path,
+def _init_worker(key: bytes, version: int) -> None:
+    """Initialize cipher of worker process.
+
+    Args:
+        key (bytes): symmetric key
+        version (int): container version
+    """
+    global _worker_cipher  # pylint: disable=global-statement
+    _worker_cipher = _new_cipher(key, version)
+
+
+def _call_keyed(
+    func: Callable[[Any, Any], bytes],
+    key: bytes,
+    version: int,
+    item: Any
+) -> bytes:
+    """Apply crypto worker function with the cipher of a key.
+
+    Workers of a pool shared by several streams get the key with every
+    block instead of once at start, and keep the ciphers of recent keys.
+
+    Args:
+        func (Callable[[Any, Any], bytes]): crypto worker function
+        key (bytes): symmetric key
+        version (int): container version
+        item (Any): block passed to func
+
+    Returns:
+        bytes: result of func
+    """
+    cipher = _worker_ciphers.get((key, version))
+    if cipher is None:
+        if len(_worker_ciphers) >= MAX_WORKER_CIPHERS:
+            _worker_ciphers.clear()
+        cipher = _worker_ciphers[key, version] = _new_cipher(key, version)
+    return func(item, cipher)
+
+
+def new_crypto_pool(workers: int) -> ProcessPoolExecutor:
+    """Create process pool shared by the crypto of several streams.
+
+    Pass it as executor to encrypt_stream or open_decrypt_stream, e.g. of
+    all shards of a backup, so they use the same processes.
+
+    Args:
+        workers (int): number of worker processes
+
+    Returns:
+        ProcessPoolExecutor: process pool
+    """
+    return ProcessPoolExecutor(
+        max_workers=workers,
+        # spawn avoids forking a process with running threads
+        mp_context=get_context("spawn")
+    )
+
+
+def _new_cipher(key: bytes, version: int) -> Union[Fernet, AESGCM]:
+    """Create block cipher of container version.
+
+    Args:
+        key (bytes): symmetric key
+        version (int): container version
+
+    Returns:
+        Union[Fernet, AESGCM]: cipher
+    """
+    return Fernet(key) if version == 1 else AESGCM(key)
+
+
+def _block_aad(header_digest: bytes, index: int, final: bool) -> bytes:
+    """Associated data authenticated with each v2 block.
+
+    Binding header, position and end marker to every block detects
+    tampered headers as well as reordered and truncated blocks.
+
+    Args:
+        header_digest (bytes): SHA256 digest of the container header
+        index (int): block index
+        final (bool): last block of stream
+
+    Returns:
+        bytes: associated data
+    """
+    return header_digest + struct.pack(">QB", index, final)
+
+
+def _encrypt_block(
+    block: bytes,
+    cipher: Optional[Fernet] = None
+) -> bytes:
+    """Encrypt v1 block.
+
+    Args:
+        block (bytes): plain text block
+        cipher (Optional[Fernet], optional): Fernet instance. Defaults to
+            the one of the worker process.
+
+    Returns:
+        bytes: fernet token
+    """
+    return (cipher or _worker_cipher).encrypt(block)
+
+
+def _decrypt_block(
+    token: bytes,
+    cipher: Optional[Fernet] = None
+) -> bytes:
+    """Decrypt v1 block.
+
+    Args:
+        token (bytes): fernet token
+        cipher (Optional[Fernet], optional): Fernet instance. Defaults to
+            the one of the worker process.
+
+    Returns:
+        bytes: plain text block
+    """
+    return (cipher or _worker_cipher).decrypt(token)
+
+
+def _seal_block(
+    item: Tuple[bytes, bytes],
+    cipher: Optional[AESGCM] = None
+) -> bytes:
+    """Encrypt v2 block.
+
+    The cipher text is written behind the block header in place, so the
+    sealed block is the only allocation.
+
+    Args:
+        item (Tuple[bytes, bytes]): associated data and plain text block,
+            which may be a view of a reused buffer
+        cipher (Optional[AESGCM], optional): AESGCM instance. Defaults to
+            the one of the worker process.
+
+    Returns:
+        bytes: nonce, flags, length and cipher text including tag
+    """
+    aad, block = item
+    cipher = cipher or _worker_cipher
+    nonce = urandom(NONCE_SIZE)
+    size = len(block) + TAG_SIZE
+    sealed = bytearray(BLOCK_HEADER_SIZE + size)
+    sealed[:NONCE_SIZE] = nonce
+    # flags are the last byte of the associated data
+    sealed[NONCE_SIZE] = aad[-1]
+    sealed[NONCE_SIZE + 1:BLOCK_HEADER_SIZE] = \
+        int.to_bytes(size, 4, byteorder="big")
+    if hasattr(cipher, "encrypt_into"):
+        cipher.encrypt_into(
+            nonce, block, aad, memoryview(sealed)[BLOCK_HEADER_SIZE:]
+        )
+    else:
+        # cryptography before 44
+        sealed[BLOCK_HEADER_SIZE:] = cipher.encrypt(nonce, bytes(block), aad)
+    return sealed
+
+
+def _open_block(
+    item: Tuple[bytes, bytes, bytes],
+    cipher: Optional[AESGCM] = None
+) -> bytes:
+    """Decrypt v2 block.
+
+    Args:
+        item (Tuple[bytes, bytes, bytes]): associated data, nonce and
+            cipher text including tag
+        cipher (Optional[AESGCM], optional): AESGCM instance. Defaults to
+            the one of the worker process.
+
+    Returns:
+        bytes: plain text block
+    """
+    aad, nonce, block_crypt = item
+    return (cipher or _worker_cipher).decrypt(nonce, block_crypt, aad)
+
+
+@contextmanager
+def _block_mapper(
+    key: bytes,
+    version: int,
+    workers: int,
+    max_blocks_in_flight: Optional[int],
+    executor: Optional[Executor] = None
+) -> Iterator[Callable[[Callable, Iterable[Any]], Iterator[bytes]]]:
+    """Provide function mapping blocks through a crypto worker function.
+
+    A single worker processes blocks in the calling process. Otherwise a
+    process pool is used, as the ciphers hold the GIL for most of their
+    work.
+
+    Args:
+        key (bytes): symmetric key
+        version (int): container version
+        workers (int): number of worker processes
+        max_blocks_in_flight (Optional[int]): maximum number of blocks
+            being processed. Defaults to BLOCKS_IN_FLIGHT_PER_WORKER per
+            worker.
+        executor (Optional[Executor], optional): Pool from new_crypto_pool
+            shared with other streams, used instead of an own pool.
+            Defaults to None.
+
+    Yields:
+        Callable[[Callable, Iterable[Any]], Iterator[bytes]]: ordered map
+    """
+    if executor is not None:
+        if max_blocks_in_flight is None:
+            max_blocks_in_flight = BLOCKS_IN_FLIGHT_PER_WORKER*max(workers, 1)
+        yield lambda func, blocks: parallel_map(
+            executor, partial(_call_keyed, func, key, version), blocks,
+            max_blocks_in_flight
+        )
+    elif workers <= 1:
+        cipher = _new_cipher(key, version)
+        yield lambda func, blocks: (func(block, cipher) for block in blocks)
+    else:
+        if max_blocks_in_flight is None:
+            max_blocks_in_flight = BLOCKS_IN_FLIGHT_PER_WORKER*workers
+        with ProcessPoolExecutor(
+            max_workers=workers,
+            # spawn avoids forking a process with running threads
+            mp_context=get_context("spawn"),
+            initializer=_init_worker,
+            initargs=(key, version)
+        ) as executor:
+            yield lambda func, blocks: parallel_map(
+                executor, func, blocks, max_blocks_in_flight
+            )
+
+
+def _read_blocks(bytesio_in: IO[bytes], block_size: int) -> Iterator[bytes]:
+    """Read stream in blocks.
+
+    Args:
+        bytesio_in (IO[bytes]): readable stream
+        block_size (int): bytes per block
+
+    Yields:
+        bytes: blocks, only the last one may be shorter
+    """
+    while block := read_exact(bytesio_in, block_size):
+        yield block
+
+
+def _read_blocks_pooled(
+    bytesio_in: IO[bytes],
+    pool: BufferPool,
+    taken: deque
+) -> Iterator[bytearray]:
+    """Read stream in blocks into reused buffers of a pool.
+
+    Buffers are appended to taken in order. The consumer returns the
+    oldest one to the pool once its block is encrypted, which may be in a
+    worker process. Reading waits while all buffers are taken.
+
+    Args:
+        bytesio_in (IO[bytes]): readable stream
+        pool (BufferPool): buffers of the block size
+        taken (deque): buffers holding blocks not yet encrypted
+
+    Yields:
+        bytearray: blocks, only the last one may be shorter and a copy
+    """
+    while True:
+        buffer = pool.get()
+        size = readinto_exact(bytesio_in, memoryview(buffer))
+        if not size:
+            pool.put(buffer)
+            return
+        taken.append(buffer)
+        # bytearrays, unlike views, can be passed to worker processes
+        yield buffer if size == len(buffer) else buffer[:size]
+
+
+def _read_tokens(bytesio_in: IO[bytes]) -> Iterator[bytes]:
+    """Read length prefixed fernet tokens of v1 container.
+
+    Args:
+        bytesio_in (IO[bytes]): readable stream positioned after the key
+
+    Raises:
+        AsymmetricFernetError: stream is truncated
+
+    Yields:
+        bytes: fernet tokens
+    """
+    while block_size_bytes := read_exact(bytesio_in, 4):
+        block_size = int.from_bytes(
+            block_size_bytes,
+            byteorder="big", signed=False
+        )
+        encrypted_block = read_exact(bytesio_in, block_size)
+        if len(encrypted_block) != block_size:
+            raise AsymmetricFernetError("Encrypted stream is truncated.")
+        yield encrypted_block
+
+
+def _read_sealed_blocks(
+    bytesio_in: IO[bytes],
+    header_digest: bytes
+) -> Iterator[Tuple[bytes, bytes, bytes]]:
+    """Read v2 blocks up to the final one.
+
+    Args:
+        bytesio_in (IO[bytes]): readable stream positioned after the header
+        header_digest (bytes): SHA256 digest of the container header
+
+    Raises:
+        AsymmetricFernetError: stream is truncated
+
+    Yields:
+        Tuple[bytes, bytes, bytes]: associated data, nonce and cipher text
+    """
+    index = 0
+    final = False
+    while not final:
+        block_header = read_exact(bytesio_in, BLOCK_HEADER_SIZE)
+        if len(block_header) != BLOCK_HEADER_SIZE:
+            raise AsymmetricFernetError("Encrypted stream is truncated.")
+        nonce = block_header[:NONCE_SIZE]
+        final = bool(block_header[NONCE_SIZE] & FLAG_FINAL)
+        block_size = int.from_bytes(
+            block_header[NONCE_SIZE+1:], byteorder="big"
+        )
+        block_crypt = read_exact(bytesio_in, block_size)
+        if len(block_crypt) != block_size:
+            raise AsymmetricFernetError("Encrypted stream is truncated.")
+        yield _block_aad(header_digest, index, final), nonce, block_crypt
+        index += 1
+
+
+def _with_aad(
+    blocks: Iterable[bytes],
+    header_digest: bytes
+) -> Iterator[Tuple[bytes, bytes]]:
+    """Attach v2 associated data to plain text blocks.
+
+    Looks one block ahead to mark the final block. Empty streams consist of
+    one empty final block.
+
+    Args:
+        blocks (Iterable[bytes]): plain text blocks
+        header_digest (bytes): SHA256 digest of the container header
+
+    Yields:
+        Tuple[bytes, bytes]: associated data and plain text block
+    """
+    blocks = iter(blocks)
+    block = next(blocks, b"")
+    index = 0
+    for next_block in blocks:
+        yield _block_aad(header_digest, index, False), block
+        block = next_block
+        index += 1
+    yield _block_aad(header_digest, index, True), block
+
+
+def _pack_header(
+    key_encrypted: bytes,
+    metadata: Dict[str, Any]
+) -> bytes:
+    """Serialize v2 container header.
+
+    Args:
+        key_encrypted (bytes): RSA encrypted symmetric key
+        metadata (Dict[str, Any]): plain text container metadata
+
+    Returns:
+        bytes: header
+    """
+    metadata_bytes = json.dumps(metadata, sort_keys=True).encode()
+    return b"".join((
+        MAGIC,
+        struct.pack(">BI", 2, len(metadata_bytes)),
+        metadata_bytes,
+        struct.pack(">H", len(key_encrypted)),
+        key_encrypted
+    ))
+
+
+def new_stream_key(
     public_key: rsa.RSAPublicKey,
-    block_size: int = BLOCK_SIZE
-) -> None:
-    """Encrypt procedure.
+    block_size: int = BLOCK_SIZE,
+    metadata: Optional[Dict[str, Any]] = None
+) -> Tuple[bytes, bytes]:
+    """Generate symmetric key and header of a v2 container.
+
+    Callers keep both to continue an interrupted encryption later.
 
     Args:
-        file_path (Path): file to be encrypted
-        public_key (rsa.RSAPublicKey): public key to encrypt fernet key
+        public_key (rsa.RSAPublicKey): public key to encrypt symmetric key
         block_size (int, optional): Size of encryption blocks.
             Defaults to BLOCK_SIZE.
+        metadata (Optional[Dict[str, Any]], optional): Plain text metadata
+            stored in the header. Defaults to None.
+
+    Returns:
+        Tuple[bytes, bytes]: plain text key and header
     """
-    key = Fernet.generate_key()
-    fernet = Fernet(key)
+    key = AESGCM.generate_key(bit_length=256)
     key_encrypted = public_key.encrypt(
         plaintext=key,
         padding=PADDING
     )
-    with open(
-        file_path.with_suffix(
-            file_path.suffix + ".crypt"
-        ),
-        "wb"
-    ) as bytesio_out:
-        # first 512 bytes are the fernet key
-        bytesio_out.write(key_encrypted)
+    return key, _pack_header(
+        key_encrypted,
+        {
+            **(metadata or {}),
+            "cipher": "AES-256-GCM",
+            "block_size": block_size
+        }
+    )
 
-        with open(file_path, "rb") as bytesio_in:
-            while block := bytesio_in.read(block_size):
-                block_crypt = fernet.encrypt(block)
+
+def read_header(
+    bytesio_in: IO[bytes]
+) -> Tuple[int, Dict[str, Any], bytes, bytes]:
+    """Read container header and detect the container version.
+
+    v1 containers have no header. They start with the 512 byte RSA
+    encrypted fernet key directly.
+
+    Args:
+        bytesio_in (IO[bytes]): readable encrypted stream
+
+    Raises:
+        AsymmetricFernetError: unsupported version or truncated header
+
+    Returns:
+        Tuple[int, Dict[str, Any], bytes, bytes]: version, metadata, RSA
+            encrypted key and SHA256 digest of the header
+    """
+    start = read_exact(bytesio_in, len(MAGIC))
+    if start != MAGIC:
+        key_encrypted = start + read_exact(bytesio_in, 512 - len(start))
+        return 1, {}, key_encrypted, b""
+    version_bytes = read_exact(bytesio_in, 5)
+    if len(version_bytes) != 5:
+        raise AsymmetricFernetError("Encrypted stream is truncated.")
+    version, metadata_size = struct.unpack(">BI", version_bytes)
+    if version != 2:
+        raise AsymmetricFernetError(f"Unsupported version {version}.")
+    metadata_bytes = read_exact(bytesio_in, metadata_size)
+    key_size = struct.unpack(">H", read_exact(bytesio_in, 2))[0]
+    key_encrypted = read_exact(bytesio_in, key_size)
+    if len(metadata_bytes) != metadata_size or \
+            len(key_encrypted) != key_size:
+        raise AsymmetricFernetError("Encrypted stream is truncated.")
+    header = MAGIC + version_bytes + metadata_bytes + \
+        struct.pack(">H", key_size) + key_encrypted
+    return (
+        version,
+        json.loads(metadata_bytes),
+        key_encrypted,
+        sha256(header).digest()
+    )
+
+
+def encrypt_stream(
+    bytesio_in: IO[bytes],
+    public_key: rsa.RSAPublicKey,
+    block_size: int = BLOCK_SIZE,
+    workers: int = 1,
+    max_blocks_in_flight: Optional[int] = None,
+    version: int = VERSION,
+    metadata: Optional[Dict[str, Any]] = None,
+    stream_key: Optional[Tuple[bytes, bytes]] = None,
+    skip_blocks: int = 0,
+    executor: Optional[Executor] = None
+) -> Iterator[bytes]:
+    """Encrypt byte stream block by block.
+
+    Version 2 reads blocks into a pool of reused buffers for the blocks in
+    flight, the block looked ahead and the one being read. A buffer is
+    reused once its block is encrypted, by this process or a worker.
+
+    An interrupted encryption continues with the key and header of the
+    first run. The skipped blocks are read from the regenerated plain text
+    but neither encrypted nor yielded.
+
+    Args:
+        bytesio_in (IO[bytes]): readable plain text stream
+        public_key (rsa.RSAPublicKey): public key to encrypt symmetric key
+        block_size (int, optional): Size of encryption blocks.
+            Defaults to BLOCK_SIZE.
+        workers (int, optional): Number of processes encrypting blocks.
+            Defaults to 1.
+        max_blocks_in_flight (Optional[int], optional): Maximum number of
+            blocks held in memory by parallel encryption. Defaults to
+            BLOCKS_IN_FLIGHT_PER_WORKER per worker.
+        version (int, optional): Container version. Defaults to VERSION.
+        metadata (Optional[Dict[str, Any]], optional): Plain text metadata
+            stored in the header, e.g. the compression used. Requires
+            version 2. Defaults to None.
+        stream_key (Optional[Tuple[bytes, bytes]], optional): Key and
+            header from new_stream_key, which must use block_size.
+            Requires version 2. Defaults to a new key.
+        skip_blocks (int, optional): Number of leading blocks already
+            encrypted with stream_key. The header is only yielded if no
+            block is skipped. Defaults to 0.
+        executor (Optional[Executor], optional): Pool from
+            new_crypto_pool shared with other streams, which replaces the
+            processes of workers. Defaults to None.
+
+    Raises:
+        AsymmetricFernetError: unsupported version
+
+    Yields:
+        bytes: container header followed by encrypted blocks and, in
+            version 2, one item holding block index and footer
+    """
+    if version == 1 and (metadata or stream_key or skip_blocks):
+        raise AsymmetricFernetError(
+            "Version 1 does not support metadata or resuming."
+        )
+    if version == 1:
+        key = Fernet.generate_key()
+        key_encrypted = public_key.encrypt(
+            plaintext=key,
+            padding=PADDING
+        )
+    elif version == 2:
+        key, header = stream_key or \
+            new_stream_key(public_key, block_size, metadata)
+    else:
+        raise AsymmetricFernetError(f"Unsupported version {version}.")
+    if version == 1:
+        blocks: Iterator[Any] = _read_blocks(bytesio_in, block_size)
+    else:
+        if workers <= 1 and executor is None:
+            in_flight = 0
+        else:
+            in_flight = max_blocks_in_flight or \
+                BLOCKS_IN_FLIGHT_PER_WORKER*max(workers, 1)
+        # blocks in flight, the look ahead of _with_aad and the one read
+        pool = BufferPool(in_flight + 2, block_size)
+        taken: deque = deque()
+        blocks = _read_blocks_pooled(bytesio_in, pool, taken)
+
+        def release() -> None:
+            # empty streams consist of one block without buffer
+            if taken:
+                pool.put(taken.popleft())
+    with _block_mapper(
+        key, version, workers, max_blocks_in_flight, executor
+    ) as block_map:
+        if version == 1:
+            # first 512 bytes are the fernet key
+            yield key_encrypted
+            for block_crypt in block_map(_encrypt_block, blocks):
                 # 4 bytes block length
-                bytesio_out.write(
-                    int.to_bytes(
-                        len(block_crypt),
-                        length=4, byteorder="big", signed=False
-                    )
+                yield int.to_bytes(
+                    len(block_crypt),
+                    length=4, byteorder="big", signed=False
                 )
                 # encrypted block
-                bytesio_out.write(block_crypt)
+                yield block_crypt
+        else:
+            if not skip_blocks:
+                yield header
+            offset = len(header)
+            plain_size = 0
+            index = []
+            sealed = _with_aad(blocks, sha256(header).digest())
+            for _, block in islice(sealed, skip_blocks):
+                index.append(INDEX_ENTRY.pack(offset, plain_size))
+                offset += len(block) + BLOCK_HEADER_SIZE + TAG_SIZE
+                plain_size += len(block)
+                release()
+            for block_crypt in block_map(_seal_block, sealed):
+                # the worker is done with the plain text block
+                release()
+                index.append(INDEX_ENTRY.pack(offset, plain_size))
+                offset += len(block_crypt)
+                plain_size += len(block_crypt) - BLOCK_HEADER_SIZE - TAG_SIZE
+                yield block_crypt
+            yield b"".join(index) + \
+                FOOTER.pack(len(index), plain_size, INDEX_MAGIC)
+
+
+def open_decrypt_stream(
+    private_key: rsa.RSAPrivateKey,
+    bytesio_in: IO[bytes],
+    workers: int = 1,
+    max_blocks_in_flight: Optional[int] = None,
+    executor: Optional[Executor] = None
+) -> Tuple[Dict[str, Any], Iterator[bytes]]:
+    """Read container header and prepare block by block decryption.
+
+    The container version is detected from the stream.
+
+    Args:
+        private_key (rsa.RSAPrivateKey): Private key used for encryption.
+        bytesio_in (IO[bytes]): readable encrypted stream
+        workers (int, optional): Number of processes decrypting blocks.
+            Defaults to 1.
+        max_blocks_in_flight (Optional[int], optional): Maximum number of
+            blocks held in memory by parallel decryption. Defaults to
+            BLOCKS_IN_FLIGHT_PER_WORKER per worker.
+        executor (Optional[Executor], optional): Pool from
+            new_crypto_pool shared with other streams, which replaces the
+            processes of workers. Defaults to None.
+
+    Raises:
+        AsymmetricFernetError: stream is truncated or unsupported
+
+    Returns:
+        Tuple[Dict[str, Any], Iterator[bytes]]: container metadata and
+            decrypted blocks
+    """
+    version, metadata, key_encrypted, header_digest = \
+        read_header(bytesio_in)
+    key = private_key.decrypt(key_encrypted, PADDING)
+
+    def decrypt_blocks() -> Iterator[bytes]:
+        with _block_mapper(
+            key, version, workers, max_blocks_in_flight, executor
+        ) as block_map:
+            if version == 1:
+                yield from block_map(
+                    _decrypt_block, _read_tokens(bytesio_in)
+                )
+            else:
+                yield from block_map(
+                    _open_block,
+                    _read_sealed_blocks(bytesio_in, header_digest)
+                )
+
+    return metadata, decrypt_blocks()
+
+
+def decrypt_stream(
+    private_key: rsa.RSAPrivateKey,
+    bytesio_in: IO[bytes],
+    workers: int = 1,
+    max_blocks_in_flight: Optional[int] = None
+) -> Iterator[bytes]:
+    """Decrypt byte stream block by block.
+
+    The container version is detected from the stream.
+
+    Args:
+        private_key (rsa.RSAPrivateKey): Private key used for encryption.
+        bytesio_in (IO[bytes]): readable encrypted stream
+        workers (int, optional): Number of processes decrypting blocks.
+            Defaults to 1.
+        max_blocks_in_flight (Optional[int], optional): Maximum number of
+            blocks held in memory by parallel decryption. Defaults to
+            BLOCKS_IN_FLIGHT_PER_WORKER per worker.
+
+    Raises:
+        AsymmetricFernetError: stream is truncated or unsupported
+
+    Yields:
+        bytes: decrypted blocks
+    """
+    _, blocks = open_decrypt_stream(
+        private_key, bytesio_in, workers, max_blocks_in_flight
+    )
+    yield from blocks
+
+
+class SeekableDecryptor:
+    """Random access to the plain text of a v2 container.
+
+    Uses the block index at the end of the container to fetch only the
+    blocks covering a requested range. The ranges are read with a callable,
+    for example ranged GETs from AWSBucket.range_reader.
+    """
+
+    def __init__(
+        self,
+        private_key: rsa.RSAPrivateKey,
+        read_at: Callable[[int, int], bytes],
+        size: int
+    ) -> None:
+        """SeekableDecryptor constructor. Reads header and index.
+
+        Args:
+            private_key (rsa.RSAPrivateKey): Private key used for encryption.
+            read_at (Callable[[int, int], bytes]): read size bytes at offset
+            size (int): size of container in bytes
+
+        Raises:
+            AsymmetricFernetError: container is not seekable or corrupt
+        """
+        self._read_at = read_at
+        version, metadata, key_encrypted, self._header_digest = \
+            read_header(BytesIO(read_at(0, min(size, HEADER_PREFETCH))))
+        if version < 2 or size < FOOTER.size:
+            raise AsymmetricFernetError(
+                f"Version {version} containers are not seekable."
+            )
+        self.metadata = metadata
+        self.block_size: int = metadata["block_size"]
+        self._cipher = AESGCM(private_key.decrypt(key_encrypted, PADDING))
+
+        count, self.size, magic = FOOTER.unpack(
+            read_at(size - FOOTER.size, FOOTER.size)
+        )
+        self._index_start = size - FOOTER.size - count*INDEX_ENTRY.size
+        if magic != INDEX_MAGIC or self._index_start < 0:
+            raise AsymmetricFernetError("Container has no block index.")
+        index = read_at(self._index_start, count*INDEX_ENTRY.size)
+        self._offsets = []
+        for block, (offset, plain_offset) in enumerate(
+            INDEX_ENTRY.iter_unpack(index)
+        ):
+            # plain text offsets follow from the authenticated block size
+            if plain_offset != block*self.block_size:
+                raise AsymmetricFernetError("Block index is corrupt.")
+            self._offsets.append(offset)
+
+    def check(self) -> None:
+        """Check block index and authenticate first and last block.
+
+        Catches truncated and mixed up containers by a few small reads,
+        but not damaged blocks in between.
+
+        Raises:
+            AsymmetricFernetError: block index does not fit the container
+            cryptography.exceptions.InvalidTag: block is damaged
+        """
+        overhead = BLOCK_HEADER_SIZE + TAG_SIZE
+        ends = [*self._offsets[1:], self._index_start]
+        for block, (offset, end) in enumerate(zip(self._offsets, ends)):
+            expected = self.block_size if block < len(ends) - 1 else \
+                self.size - block*self.block_size
+            if end - offset != expected + overhead:
+                raise AsymmetricFernetError("Block index is corrupt.")
+        if not self._offsets:
+            raise AsymmetricFernetError("Container has no blocks.")
+        if self.size:
+            self.read(0, 1)
+            self.read(self.size - 1, 1)
+
+    def read(self, start: int, size: int) -> bytes:
+        """Read plain text range.
+
+        Args:
+            start (int): plain text offset
+            size (int): number of bytes, truncated at the end of data
+
+        Returns:
+            bytes: plain text
+        """
+        end = min(start + size, self.size)
+        if start >= end:
+            return b""
+        first = start // self.block_size
+        last = (end - 1) // self.block_size
+        cipher_start = self._offsets[first]
+        cipher_end = self._offsets[last + 1] \
+            if last + 1 < len(self._offsets) else self._index_start
+        data = memoryview(
+            self._read_at(cipher_start, cipher_end - cipher_start)
+        )
+        blocks = []
+        for block in range(first, last + 1):
+            offset = self._offsets[block] - cipher_start
+            block_header = data[offset:offset + BLOCK_HEADER_SIZE]
+            final = bool(block_header[NONCE_SIZE] & FLAG_FINAL)
+            if final != (block == len(self._offsets) - 1):
+                raise AsymmetricFernetError("Block index is corrupt.")
+            block_size = int.from_bytes(
+                block_header[NONCE_SIZE+1:], byteorder="big"
+            )
+            offset += BLOCK_HEADER_SIZE
+            blocks.append(_open_block(
+                (
+                    _block_aad(self._header_digest, block, final),
+                    bytes(block_header[:NONCE_SIZE]),
+                    bytes(data[offset:offset + block_size])
+                ),
+                self._cipher
+            ))
+        plain = b"".join(blocks)
+        offset = start - first*self.block_size
+        return plain[offset:offset + end - start]
+
+    def read_ranges(
+        self,
+        ranges: Iterable[Tuple[int, int]],
+        workers: int = 4
+    ) -> Iterator[bytes]:
+        """Read several plain text ranges concurrently.
+
+        Args:
+            ranges (Iterable[Tuple[int, int]]): offset and size per range
+            workers (int, optional): Number of concurrent reads.
+                Defaults to 4.
+
+        Yields:
+            bytes: plain text of ranges in order
+        """
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            yield from parallel_map(
+                executor, lambda item: self.read(*item), ranges, workers
+            )
+
+
+def encrypt(
+    file_path: Path,
+    public_key: rsa.RSAPublicKey,
+    block_size: int = BLOCK_SIZE,
+    workers: int = 1,
+    version: int = VERSION,
+    metadata: Optional[Dict[str, Any]] = None,
+    max_blocks_in_flight: Optional[int] = None
+) -> None:
+    """Encrypt procedure.
+
+    Args:
+        file_path (Path): file to be encrypted
+        public_key (rsa.RSAPublicKey): public key to encrypt symmetric key
+        block_size (int, optional): Size of encryption blocks.
+            Defaults to BLOCK_SIZE.
+        workers (int, optional): Number of processes encrypting blocks.
+            Defaults to 1.
+        version (int, optional): Container version. Defaults to VERSION.
+        metadata (Optional[Dict[str, Any]], optional): Plain text metadata
+            stored in the header. Requires version 2. Defaults to None.
+        max_blocks_in_flight (Optional[int], optional): Maximum number of
+            blocks held in memory by parallel encryption. Defaults to
+            BLOCKS_IN_FLIGHT_PER_WORKER per worker.
+    """
+    file_path_out = file_path.with_suffix(file_path.suffix + ".crypt")
+    with open(file_path_out, "wb") as bytesio_out:
+        with open(file_path, "rb") as bytesio_in:
+            for chunk in encrypt_stream(
+                bytesio_in, public_key, block_size, workers,
+                max_blocks_in_flight, version=version, metadata=metadata
+            ):
+                bytesio_out.write(chunk)
     logger.debug(
         "Successfully encrypted '%s'.",
+        file_path_out
     )
 
 
 def decrypt(
     private_key: rsa.RSAPrivateKey,
     file_path: Path,
-    file_path_out: Path = None
+    file_path_out: Path = None,
+    workers: int = 1,
+    max_blocks_in_flight: Optional[int] = None
 ):
     """Decrypt method.
 
@@ -142,6 +982,11 @@ def decrypt(
             Defaults to file_path without '.crypt' if that is the
             file extension. Otherwise file_path_out will be file_path
             with '.decrypt' extension.
+        workers (int, optional): Number of processes decrypting blocks.
+            Defaults to 1.
+        max_blocks_in_flight (Optional[int], optional): Maximum number of
+            blocks held in memory by parallel decryption. Defaults to
+            BLOCKS_IN_FLIGHT_PER_WORKER per worker.
     """
     # prepare output file name
     if file_path_out is None:
@@ -160,23 +1005,11 @@ def decrypt(
 
     # start decrypting
     with open(file_path, "rb") as bytesio_in:
-        fernet = Fernet(
-            private_key.decrypt(
-                bytesio_in.read(512),
-                PADDING
-            )
-        )
         with open(file_path_out, "wb") as bytesio_out:
-            while block_size := bytesio_in.read(4):
-                encrypted_block = bytesio_in.read(
-                    int.from_bytes(
-                        block_size,
-                        byteorder="big", signed=False
-                    )
-                )
-                bytesio_out.write(
-                    fernet.decrypt(encrypted_block)
-                )
+            for block in decrypt_stream(
+                private_key, bytesio_in, workers, max_blocks_in_flight
+            ):
+                bytesio_out.write(block)
     logger.debug(
         "Successfully decrypted '%s'",
         file_path_out
@@ -239,23 +1072,23 @@ def prompt_private_key(
         Optional[rsa.RSAPrivateKey]: private key
     """
     private_key = None
-    for ntry in range(3):
+    for _ in range(3):
+        tty = True
         try:
             password = getpass("Private Key Password:")
             password = password.encode() if password else None
-            try:
-                with open(priv_key_path, "rb") as bytesio:
-                    private_key = load_private_key(bytesio, password)
-                    break
-            except (ValueError, TypeError) as error:
-                logger.warning("Failed to load private key: %s", str(error))
-
         except EOFError:
-            if ntry == 0:
-                logger.warning("No tty. Loading private key without password.")
-                password = None
-            else:
-                # no need to try again if no tty exists
+            logger.warning("No tty. Loading private key without password.")
+            tty = False
+            password = None
+        try:
+            with open(priv_key_path, "rb") as bytesio:
+                private_key = load_private_key(bytesio, password)
                 break
+        except (ValueError, TypeError) as error:
+            logger.warning("Failed to load private key: %s", str(error))
+        if not tty:
+            # no need to try again if no tty exists
+            break
 
     return private_key
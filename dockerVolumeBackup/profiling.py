@@ -0,0 +1,166 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Profile runs per stage.
+
+The run is split into segments at stage boundaries, each profiled on its
+own by cProfile or, if installed, the sampling profiler pyinstrument. At
+every boundary tracemalloc takes a snapshot, so the allocations of a stage
+are the difference to the snapshot before it. Only the main thread is
+profiled. Encryption workers and transfer threads show up as waits.
+"""
+
+import cProfile
+import pstats
+import tracemalloc
+from importlib.util import find_spec
+from io import StringIO
+from logging import getLogger
+from pathlib import Path
+from typing import Any, List, NamedTuple, Optional
+
+PROFILERS = ("auto", "cprofile", "sampling")
+# frames recorded per allocation
+TRACEMALLOC_FRAMES = 16
+# allocation sites listed per stage
+TOP_ALLOCATIONS = 15
+logger = getLogger(__file__)
+
+
+class Segment(NamedTuple):
+    """Profile of the run between two stage boundaries."""
+
+    name: str
+    # cProfile.Profile or pyinstrument.Profiler
+    profile: Any
+    snapshot: tracemalloc.Snapshot
+    # bytes traced at the end and the peak during the segment
+    memory: int
+    peak_memory: int
+
+
+class Profiler:
+    """Profiles of the segments of a run."""
+
+    def __init__(self, kind: str = "auto") -> None:
+        """Profiler constructor.
+
+        Args:
+            kind (str, optional): "cprofile", "sampling" for pyinstrument or
+                "auto" for pyinstrument if installed. Defaults to "auto".
+
+        Raises:
+            ValueError: sampling requested but pyinstrument not installed
+        """
+        available = find_spec("pyinstrument") is not None
+        if kind == "sampling" and not available:
+            raise ValueError("Sampling profiles require pyinstrument.")
+        self.sampling = kind == "sampling" or kind == "auto" and available
+        self.segments: List[Segment] = []
+        self.written: Optional[Path] = None
+        self._name: Optional[str] = None
+        self._profile: Any = None
+
+    def _new_profile(self) -> Any:
+        """Create and start profiler of the backend.
+
+        Returns:
+            Any: running profiler
+        """
+        if self.sampling:
+            # pylint: disable=import-outside-toplevel
+            from pyinstrument import Profiler as SamplingProfiler
+            profile = SamplingProfiler()
+            profile.start()
+        else:
+            profile = cProfile.Profile()
+            profile.enable()
+        return profile
+
+    def start(self) -> None:
+        """Start profiling with the segment "start"."""
+        tracemalloc.start(TRACEMALLOC_FRAMES)
+        self._name = "start"
+        self._profile = self._new_profile()
+
+    def mark(self, name: str) -> None:
+        """End the current segment and start the next.
+
+        Args:
+            name (str): name of the next segment
+        """
+        if self._name is None:
+            return
+        self._end_segment()
+        self._name = name
+        self._profile = self._new_profile()
+
+    def _end_segment(self) -> None:
+        """Stop profiling the current segment and snapshot memory."""
+        if self.sampling:
+            self._profile.stop()
+        else:
+            self._profile.disable()
+        memory, peak_memory = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        self.segments.append(Segment(
+            f"{len(self.segments):02}-{self._name}", self._profile,
+            tracemalloc.take_snapshot(), memory, peak_memory
+        ))
+
+    def stop(self) -> None:
+        """Stop profiling. Does nothing if stopped."""
+        if self._name is None:
+            return
+        self._end_segment()
+        self._name = None
+        self._profile = None
+        tracemalloc.stop()
+
+    def write(self, directory: Path) -> None:
+        """Stop profiling and write profiles and memory snapshots.
+
+        cProfile segments are written as pstats files and combined into
+        run.prof, sampling segments as text and HTML. Every segment has a
+        tracemalloc snapshot, summarized in memory.txt.
+
+        Args:
+            directory (Path): output directory, created if missing
+        """
+        self.stop()
+        directory.mkdir(parents=True, exist_ok=True)
+        combined: Optional[pstats.Stats] = None
+        summary = StringIO()
+        previous: Optional[tracemalloc.Snapshot] = None
+        for segment in self.segments:
+            if self.sampling:
+                (directory/f"{segment.name}.txt").write_text(
+                    segment.profile.output_text(), encoding="utf-8"
+                )
+                (directory/f"{segment.name}.html").write_text(
+                    segment.profile.output_html(), encoding="utf-8"
+                )
+            else:
+                segment.profile.dump_stats(directory/f"{segment.name}.prof")
+                stats = pstats.Stats(segment.profile)
+                if combined is None:
+                    combined = stats
+                else:
+                    combined.add(stats)
+            segment.snapshot.dump(str(directory/f"{segment.name}.tracemalloc"))
+            summary.write(
+                f"{segment.name}: {segment.memory / 2**20:.1f} MiB traced, "
+                f"{segment.peak_memory / 2**20:.1f} MiB peak\n"
+            )
+            statistics = segment.snapshot.statistics("lineno") \
+                if previous is None \
+                else segment.snapshot.compare_to(previous, "lineno")
+            for statistic in statistics[:TOP_ALLOCATIONS]:
+                summary.write(f"    {statistic}\n")
+            previous = segment.snapshot
+        if combined is not None:
+            combined.dump_stats(directory/"run.prof")
+        (directory/"memory.txt").write_text(
+            summary.getvalue(), encoding="utf-8"
+        )
+        self.written = directory
+        logger.info("Wrote profiles to %s.", directory)
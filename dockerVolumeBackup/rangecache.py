@@ -0,0 +1,186 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Local cache of downloaded ranges of encrypted files.
+
+Repeated restores of the same backup, e.g. a verify followed by a restore
+or several partial restores, read ranges fetched before from disk instead
+of S3. Entries are keyed by bucket, file name, object version or ETag and
+range, so a newer upload of the file never hits older entries. Only
+ciphertext is stored. Every entry is checked against its SHA256 when read
+and dropped if it does not match. The least recently used entries are
+evicted once the cache exceeds its size.
+"""
+
+import json
+import os
+import sqlite3
+from hashlib import sha256
+from logging import getLogger
+from pathlib import Path
+from threading import Lock, get_ident
+from typing import Callable, Optional
+
+logger = getLogger(__file__)
+
+
+class RangeCache:
+    """Size limited LRU cache of file ranges on disk.
+
+    Thread safe. Processes may share the cache directory.
+    """
+
+    def __init__(self, root: Path, max_size: int) -> None:
+        """RangeCache constructor.
+
+        Args:
+            root (Path): cache directory, created if missing
+            max_size (int): maximum size of all entries in bytes
+        """
+        root.mkdir(parents=True, exist_ok=True)
+        self.root = root
+        self.max_size = max_size
+        # bytes read from the cache and from S3
+        self.hits = 0
+        self.misses = 0
+        self._lock = Lock()
+        # autocommit, so other processes see entries immediately
+        self._connection = sqlite3.connect(
+            root/"index.sqlite", isolation_level=None,
+            check_same_thread=False
+        )
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS ranges (key TEXT PRIMARY KEY, "
+            "size INTEGER, digest TEXT, used INTEGER)"
+        )
+
+    def _path(self, key: str) -> Path:
+        """File of an entry.
+
+        Args:
+            key (str): entry key
+
+        Returns:
+            Path: file in cache directory
+        """
+        return self.root/sha256(key.encode()).hexdigest()
+
+    def _drop(self, key: str) -> None:
+        """Remove entry.
+
+        Args:
+            key (str): entry key
+        """
+        with self._lock:
+            self._connection.execute(
+                "DELETE FROM ranges WHERE key = ?", (key,)
+            )
+        self._path(key).unlink(missing_ok=True)
+
+    def get(self, key: str) -> Optional[bytes]:
+        """Read entry and mark it as recently used.
+
+        Args:
+            key (str): entry key
+
+        Returns:
+            Optional[bytes]: data, None if missing or damaged
+        """
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT digest FROM ranges WHERE key = ?", (key,)
+            ).fetchone()
+        if row is None:
+            return None
+        try:
+            data = self._path(key).read_bytes()
+        except FileNotFoundError:
+            data = None
+        if data is None or sha256(data).hexdigest() != row[0]:
+            logger.warning("Dropping damaged cache entry %s.", key)
+            self._drop(key)
+            return None
+        with self._lock:
+            self._connection.execute(
+                "UPDATE ranges SET used = "
+                "(SELECT COALESCE(MAX(used), 0) + 1 FROM ranges) "
+                "WHERE key = ?", (key,)
+            )
+        return data
+
+    def put(self, key: str, data: bytes) -> None:
+        """Store entry, evicting least recently used ones.
+
+        Entries larger than the cache are not stored.
+
+        Args:
+            key (str): entry key
+            data (bytes): data
+        """
+        if len(data) > self.max_size:
+            return
+        path = self._path(key)
+        partial_path = path.with_name(
+            f"{path.name}.{os.getpid()}.{get_ident()}.partial"
+        )
+        partial_path.write_bytes(data)
+        partial_path.replace(path)
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO ranges VALUES (?, ?, ?, "
+                "(SELECT COALESCE(MAX(used), 0) + 1 FROM ranges))",
+                (key, len(data), sha256(data).hexdigest())
+            )
+            total = self._connection.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM ranges"
+            ).fetchone()[0]
+            evicted = []
+            for old_key, size in self._connection.execute(
+                "SELECT key, size FROM ranges ORDER BY used"
+            ).fetchall():
+                if total <= self.max_size:
+                    break
+                evicted.append(old_key)
+                total -= size
+            self._connection.executemany(
+                "DELETE FROM ranges WHERE key = ?",
+                ((old_key,) for old_key in evicted)
+            )
+        for old_key in evicted:
+            self._path(old_key).unlink(missing_ok=True)
+
+    def wrap(
+        self,
+        read_at: Callable[[int, int], bytes],
+        bucket: str,
+        file_name: str,
+        version: str
+    ) -> Callable[[int, int], bytes]:
+        """Serve reads of a pinned file version from the cache.
+
+        Args:
+            read_at (Callable[[int, int], bytes]): function reading size
+                bytes at offset from S3
+            bucket (str): bucket name
+            file_name (str): name of file in bucket
+            version (str): version id or ETag
+
+        Returns:
+            Callable[[int, int], bytes]: function reading size bytes at
+                offset, from the cache if present
+        """
+        def cached_read_at(offset: int, size: int) -> bytes:
+            if size <= 0:
+                return b""
+            key = json.dumps([bucket, file_name, version, offset, size])
+            data = self.get(key)
+            if data is not None:
+                with self._lock:
+                    self.hits += len(data)
+                return data
+            data = read_at(offset, size)
+            with self._lock:
+                self.misses += len(data)
+            self.put(key, data)
+            return data
+
+        return cached_read_at
@@ -0,0 +1,271 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Resume interrupted stream backups.
+
+Resumable backups are multipart uploads of whole encryption blocks. After
+each uploaded part a checkpoint records the upload id, the parts, the
+number of blocks they hold and the SHA256 of the plain text up to there. A
+resumed backup regenerates the plain text, compares its prefix with the
+checkpoint and encrypts and uploads only the remainder with the key of the
+first run.
+
+The checkpoint holds the plain text symmetric key of the unfinished
+backup. It is readable by its owner only and removed once the upload is
+complete.
+"""
+
+import json
+import os
+from hashlib import sha256
+from io import RawIOBase
+from logging import getLogger
+from pathlib import Path
+from typing import IO, Any, Dict, Optional
+
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+from .mycrypt import BLOCK_SIZE, encrypt_stream, new_stream_key
+from .storage import AWSBucket
+
+logger = getLogger(__file__)
+
+
+class ResumeError(Exception):
+    """Plain text differs from the interrupted backup."""
+
+
+class _PrefixHasher(RawIOBase):
+    """Readable stream hashing the plain text at block boundaries.
+
+    Reads stop at block boundaries, where the digest of everything read so
+    far is recorded. At the boundary of the checkpoint the digest must match
+    the checkpoint.
+    """
+
+    def __init__(
+        self,
+        bytesio: IO[bytes],
+        block_size: int,
+        skip_blocks: int,
+        digest: str
+    ) -> None:
+        """_PrefixHasher constructor.
+
+        Args:
+            bytesio (IO[bytes]): plain text stream
+            block_size (int): size of encryption blocks
+            skip_blocks (int): number of blocks uploaded before
+            digest (str): SHA256 of these blocks
+        """
+        super().__init__()
+        self._bytesio = bytesio
+        self._block_size = block_size
+        self._skip_blocks = skip_blocks
+        self._hash = sha256()
+        self._blocks = 0
+        self._block_filled = 0
+        self._eof = False
+        self.digests: Dict[int, str] = {skip_blocks: digest}
+
+    def readable(self) -> bool:
+        """Stream is readable.
+
+        Returns:
+            bool: always True
+        """
+        return True
+
+    def _end_block(self) -> None:
+        """Record digest at block boundary.
+
+        Raises:
+            ResumeError: prefix does not match checkpoint
+        """
+        self._blocks += 1
+        self._block_filled = 0
+        digest = self._hash.hexdigest()
+        if self._blocks == self._skip_blocks and \
+                digest != self.digests[self._skip_blocks]:
+            raise ResumeError("Data changed since the interrupted backup.")
+        if self._blocks > self._skip_blocks:
+            self.digests[self._blocks] = digest
+
+    def readinto(self, buffer: memoryview) -> int:
+        """Read up to the next block boundary.
+
+        Args:
+            buffer (memoryview): destination buffer
+
+        Raises:
+            ResumeError: data differs from or is shorter than the prefix
+                uploaded before
+
+        Returns:
+            int: number of bytes read, 0 on end of stream
+        """
+        if self._eof:
+            return 0
+        size = min(len(buffer), self._block_size - self._block_filled)
+        data = self._bytesio.read(size)
+        if not data:
+            self._eof = True
+            # the final block may be short or, in empty streams, empty
+            if self._block_filled or not self._blocks:
+                self._end_block()
+            if self._blocks < self._skip_blocks:
+                raise ResumeError(
+                    "Data ended before the end of the interrupted backup."
+                )
+            return 0
+        buffer[:len(data)] = data
+        self._hash.update(data)
+        self._block_filled += len(data)
+        if self._block_filled == self._block_size:
+            self._end_block()
+        return len(data)
+
+
+def _save_checkpoint(path: Path, checkpoint: Dict[str, Any]) -> None:
+    """Replace checkpoint atomically, readable by the owner only.
+
+    Args:
+        path (Path): checkpoint file
+        checkpoint (Dict[str, Any]): progress of the upload
+    """
+    partial_path = path.with_name(path.name + ".partial")
+    descriptor = os.open(
+        partial_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600
+    )
+    with open(descriptor, "w", encoding="utf-8") as textio:
+        json.dump(checkpoint, textio)
+    partial_path.replace(path)
+
+
+def _load_checkpoint(
+    aws: AWSBucket,
+    path: Path,
+    name: str,
+    metadata: Dict[str, Any]
+) -> Optional[Dict[str, Any]]:
+    """Load checkpoint of an interrupted upload of the same backup.
+
+    Checkpoints of other backups and of uploads no longer in the bucket
+    are discarded.
+
+    Args:
+        aws (AWSBucket): bucket connector
+        path (Path): checkpoint file
+        name (str): name of file in bucket
+        metadata (Dict[str, Any]): container metadata of the backup
+
+    Returns:
+        Optional[Dict[str, Any]]: checkpoint, None to start over
+    """
+    if not path.exists():
+        return None
+    try:
+        checkpoint = json.loads(path.read_text(encoding="utf-8"))
+    except ValueError:
+        logger.warning("Ignoring unreadable checkpoint %s.", path)
+        return None
+    if checkpoint["name"] == name and checkpoint["metadata"] == metadata:
+        parts = aws.list_parts(name, checkpoint["upload_id"])
+        if parts is not None and all(
+            parts.get(part["PartNumber"]) == part["ETag"]
+            for part in checkpoint["parts"]
+        ):
+            return checkpoint
+    logger.warning("Discarding checkpoint of another upload.")
+    aws.abort_multipart_upload(checkpoint["name"], checkpoint["upload_id"])
+    return None
+
+
+def upload_resumable(
+    aws: AWSBucket,
+    bytesio_in: IO[bytes],
+    name: str,
+    public_key: rsa.RSAPublicKey,
+    checkpoint_path: Path,
+    workers: int = 1,
+    metadata: Optional[Dict[str, Any]] = None,
+    max_blocks_in_flight: Optional[int] = None
+) -> None:
+    """Encrypt and upload stream, continuing an interrupted upload.
+
+    Args:
+        aws (AWSBucket): bucket connector
+        bytesio_in (IO[bytes]): readable plain text stream, regenerated
+            identically when resuming
+        name (str): name of file in bucket
+        public_key (rsa.RSAPublicKey): public key to encrypt symmetric key
+        checkpoint_path (Path): progress of the upload, kept on failure
+        workers (int, optional): Number of encryption processes.
+            Defaults to 1.
+        metadata (Optional[Dict[str, Any]], optional): Plain text metadata
+            stored in the header. Defaults to None.
+        max_blocks_in_flight (Optional[int], optional): Maximum number of
+            blocks held in memory by parallel encryption. Defaults to
+            BLOCKS_IN_FLIGHT_PER_WORKER per worker.
+
+    Raises:
+        ResumeError: plain text differs from the interrupted backup. The
+            checkpoint and the upload are discarded, so a retry starts
+            over.
+    """
+    metadata = metadata or {}
+    checkpoint = _load_checkpoint(aws, checkpoint_path, name, metadata)
+    if checkpoint is None:
+        key, header = new_stream_key(public_key, BLOCK_SIZE, metadata)
+        checkpoint = {
+            "name": name,
+            "metadata": metadata,
+            "upload_id": aws.create_multipart_upload(name),
+            "key": key.hex(),
+            "header": header.hex(),
+            "parts": [],
+            "blocks": 0,
+            "digest": sha256().hexdigest()
+        }
+        _save_checkpoint(checkpoint_path, checkpoint)
+    else:
+        logger.info(
+            "Resuming upload after %d parts.", len(checkpoint["parts"])
+        )
+
+    skip_blocks = checkpoint["blocks"]
+    hasher = _PrefixHasher(
+        bytesio_in, BLOCK_SIZE, skip_blocks, checkpoint["digest"]
+    )
+    chunks = encrypt_stream(
+        hasher, public_key, workers=workers,
+        max_blocks_in_flight=max_blocks_in_flight,
+        stream_key=(
+            bytes.fromhex(checkpoint["key"]),
+            bytes.fromhex(checkpoint["header"])
+        ),
+        skip_blocks=skip_blocks
+    )
+    # the first chunk of a new upload is the header
+    header_chunks = 0 if skip_blocks else 1
+    parts = checkpoint["parts"]
+    try:
+        for part, count, last in aws.upload_parts(
+            chunks, name, checkpoint["upload_id"], len(parts) + 1
+        ):
+            parts.append(part)
+            if last:
+                break
+            # the last part holds the block index, so others end on blocks
+            blocks = skip_blocks + count - header_chunks
+            checkpoint.update(
+                parts=parts, blocks=blocks, digest=hasher.digests[blocks]
+            )
+            _save_checkpoint(checkpoint_path, checkpoint)
+            for done in [done for done in hasher.digests if done < blocks]:
+                del hasher.digests[done]
+    except ResumeError:
+        aws.abort_multipart_upload(name, checkpoint["upload_id"])
+        checkpoint_path.unlink()
+        raise
+    aws.complete_multipart_upload(name, checkpoint["upload_id"], parts)
+    checkpoint_path.unlink()
@@ -0,0 +1,333 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Sharded backups packed, uploaded and restored by parallel pipelines.
+
+The files of a volume are split into shards of roughly equal size. Each
+shard is an archive of its own, compressed by its tar process, encrypted
+and uploaded concurrently with the others. Directories are packed into an
+extra archive, which is unpacked after all shards so their permissions and
+times are set last. A manifest stored as encrypted document lists the
+archives.
+"""
+
+import heapq
+from concurrent.futures import Executor, ThreadPoolExecutor
+from contextlib import nullcontext
+from io import BufferedReader
+from logging import getLogger
+from pathlib import Path
+from shutil import copyfileobj
+from threading import Event
+from typing import \
+    IO, Any, Callable, ContextManager, Dict, Iterator, List, Optional, Tuple
+
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+from .compression import DEFAULT_CODEC, tar_options
+from .extract import open_extractor
+from .documents import SHARDS_SUFFIX, upload_document
+from .incremental import \
+    FILE_INODE, FILE_SIZE, FILE_TYPE, scan_tree, tree_size
+from .mycrypt import \
+    BLOCKS_IN_FLIGHT_PER_WORKER, encrypt_stream, new_crypto_pool, \
+    open_decrypt_stream
+from .storage import AWSBucket
+from .streams import IteratorReader
+from .tar import pack_files_stream
+from .throttle import TokenBucket
+
+# name of each archive, appended to the backup name
+SHARD_SUFFIX = ".shard{:04d}"
+# tar header of each member, which makes many small files count
+MEMBER_OVERHEAD = 512
+logger = getLogger(__file__)
+
+
+class ShardError(Exception):
+    """Another shard of the same backup or restore failed."""
+
+
+def partition_tree(
+    files: Dict[str, List[Any]],
+    count: int
+) -> Tuple[List[List[str]], List[str]]:
+    """Split files into shards of roughly equal size.
+
+    Hard links of a file stay in one shard, so tar stores the content once
+    and restores the links. Groups are assigned largest first to the
+    smallest shard.
+
+    Args:
+        files (Dict[str, List[Any]]): manifest from scan_tree
+        count (int): maximum number of shards
+
+    Returns:
+        Tuple[List[List[str]], List[str]]: sorted paths of each non-empty
+            shard and sorted directories
+    """
+    groups: Dict[Any, List[str]] = {}
+    directories = []
+    for path, fields in files.items():
+        if fields[FILE_TYPE] == "d":
+            directories.append(path)
+        elif fields[FILE_TYPE] == "f":
+            groups.setdefault(fields[FILE_INODE], []).append(path)
+        else:
+            groups[path] = [path]
+    weighted = sorted(
+        (
+            (
+                (files[paths[0]][FILE_TYPE] == "f")*files[paths[0]][FILE_SIZE]
+                + MEMBER_OVERHEAD*len(paths),
+                paths
+            )
+            for paths in groups.values()
+        ),
+        reverse=True
+    )
+    shards: List[List[str]] = [[] for _ in range(max(count, 1))]
+    loads = [(0, index) for index in range(len(shards))]
+    for weight, paths in weighted:
+        load, index = heapq.heappop(loads)
+        shards[index].extend(paths)
+        heapq.heappush(loads, (load + weight, index))
+    return [sorted(shard) for shard in shards if shard], sorted(directories)
+
+
+def _run_all(tasks: List[Callable[[Event], None]], failed: Event) -> None:
+    """Run tasks concurrently, telling the others when one fails.
+
+    Args:
+        tasks (List[Callable[[Event], None]]): tasks, which stop soon once
+            the event is set
+        failed (Event): set on the first failure
+
+    Raises:
+        BaseException: error of the task which failed first
+    """
+    def run(task: Callable[[Event], None]) -> None:
+        try:
+            task(failed)
+        except BaseException:
+            failed.set()
+            raise
+
+    with ThreadPoolExecutor(max_workers=max(1, len(tasks))) as executor:
+        futures = [executor.submit(run, task) for task in tasks]
+    errors = [
+        future.exception() for future in futures
+        if future.exception() is not None
+    ]
+    # raise the cause rather than the tasks stopped because of it
+    causes = [
+        error for error in errors if not isinstance(error, ShardError)
+    ]
+    if causes or errors:
+        raise (causes or errors)[0]
+
+
+def _crypto_pool(workers: int) -> ContextManager[Optional[Executor]]:
+    """Open process pool shared by the shards.
+
+    Args:
+        workers (int): number of encryption or decryption processes
+
+    Returns:
+        ContextManager[Optional[Executor]]: pool, None to encrypt in the
+            thread of each shard
+    """
+    return new_crypto_pool(workers) if workers > 1 else nullcontext()
+
+
+def _until_failed(chunks: Iterator[bytes], failed: Event) -> Iterator[bytes]:
+    """Pass chunks through until another shard failed.
+
+    Args:
+        chunks (Iterator[bytes]): chunks
+        failed (Event): set when another shard failed
+
+    Raises:
+        ShardError: another shard failed
+
+    Yields:
+        bytes: chunks
+    """
+    for chunk in chunks:
+        if failed.is_set():
+            raise ShardError("Another shard failed.")
+        yield chunk
+
+
+def backup_sharded(
+    aws: AWSBucket,
+    root: Path,
+    name: str,
+    public_key: rsa.RSAPublicKey,
+    shards: int,
+    workers: int = 1,
+    codec: str = DEFAULT_CODEC,
+    level: Optional[int] = None,
+    max_blocks_in_flight: Optional[int] = None,
+    count: Optional[Callable[[IO[bytes]], IO[bytes]]] = None,
+    threads: Optional[int] = None,
+    read_limit: Optional[TokenBucket] = None,
+    files: Optional[Dict[str, List[Any]]] = None
+) -> List[str]:
+    """Pack, encrypt and upload shards of root concurrently.
+
+    If a shard fails, the uploads of the others are aborted and no
+    manifest is written.
+
+    Args:
+        aws (AWSBucket): bucket connector
+        root (Path): directory to back up
+        name (str): name of backup in bucket
+        public_key (rsa.RSAPublicKey): public key to encrypt shards
+        shards (int): maximum number of shards
+        workers (int, optional): Number of encryption processes in one
+            pool shared by the shards. Defaults to 1.
+        codec (str, optional): Codec name. Defaults to DEFAULT_CODEC.
+        level (Optional[int], optional): Compression level.
+            Defaults to the codec's default level.
+        max_blocks_in_flight (Optional[int], optional): Maximum number of
+            blocks being encrypted per shard. Defaults to
+            BLOCKS_IN_FLIGHT_PER_WORKER per worker of the shard's share.
+        count (Optional[Callable[[IO[bytes]], IO[bytes]]], optional):
+            Wraps each compressed archive, e.g. to count its bytes.
+            Called from several threads. Defaults to None.
+        threads (Optional[int], optional): Number of compressor threads
+            shared by the shards. Defaults to all cores per shard.
+        read_limit (Optional[TokenBucket], optional): Rate limit shared by
+            the archive streams. Defaults to unlimited.
+        files (Optional[Dict[str, List[Any]]], optional): Manifest of root
+            from scan_tree. Defaults to scanning root.
+
+    Returns:
+        List[str]: names of the uploaded files in bucket, manifest first
+    """
+    if files is None:
+        logger.info("Scanning files.")
+        files = scan_tree(root)
+    parts, directories = partition_tree(files, shards)
+    logger.info(
+        "Packing %d files in %d shards.",
+        len(files) - len(directories), len(parts)
+    )
+    # the volume root is packed with the directories, which come last
+    paths_of = [
+        *([root/path for path in paths] for paths in parts),
+        [root, *(root/path for path in directories)]
+    ]
+    archives = [
+        {
+            "name": name + SHARD_SUFFIX.format(index),
+            "files": len(paths_of[index]),
+            # links of a file are in the same shard
+            "size": tree_size({path: files[path] for path in paths})
+        }
+        for index, paths in enumerate([*parts, directories])
+    ]
+
+    if max_blocks_in_flight is None:
+        # the shards share the workers
+        max_blocks_in_flight = \
+            BLOCKS_IN_FLIGHT_PER_WORKER*max(1, -(-workers // len(archives)))
+
+    def upload(
+        archive: Dict[str, Any],
+        paths: List[Path],
+        executor: Optional[Executor]
+    ) -> Callable[[Event], None]:
+        def task(failed: Event) -> None:
+            with pack_files_stream(
+                paths,
+                tar_options(
+                    codec, level, threads=None if threads is None
+                    else max(1, threads // len(archives))
+                ),
+                read_limit
+            ) as bytesio:
+                aws.upload_stream(
+                    IteratorReader(_until_failed(encrypt_stream(
+                        count(bytesio) if count else bytesio, public_key,
+                        workers=workers,
+                        max_blocks_in_flight=max_blocks_in_flight,
+                        metadata={"compression": codec}, executor=executor
+                    ), failed)),
+                    archive["name"]
+                )
+        return task
+
+    with _crypto_pool(workers) as executor:
+        _run_all([
+            upload(archive, paths, executor)
+            for archive, paths in zip(archives, paths_of)
+        ], Event())
+    upload_document(
+        aws, name + SHARDS_SUFFIX, {"shards": archives}, public_key
+    )
+    return [name + SHARDS_SUFFIX, *(archive["name"] for archive in archives)]
+
+
+def restore_sharded(
+    aws: AWSBucket,
+    manifest: Dict[str, Any],
+    private_key: rsa.RSAPrivateKey,
+    workers: int = 1,
+    max_blocks_in_flight: Optional[int] = None,
+    count: Optional[Callable[[IO[bytes]], IO[bytes]]] = None,
+    writers: int = 1
+) -> None:
+    """Download, decrypt and unpack shards concurrently.
+
+    Archives contain paths below the volume, so they are unpacked into the
+    working directory like full backups. The directory archive follows
+    once all shards are unpacked.
+
+    Args:
+        aws (AWSBucket): bucket connector
+        manifest (Dict[str, Any]): manifest of the backup
+        private_key (rsa.RSAPrivateKey): Private key used for encryption.
+        workers (int, optional): Number of decryption processes in one
+            pool shared by the shards. Defaults to 1.
+        max_blocks_in_flight (Optional[int], optional): Maximum number of
+            blocks being decrypted per shard. Defaults to
+            BLOCKS_IN_FLIGHT_PER_WORKER per worker of the shard's share.
+        count (Optional[Callable[[IO[bytes]], IO[bytes]]], optional):
+            Wraps each downloaded archive, e.g. to count its bytes.
+            Called from several threads. Defaults to None.
+        writers (int, optional): Number of threads writing the files of
+            each shard, 1 to unpack with tar. Defaults to 1.
+    """
+    *shards, directories = manifest["shards"]
+    if max_blocks_in_flight is None:
+        # the shards share the workers
+        max_blocks_in_flight = BLOCKS_IN_FLIGHT_PER_WORKER*max(
+            1, -(-workers // max(1, len(shards)))
+        )
+
+    def unpack(
+        shard: Dict[str, Any],
+        executor: Optional[Executor]
+    ) -> Callable[[Event], None]:
+        def task(failed: Event) -> None:
+            bytesio = aws.download_stream(shard["name"])
+            metadata, blocks = open_decrypt_stream(
+                private_key, count(bytesio) if count else bytesio,
+                workers, max_blocks_in_flight, executor
+            )
+            with open_extractor(metadata["compression"], writers) \
+                    as archive:
+                copyfileobj(
+                    BufferedReader(IteratorReader(
+                        _until_failed(blocks, failed)
+                    )),
+                    archive
+                )
+        return task
+
+    with _crypto_pool(workers) as executor:
+        logger.info("Restoring %d shards.", len(shards))
+        _run_all([unpack(shard, executor) for shard in shards], Event())
+        logger.info("Restoring directories.")
+        unpack(directories, executor)(Event())
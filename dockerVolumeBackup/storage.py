@@ -2,9 +2,246 @@
 # -*- coding: utf-8 -*-
 """Storage connector classes."""
 # Created on Fri Jan 28 2022 by Merlin Mittelbach.
+import json
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from configparser import ConfigParser
+from datetime import datetime
+from hashlib import sha256
+from io import BufferedReader
+from logging import getLogger
 from pathlib import Path
+from typing import \
+    IO, Any, Callable, Collection, Dict, Iterable, Iterator, List, \
+    NamedTuple, Optional, Tuple, Union
 
 from boto3 import Session
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from botocore.exceptions import ClientError
+
+from .rangecache import RangeCache
+from .streams import \
+    BufferPool, IteratorReader, parallel_map, readinto_exact
+from .throttle import IONICE_CLASSES, TokenBucket, parse_hours, rate_limit
+
+MiB = 2**20
+# S3 allows 10000 parts per object.
+MAX_PARTS = 10000
+# S3 deletes at most 1000 objects per request.
+DELETE_BATCH_SIZE = 1000
+# Connections of the shared client, botocore's default.
+MAX_POOL_CONNECTIONS = 10
+# environment variables overriding transfer settings, e.g.
+# AWS_BACKUP_PART_SIZE=128
+ENV_PREFIX = "AWS_BACKUP_"
+# section of transfer settings in the config file
+CONFIG_SECTION = "transfer"
+CHECKSUM_ALGORITHMS = ("CRC32", "CRC32C", "SHA1", "SHA256")
+CHECKSUM_MODES = ("when_supported", "when_required")
+logger = getLogger(__file__)
+
+
+class TransferSettings(NamedTuple):
+    """Tuning of S3 transfers."""
+
+    # Size of multipart upload parts. Streams have unknown size, so parts
+    # must be large enough for the biggest volume: 10000 * 64 MiB = 625 GiB.
+    # Files use larger parts if needed.
+    part_size: int = 64*MiB
+    # Concurrent requests per transfer. Uploaded streams hold as many parts
+    # in memory, downloaded streams as many ranges.
+    max_concurrency: int = 4
+    # Connections of the shared client. Defaults to max_concurrency but at
+    # least MAX_POOL_CONNECTIONS.
+    max_pool_connections: Optional[int] = None
+    # Size of ranged GETs of downloaded streams and files.
+    range_size: int = 8*MiB
+    # Additional checksum stored with uploads and validated on downloads,
+    # one of CHECKSUM_ALGORITHMS. None keeps the SDK default.
+    checksum_algorithm: Optional[str] = None
+    # When the SDK calculates and validates checksums, one of
+    # CHECKSUM_MODES. None keeps the SDK default.
+    checksums: Optional[str] = None
+    # Memory for buffers of streaming pipelines, None for unlimited. The
+    # buffers of each stage are sized to fit, see plan_memory.
+    max_memory: Optional[int] = None
+    # Alternative S3 endpoint, e.g. MinIO or moto server.
+    endpoint_url: Optional[str] = None
+    # Check bucket and credentials with a HEAD request on connect. Skipping
+    # it saves a round trip, errors surface on the first transfer instead.
+    preflight: bool = True
+    # Size of the local cache of downloaded ranges, None for no cache.
+    # Repeated restores of a backup read cached ranges from disk.
+    cache_size: Optional[int] = None
+    # Bandwidth of uploads and downloads and read rate of tar in bytes per
+    # second, None for unlimited.
+    upload_limit: Optional[int] = None
+    download_limit: Optional[int] = None
+    read_limit: Optional[int] = None
+    # Cores for encryption workers and compressor threads, None for all.
+    cpu_limit: Optional[int] = None
+    # Niceness and I/O scheduling class of this process and its children,
+    # None to keep them.
+    nice: Optional[int] = None
+    ionice: Optional[str] = None
+    # Hours of the day like "08:00-20:00" the limits above apply, None for
+    # always. Bandwidth and read limits apply while the hours last, CPU
+    # limits and priorities are set for the whole run when it starts.
+    throttle_hours: Optional[str] = None
+
+
+def _parse_size(value: Any) -> int:
+    """Parse size in MiB.
+
+    Args:
+        value (Any): number or string
+
+    Returns:
+        int: size in bytes
+    """
+    return int(float(value)*MiB)
+
+
+def _parse_bool(value: Any) -> bool:
+    """Parse boolean.
+
+    Args:
+        value (Any): bool or string like "yes", "off" or "1"
+
+    Raises:
+        ValueError: value is no boolean
+
+    Returns:
+        bool: value
+    """
+    if isinstance(value, bool):
+        return value
+    if str(value).lower() in ("1", "yes", "true", "on"):
+        return True
+    if str(value).lower() in ("0", "no", "false", "off"):
+        return False
+    raise ValueError(f"Expected a boolean, got {value}.")
+
+
+def _parse_choice(choices: Tuple[str, ...]) -> Callable[[Any], str]:
+    """Create parser accepting one of choices.
+
+    Args:
+        choices (Tuple[str, ...]): valid values
+
+    Returns:
+        Callable[[Any], str]: parser raising ValueError on other values
+    """
+    def parse(value: Any) -> str:
+        for choice in choices:
+            if str(value).lower() == choice.lower():
+                return choice
+        raise ValueError(f"Expected one of {', '.join(choices)}.")
+    return parse
+
+
+SETTING_PARSERS: Dict[str, Callable[[Any], Any]] = {
+    "part_size": _parse_size,
+    "max_concurrency": int,
+    "max_pool_connections": int,
+    "range_size": _parse_size,
+    "max_memory": _parse_size,
+    "checksum_algorithm": _parse_choice(CHECKSUM_ALGORITHMS),
+    "checksums": _parse_choice(CHECKSUM_MODES),
+    "endpoint_url": str,
+    "preflight": _parse_bool,
+    "cache_size": _parse_size,
+    "upload_limit": _parse_size,
+    "download_limit": _parse_size,
+    "read_limit": _parse_size,
+    "cpu_limit": int,
+    "nice": int,
+    "ionice": _parse_choice(tuple(IONICE_CLASSES)),
+    "throttle_hours": parse_hours,
+}
+
+
+def load_transfer_settings(
+    config_path: Optional[Path] = None,
+    overrides: Optional[Dict[str, Any]] = None
+) -> TransferSettings:
+    """Load transfer settings.
+
+    Later sources take precedence: defaults, the [transfer] section of the
+    config file, environment variables and overrides, e.g. CLI options.
+    Sizes are given in MiB.
+
+    Args:
+        config_path (Optional[Path], optional): INI file, may not exist.
+            Defaults to None.
+        overrides (Optional[Dict[str, Any]], optional): Settings by field
+            name, None values and other keys are ignored. Defaults to None.
+
+    Raises:
+        ValueError: invalid setting
+
+    Returns:
+        TransferSettings: settings
+    """
+    values: Dict[str, Any] = {}
+    if config_path is not None:
+        parser = ConfigParser()
+        parser.read(config_path)
+        if parser.has_section(CONFIG_SECTION):
+            values.update(parser[CONFIG_SECTION])
+    for field in TransferSettings._fields:
+        if ENV_PREFIX + field.upper() in os.environ:
+            values[field] = os.environ[ENV_PREFIX + field.upper()]
+    values.update(
+        (field, value)
+        for field, value in (overrides or {}).items()
+        if field in TransferSettings._fields and value is not None
+    )
+    settings = {}
+    for field, value in values.items():
+        if field not in SETTING_PARSERS:
+            raise ValueError(f"Unknown transfer setting {field}.")
+        try:
+            settings[field] = SETTING_PARSERS[field](value)
+        except ValueError as error:
+            raise ValueError(f"Transfer setting {field}: {error}") from error
+    return TransferSettings(**settings)
+
+
+def _group_chunks(
+    chunks: Iterable[bytes],
+    part_size: int
+) -> Iterator[Tuple[bytes, int, bool]]:
+    """Join chunks to parts of at least part_size bytes.
+
+    Looks one chunk ahead, so the last part always holds the last chunk.
+
+    Args:
+        chunks (Iterable[bytes]): data
+        part_size (int): minimum size of all but the last part
+
+    Yields:
+        Tuple[bytes, int, bool]: part, number of chunks consumed so far and
+            whether it is the last part, which is empty without chunks
+    """
+    chunks = iter(chunks)
+    buffer: List[bytes] = []
+    size = 0
+    count = 0
+    chunk = next(chunks, None)
+    if chunk is None:
+        yield b"", 0, True
+    while chunk is not None:
+        buffer.append(chunk)
+        size += len(chunk)
+        count += 1
+        chunk = next(chunks, None)
+        if chunk is None or size >= part_size:
+            yield b"".join(buffer), count, chunk is None
+            buffer = []
+            size = 0
 
 
 class AWSBucket:
@@ -12,44 +249,753 @@ class AWSBucket:
 
     session: Session
     bucket: str
+    settings: TransferSettings
+    # clients are thread safe, sessions are not
+    client: Any
+    # part buffers of the last streamed upload
+    buffers: Optional[BufferPool] = None
+    # downloaded ranges, see cache_size
+    cache: Optional[RangeCache] = None
+    # bandwidth limits shared by all transfers, see upload_limit
+    upload_rate: Optional[TokenBucket]
+    download_rate: Optional[TokenBucket]
 
-    def __init__(self, bucket: str) -> None:
+    def __init__(
+        self,
+        bucket: str,
+        settings: TransferSettings = TransferSettings()
+    ) -> None:
         """AWSBucket constructor.
 
         Args:
             bucket (str): name of bucket
+            settings (TransferSettings, optional): Tuning of transfers.
+                Defaults to TransferSettings().
         """
         self.session = Session()
         self.bucket = bucket
-        self._test_credentials()
+        self.settings = settings
+        self.upload_rate = rate_limit(
+            settings.upload_limit, settings.throttle_hours
+        )
+        self.download_rate = rate_limit(
+            settings.download_limit, settings.throttle_hours
+        )
+        checksums = {
+            "request_checksum_calculation": settings.checksums,
+            "response_checksum_validation": settings.checksums
+        } if settings.checksums else {}
+        self.client = self.session.client(
+            "s3",
+            endpoint_url=settings.endpoint_url,
+            config=Config(
+                max_pool_connections=settings.max_pool_connections or max(
+                    settings.max_concurrency, MAX_POOL_CONNECTIONS
+                ),
+                **checksums
+            )
+        )
+        if settings.preflight:
+            self._test_credentials()
 
     def _test_credentials(self) -> None:
-        """Test credentials by listing bucket."""
-        s3_client = self.session.client("s3")
-        s3_client.list_objects_v2(Bucket=self.bucket)
+        """Test credentials and bucket with a single HEAD request.
+
+        Unlike a listing, this does not depend on the number of objects and
+        needs no ListBucket permission.
+        """
+        self.client.head_bucket(Bucket=self.bucket)
+
+    def _transfer_config(self, part_size: int) -> TransferConfig:
+        """Transfer config of managed up- and downloads.
+
+        Args:
+            part_size (int): size of parts or ranges
+
+        Returns:
+            TransferConfig: config
+        """
+        config = TransferConfig(
+            multipart_threshold=part_size,
+            multipart_chunksize=part_size,
+            max_concurrency=self.settings.max_concurrency
+        )
+        config.max_in_memory_upload_chunks = self.settings.max_concurrency
+        return config
+
+    def _upload_args(self) -> Dict[str, str]:
+        """Extra arguments of uploads.
+
+        Returns:
+            Dict[str, str]: checksum algorithm if configured
+        """
+        if self.settings.checksum_algorithm is None:
+            return {}
+        return {"ChecksumAlgorithm": self.settings.checksum_algorithm}
+
+    def _download_args(self) -> Dict[str, str]:
+        """Extra arguments of downloads.
+
+        Returns:
+            Dict[str, str]: checksum validation if configured
+        """
+        if self.settings.checksum_algorithm is None:
+            return {}
+        return {"ChecksumMode": "ENABLED"}
 
     def upload(self, file_path: Path, uploaded_filename: str) -> None:
         """Upload file to AWS S3 bucket root.
 
+        Parts are enlarged if the file would need more than MAX_PARTS.
+
         Args:
             file_path (Path): path to file
             uploaded_filename (str): name of file in bucket
         """
-        s3_client = self.session.client("s3")
-        s3_client.upload_file(
-            str(file_path), self.bucket, uploaded_filename
+        part_size = max(
+            self.settings.part_size,
+            -(-file_path.stat().st_size // MAX_PARTS)
+        )
+        self.client.upload_file(
+            str(file_path), self.bucket, uploaded_filename,
+            ExtraArgs=self._upload_args(),
+            Config=self._transfer_config(part_size),
+            Callback=None if self.upload_rate is None
+            else self.upload_rate.consume
         )
 
     def download(self, file_name: str, downloaded_filename: Path):
         """Download file from AWS S3 bucket root.
 
+        With a range cache, the file is fetched by ranges through the
+        cache.
+
         Args:
             file_name (str): name of file in bucket
             downloaded_filename (Path): name of local file
         """
-        s3_client = self.session.client("s3")
-        s3_client.download_file(
+        if self.cache is not None:
+            read_at, size, _ = self._pinned_reader(file_name)
+            with open(downloaded_filename, "wb") as bytesio:
+                for data in self._iter_ranges(
+                    read_at, size, self.settings.range_size
+                ):
+                    bytesio.write(data)
+            return
+        self.client.download_file(
             self.bucket,
             file_name,
-            str(downloaded_filename)
+            str(downloaded_filename),
+            ExtraArgs=self._download_args(),
+            Config=self._transfer_config(self.settings.range_size),
+            Callback=None if self.download_rate is None
+            else self.download_rate.consume
+        )
+
+    def upload_stream(self, bytesio: IO[bytes], uploaded_filename: str):
+        """Upload stream of unknown size as multipart upload.
+
+        Parts are read into a pool of max_concurrency + 1 reused buffers of
+        part_size. Reading waits while all buffers are being uploaded, so a
+        slow upload stops the producer of the stream. The pool is kept in
+        self.buffers to report the bytes in flight. Streams shorter than
+        part_size are uploaded with a single request. If reading the stream
+        raises, the multipart upload is aborted and no object is created.
+
+        Args:
+            bytesio (IO[bytes]): readable stream
+            uploaded_filename (str): name of file in bucket
+        """
+        self.buffers = pool = BufferPool(
+            self.settings.max_concurrency + 1, self.settings.part_size
+        )
+        buffer = pool.get()
+        size = readinto_exact(bytesio, memoryview(buffer))
+        if size < pool.size:
+            pool.put(buffer)
+            self.upload_bytes(bytes(buffer[:size]), uploaded_filename)
+            return
+
+        def upload(number: int, data: bytearray, size: int) \
+                -> Dict[str, Any]:
+            try:
+                return self._upload_part(
+                    uploaded_filename, upload_id, number,
+                    data if size == len(data) else data[:size]
+                )
+            finally:
+                pool.put(data)
+
+        upload_id = self.create_multipart_upload(uploaded_filename)
+        try:
+            with ThreadPoolExecutor(
+                max_workers=self.settings.max_concurrency
+            ) as executor:
+                parts: List[Dict[str, Any]] = []
+                pending: deque = deque()
+                while size:
+                    pending.append(executor.submit(
+                        upload, len(parts) + len(pending) + 1, buffer, size
+                    ))
+                    # at most one future per buffer is pending, fail early
+                    # instead of reading the rest of the stream
+                    while pending and pending[0].done():
+                        parts.append(pending.popleft().result())
+                    for future in pending:
+                        if future.done() and future.exception():
+                            future.result()
+                    buffer = pool.get()
+                    size = readinto_exact(bytesio, memoryview(buffer))
+                pool.put(buffer)
+                parts.extend(future.result() for future in pending)
+            self.complete_multipart_upload(
+                uploaded_filename, upload_id, parts
+            )
+        except BaseException:
+            self.abort_multipart_upload(uploaded_filename, upload_id)
+            raise
+
+    def download_stream(
+        self,
+        file_name: str,
+        reader: Optional[Tuple[Callable[[int, int], bytes], int]] = None
+    ) -> IO[bytes]:
+        """Open file in AWS S3 bucket root as stream.
+
+        The object is fetched in ranges by max_concurrency parallel ranged
+        GETs. Downloading thereby overlaps with processing the stream while
+        at most twice as many ranges are buffered.
+
+        Args:
+            file_name (str): name of file in bucket
+            reader (Optional[Tuple[Callable[[int, int], bytes], int]],
+                optional): Result of range_reader, e.g. to know the size
+                of the streamed version. Defaults to a new range reader.
+
+        Returns:
+            IO[bytes]: readable stream of object body
+        """
+        return BufferedReader(
+            IteratorReader(self._iter_ranges(
+                *(reader or self.range_reader(file_name)),
+                self.settings.range_size
+            )),
+            buffer_size=self.settings.range_size
         )
+
+    def _pinned_reader(
+        self,
+        file_name: str
+    ) -> Tuple[Callable[[int, int], bytes], int, str]:
+        """Provide random access to the current version of a file.
+
+        Reads go through the range cache if there is one.
+
+        Args:
+            file_name (str): name of file in bucket
+
+        Returns:
+            Tuple[Callable[[int, int], bytes], int, str]: function reading
+                size bytes at offset, object size and version id or, in
+                unversioned buckets, ETag
+        """
+        head = self.client.head_object(Bucket=self.bucket, Key=file_name)
+        version = {"VersionId": head["VersionId"]} \
+            if head.get("VersionId") else {}
+
+        def read_at(offset: int, size: int) -> bytes:
+            if size <= 0:
+                return b""
+            if self.download_rate is not None:
+                self.download_rate.consume(size)
+            return self.client.get_object(
+                Bucket=self.bucket, Key=file_name,
+                Range=f"bytes={offset}-{offset + size - 1}", **version
+            )["Body"].read()
+
+        version_id = head.get("VersionId") or head["ETag"]
+        if self.cache is not None:
+            read_at = self.cache.wrap(
+                read_at, self.bucket, file_name, version_id
+            )
+        return read_at, head["ContentLength"], version_id
+
+    def range_reader(
+        self,
+        file_name: str
+    ) -> Tuple[Callable[[int, int], bytes], int]:
+        """Provide random access to file in AWS S3 bucket root.
+
+        Reads are pinned to the object version current at the time of the
+        call, so an upload in between cannot mix two objects.
+
+        Args:
+            file_name (str): name of file in bucket
+
+        Returns:
+            Tuple[Callable[[int, int], bytes], int]: function reading size
+                bytes at offset using a ranged GET and object size
+        """
+        read_at, size, _ = self._pinned_reader(file_name)
+        return read_at, size
+
+    def download_resumable(
+        self,
+        file_name: str,
+        downloaded_filename: Path,
+        journal_path: Path
+    ) -> None:
+        """Download file by ranges, continuing an interrupted download.
+
+        The journal starts with the object version, size and range size
+        followed by the SHA256 of every range written to the local file. A
+        rerun fetches only ranges whose local data is missing or does not
+        match its digest. The journal is removed once the file is complete.
+
+        Args:
+            file_name (str): name of file in bucket
+            downloaded_filename (Path): name of local file
+            journal_path (Path): progress of the download
+        """
+        read_at, size, version = self._pinned_reader(file_name)
+        range_size = self.settings.range_size
+        signature = json.dumps([file_name, version, size, range_size])
+        done = set()
+        if journal_path.exists() and downloaded_filename.exists():
+            lines = journal_path.read_text(encoding="utf-8").splitlines()
+            if lines and lines[0] == signature:
+                with open(downloaded_filename, "rb") as bytesio:
+                    for line in lines[1:]:
+                        fields = line.split()
+                        # last line may be cut off by the interruption
+                        if len(fields) != 2 or not fields[0].isdigit():
+                            continue
+                        start = int(fields[0])
+                        bytesio.seek(start)
+                        if sha256(bytesio.read(range_size)).hexdigest() \
+                                == fields[1]:
+                            done.add(start)
+        if not done:
+            journal_path.write_text(signature + "\n", encoding="utf-8")
+            downloaded_filename.write_bytes(b"")
+        if done:
+            logger.info(
+                "Resuming download, %d of %d ranges present.",
+                len(done), -(-size // range_size)
+            )
+
+        def fetch(start: int) -> Tuple[int, bytes]:
+            return start, read_at(start, min(range_size, size - start))
+
+        concurrency = self.settings.max_concurrency
+        with open(downloaded_filename, "r+b") as bytesio, \
+                open(journal_path, "a", encoding="utf-8") as journal, \
+                ThreadPoolExecutor(max_workers=concurrency) as executor:
+            bytesio.truncate(size)
+            for start, data in parallel_map(
+                executor, fetch,
+                (
+                    start for start in range(0, size, range_size)
+                    if start not in done
+                ),
+                2*concurrency
+            ):
+                bytesio.seek(start)
+                bytesio.write(data)
+                bytesio.flush()
+                journal.write(f"{start} {sha256(data).hexdigest()}\n")
+                journal.flush()
+        journal_path.unlink()
+
+    def _iter_ranges(
+        self,
+        read_at: Callable[[int, int], bytes],
+        size: int,
+        range_size: int
+    ) -> Iterator[bytes]:
+        """Download object range by range with parallel requests.
+
+        Args:
+            read_at (Callable[[int, int], bytes]): function reading size
+                bytes at offset
+            size (int): size of object
+            range_size (int): bytes per request
+
+        Yields:
+            bytes: consecutive ranges of object
+        """
+        concurrency = self.settings.max_concurrency
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            yield from parallel_map(
+                executor,
+                lambda start: read_at(start, min(range_size, size - start)),
+                range(0, size, range_size),
+                2*concurrency
+            )
+
+    def create_multipart_upload(self, uploaded_filename: str) -> str:
+        """Start multipart upload, e.g. for upload_parts.
+
+        Args:
+            uploaded_filename (str): name of file in bucket
+
+        Returns:
+            str: upload id
+        """
+        return self.client.create_multipart_upload(
+            Bucket=self.bucket, Key=uploaded_filename, **self._upload_args()
+        )["UploadId"]
+
+    def list_parts(
+        self,
+        uploaded_filename: str,
+        upload_id: str
+    ) -> Optional[Dict[int, str]]:
+        """List uploaded parts of an unfinished multipart upload.
+
+        Args:
+            uploaded_filename (str): name of file in bucket
+            upload_id (str): upload id
+
+        Returns:
+            Optional[Dict[int, str]]: ETag by part number, None if the
+                upload was completed, aborted or expired
+        """
+        try:
+            return {
+                part["PartNumber"]: part["ETag"]
+                for page in self.client.get_paginator("list_parts").paginate(
+                    Bucket=self.bucket, Key=uploaded_filename,
+                    UploadId=upload_id
+                )
+                for part in page.get("Parts", [])
+            }
+        except ClientError as error:
+            if error.response["Error"]["Code"] == "NoSuchUpload":
+                return None
+            raise
+
+    def _upload_part(
+        self,
+        uploaded_filename: str,
+        upload_id: str,
+        number: int,
+        data: Union[bytes, bytearray]
+    ) -> Dict[str, Any]:
+        """Upload part of a multipart upload. Thread safe.
+
+        Args:
+            uploaded_filename (str): name of file in bucket
+            upload_id (str): id from create_multipart_upload
+            number (int): part number starting at one
+            data (Union[bytes, bytearray]): content of part
+
+        Returns:
+            Dict[str, Any]: part as needed by complete_multipart_upload
+        """
+        if self.upload_rate is not None:
+            self.upload_rate.consume(len(data))
+        response = self.client.upload_part(
+            Bucket=self.bucket, Key=uploaded_filename,
+            UploadId=upload_id, PartNumber=number, Body=data,
+            **self._upload_args()
+        )
+        part = {"PartNumber": number, "ETag": response["ETag"]}
+        if self.settings.checksum_algorithm is not None:
+            field = "Checksum" + self.settings.checksum_algorithm
+            part[field] = response[field]
+        return part
+
+    def upload_parts(
+        self,
+        chunks: Iterable[bytes],
+        uploaded_filename: str,
+        upload_id: str,
+        first_part: int = 1
+    ) -> Iterator[Tuple[Dict[str, Any], int, bool]]:
+        """Upload chunks as parts of a multipart upload.
+
+        Chunks are never split, so part boundaries fall between chunks.
+        Parts hold at least part_size bytes except the last one, which
+        holds the last chunk. max_concurrency parts are uploaded at a time.
+
+        Args:
+            chunks (Iterable[bytes]): data to upload
+            uploaded_filename (str): name of file in bucket
+            upload_id (str): id from create_multipart_upload
+            first_part (int, optional): Number of the first part, greater
+                than one to continue an upload. Defaults to 1.
+
+        Yields:
+            Tuple[Dict[str, Any], int, bool]: in order of parts the part as
+                needed by complete_multipart_upload, the number of chunks
+                uploaded up to and including it and whether it is the last
+        """
+        def upload(item: Tuple[int, Tuple[bytes, int, bool]]) \
+                -> Tuple[Dict[str, Any], int, bool]:
+            number, (data, count, last) = item
+            return self._upload_part(
+                uploaded_filename, upload_id, number, data
+            ), count, last
+
+        concurrency = self.settings.max_concurrency
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            yield from parallel_map(
+                executor, upload,
+                enumerate(
+                    _group_chunks(chunks, self.settings.part_size),
+                    first_part
+                ),
+                concurrency
+            )
+
+    def complete_multipart_upload(
+        self,
+        uploaded_filename: str,
+        upload_id: str,
+        parts: List[Dict[str, Any]]
+    ) -> None:
+        """Create file from uploaded parts.
+
+        Args:
+            uploaded_filename (str): name of file in bucket
+            upload_id (str): upload id
+            parts (List[Dict[str, Any]]): all parts from upload_parts
+        """
+        self.client.complete_multipart_upload(
+            Bucket=self.bucket, Key=uploaded_filename, UploadId=upload_id,
+            MultipartUpload={"Parts": parts}
+        )
+
+    def abort_multipart_upload(
+        self,
+        uploaded_filename: str,
+        upload_id: str
+    ) -> None:
+        """Discard unfinished multipart upload and its parts.
+
+        Args:
+            uploaded_filename (str): name of file in bucket
+            upload_id (str): upload id
+        """
+        try:
+            self.client.abort_multipart_upload(
+                Bucket=self.bucket, Key=uploaded_filename,
+                UploadId=upload_id
+            )
+        except ClientError as error:
+            if error.response["Error"]["Code"] != "NoSuchUpload":
+                raise
+
+    def upload_bytes(self, data: bytes, uploaded_filename: str) -> None:
+        """Upload small file from memory with a single request.
+
+        Thread safe.
+
+        Args:
+            data (bytes): content of file
+            uploaded_filename (str): name of file in bucket
+        """
+        if self.upload_rate is not None:
+            self.upload_rate.consume(len(data))
+        self.client.put_object(
+            Bucket=self.bucket, Key=uploaded_filename, Body=data,
+            **self._upload_args()
+        )
+
+    def download_bytes(
+        self,
+        file_name: str,
+        version_id: Optional[str] = None
+    ) -> bytes:
+        """Download small file into memory with a single request.
+
+        Thread safe.
+
+        Args:
+            file_name (str): name of file in bucket
+            version_id (Optional[str], optional): Version of file.
+                Defaults to the current version.
+
+        Returns:
+            bytes: content of file
+        """
+        version = {"VersionId": version_id} if version_id else {}
+        data = self.client.get_object(
+            Bucket=self.bucket, Key=file_name, **version,
+            **self._download_args()
+        )["Body"].read()
+        if self.download_rate is not None:
+            self.download_rate.consume(len(data))
+        return data
+
+    def list_files(
+        self,
+        prefix: str = "",
+        modified_before: Optional[datetime] = None
+    ) -> Iterator[str]:
+        """List names of files in bucket.
+
+        Args:
+            prefix (str, optional): Only list names starting with prefix.
+                Defaults to "".
+            modified_before (Optional[datetime], optional): Only list files
+                last modified before this time zone aware point in time.
+                Defaults to None.
+
+        Yields:
+            str: file name
+        """
+        for page in self.client.get_paginator("list_objects_v2").paginate(
+            Bucket=self.bucket, Prefix=prefix
+        ):
+            for obj in page.get("Contents", []):
+                if modified_before is None or \
+                        obj["LastModified"] < modified_before:
+                    yield obj["Key"]
+
+    def list_page(
+        self,
+        prefix: str = "",
+        delimiter: Optional[str] = None,
+        token: Optional[str] = None
+    ) -> Tuple[List[Dict[str, Any]], List[str], Optional[str]]:
+        """List one page of up to 1000 files.
+
+        Args:
+            prefix (str, optional): Only list names starting with prefix.
+                Defaults to "".
+            delimiter (Optional[str], optional): Group names containing
+                the delimiter after the prefix into common prefixes.
+                Defaults to None.
+            token (Optional[str], optional): Continuation token of the
+                previous page. Defaults to the first page.
+
+        Returns:
+            Tuple[List[Dict[str, Any]], List[str], Optional[str]]: objects
+                with Key, Size, LastModified and ETag, common prefixes and
+                continuation token of the next page, None on the last page
+        """
+        extra = {"Delimiter": delimiter} if delimiter else {}
+        if token:
+            extra["ContinuationToken"] = token
+        page = self.client.list_objects_v2(
+            Bucket=self.bucket, Prefix=prefix, **extra
+        )
+        return (
+            page.get("Contents", []),
+            [common["Prefix"] for common in page.get("CommonPrefixes", [])],
+            page.get("NextContinuationToken")
+        )
+
+    def stat(self, file_name: str) -> Optional[Dict[str, Any]]:
+        """Look up size and state of a file with a HEAD request.
+
+        Args:
+            file_name (str): name of file in bucket
+
+        Returns:
+            Optional[Dict[str, Any]]: Key, Size, LastModified and ETag like
+                list_page, None if the file does not exist
+        """
+        try:
+            head = self.client.head_object(Bucket=self.bucket, Key=file_name)
+        except ClientError as error:
+            if error.response["Error"]["Code"] in ("404", "NoSuchKey"):
+                return None
+            raise
+        return {
+            "Key": file_name,
+            "Size": head["ContentLength"],
+            "LastModified": head["LastModified"],
+            "ETag": head["ETag"]
+        }
+
+    def checksum(self, file_name: str) -> Optional[Tuple[str, str]]:
+        """Look up the additional checksum S3 validated on upload.
+
+        Args:
+            file_name (str): name of file in bucket
+
+        Returns:
+            Optional[Tuple[str, str]]: algorithm and base64 encoded value,
+                None if the file was uploaded without checksum
+        """
+        head = self.client.head_object(
+            Bucket=self.bucket, Key=file_name, ChecksumMode="ENABLED"
+        )
+        for algorithm in CHECKSUM_ALGORITHMS:
+            if head.get("Checksum" + algorithm):
+                return algorithm, head["Checksum" + algorithm]
+        return None
+
+    def list_versions(
+        self,
+        prefix: str = "",
+        exclude_prefixes: Collection[str] = ()
+    ) -> Iterator[Tuple[str, str]]:
+        """List all versions of files in bucket.
+
+        Unversioned buckets list each file once with version 'null'.
+
+        Args:
+            prefix (str, optional): Only list names starting with prefix.
+                Defaults to "".
+            exclude_prefixes (Collection[str], optional): Directories ending
+                with "/" which are not listed at all, e.g. because they
+                hold many files. Defaults to none.
+
+        Yields:
+            Tuple[str, str]: file name and version id
+        """
+        # with a delimiter, directories are listed by one entry each
+        delimiter = {"Delimiter": "/"} if exclude_prefixes else {}
+        prefixes = [prefix]
+        while prefixes:
+            for page in self.client.get_paginator("list_object_versions") \
+                    .paginate(
+                        Bucket=self.bucket, Prefix=prefixes.pop(),
+                        **delimiter
+                    ):
+                for version in page.get("Versions", []):
+                    yield version["Key"], version["VersionId"]
+                prefixes.extend(
+                    common["Prefix"]
+                    for common in page.get("CommonPrefixes", [])
+                    if common["Prefix"] not in exclude_prefixes
+                )
+
+    def delete(self, file_names: Iterable[str]) -> List[str]:
+        """Delete files in bucket.
+
+        Versioned buckets keep the data until lifecycle rules expire it.
+        Files which could not be deleted are logged.
+
+        Args:
+            file_names (Iterable[str]): names of files in bucket
+
+        Returns:
+            List[str]: names of files which could not be deleted
+        """
+        file_names = list(file_names)
+        failed = []
+        for start in range(0, len(file_names), DELETE_BATCH_SIZE):
+            # quiet responses list only the errors
+            response = self.client.delete_objects(
+                Bucket=self.bucket,
+                Delete={
+                    "Objects": [
+                        {"Key": file_name}
+                        for file_name in
+                        file_names[start:start + DELETE_BATCH_SIZE]
+                    ],
+                    "Quiet": True
+                }
+            )
+            for error in response.get("Errors", []):
+                logger.warning(
+                    "Could not delete %s: %s", error["Key"],
+                    error.get("Message", error.get("Code"))
+                )
+                failed.append(error["Key"])
+        return failed
@@ -0,0 +1,288 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Stream adapters used to connect pipeline stages without temp files."""
+
+from collections import deque
+from concurrent.futures import Executor
+from io import RawIOBase
+from queue import Full, Queue
+from threading import Condition, Event, Thread
+from typing import IO, Any, Callable, Iterable, Iterator, List, Optional
+
+# Timeout in seconds after which blocked threads check for cancellation.
+POLL_INTERVAL = 0.5
+
+
+class IteratorReader(RawIOBase):
+    """Readable file object on top of an iterator of byte chunks."""
+
+    def __init__(self, chunks: Iterable[bytes]) -> None:
+        """IteratorReader constructor.
+
+        Args:
+            chunks (Iterable[bytes]): byte chunks to be read in order
+        """
+        super().__init__()
+        self._chunks: Iterator[bytes] = iter(chunks)
+        self._chunk = memoryview(b"")
+
+    def close(self) -> None:
+        """Close stream and stop generators producing the chunks."""
+        if hasattr(self._chunks, "close"):
+            self._chunks.close()
+        super().close()
+
+    def readable(self) -> bool:
+        """Stream is readable.
+
+        Returns:
+            bool: always True
+        """
+        return True
+
+    def readinto(self, buffer: memoryview) -> int:
+        """Read next bytes of the current chunk into buffer.
+
+        Args:
+            buffer (memoryview): destination buffer
+
+        Returns:
+            int: number of bytes read, 0 on end of stream
+        """
+        while not self._chunk:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                return 0
+            self._chunk = memoryview(chunk)
+        size = min(len(buffer), len(self._chunk))
+        buffer[:size] = self._chunk[:size]
+        self._chunk = self._chunk[size:]
+        return size
+
+
+class CheckedReader(RawIOBase):
+    """Readable stream that runs a check when reaching its end.
+
+    Used on the stdout of subprocesses. The check waits for the process and
+    raises if it failed, so consumers never mistake a crashed producer for a
+    complete stream.
+    """
+
+    def __init__(self, bytesio: IO[bytes], check: Callable[[], None]) -> None:
+        """CheckedReader constructor.
+
+        Args:
+            bytesio (IO[bytes]): wrapped stream
+            check (Callable[[], None]): called once at end of stream
+        """
+        super().__init__()
+        self._bytesio = bytesio
+        self._check: Optional[Callable[[], None]] = check
+
+    def readable(self) -> bool:
+        """Stream is readable.
+
+        Returns:
+            bool: always True
+        """
+        return True
+
+    def readinto(self, buffer: memoryview) -> int:
+        """Read from wrapped stream.
+
+        Args:
+            buffer (memoryview): destination buffer
+
+        Returns:
+            int: number of bytes read, 0 on end of stream
+        """
+        size = self._bytesio.readinto(buffer)
+        if not size and self._check is not None:
+            check, self._check = self._check, None
+            check()
+        return size
+
+
+def read_exact(bytesio: IO[bytes], size: int) -> bytes:
+    """Read exactly size bytes unless the stream ends.
+
+    Network streams may return less data than requested per call.
+
+    Args:
+        bytesio (IO[bytes]): readable stream
+        size (int): number of bytes
+
+    Returns:
+        bytes: data, shorter than size only at end of stream
+    """
+    data = bytesio.read(size)
+    if len(data) == size or not data:
+        return data
+    parts = [data]
+    missing = size - len(data)
+    while missing and (data := bytesio.read(missing)):
+        parts.append(data)
+        missing -= len(data)
+    return b"".join(parts)
+
+
+def readinto_exact(bytesio: IO[bytes], buffer: memoryview) -> int:
+    """Fill buffer unless the stream ends.
+
+    Args:
+        bytesio (IO[bytes]): readable stream
+        buffer (memoryview): destination buffer
+
+    Returns:
+        int: number of bytes read, less than the buffer only at end of
+            stream
+    """
+    filled = 0
+    while filled < len(buffer) and (size := bytesio.readinto(buffer[filled:])):
+        filled += size
+    return filled
+
+
+class BufferPool:
+    """Fixed number of reusable buffers shared by producer and consumers.
+
+    The producer takes a buffer, fills it and hands it to a consumer, which
+    returns it when done. Taking blocks while all buffers are in use, which
+    stops a fast producer in front of a slow consumer. Buffers are allocated
+    on first use.
+    """
+
+    def __init__(self, count: int, size: int) -> None:
+        """BufferPool constructor.
+
+        Args:
+            count (int): maximum number of buffers
+            size (int): bytes per buffer
+        """
+        self.count = count
+        self.size = size
+        self._free: List[bytearray] = []
+        self._allocated = 0
+        self._in_use = 0
+        self.peak = 0
+        self._condition = Condition()
+
+    @property
+    def in_flight(self) -> int:
+        """Bytes of buffers in use.
+
+        Returns:
+            int: bytes
+        """
+        return self._in_use*self.size
+
+    def get(self) -> bytearray:
+        """Take a buffer, waiting until one is returned if all are in use.
+
+        Returns:
+            bytearray: buffer of size bytes with undefined content
+        """
+        with self._condition:
+            while not self._free and self._allocated == self.count:
+                self._condition.wait()
+            if self._free:
+                buffer = self._free.pop()
+            else:
+                buffer = bytearray(self.size)
+                self._allocated += 1
+            self._in_use += 1
+            self.peak = max(self.peak, self.in_flight)
+            return buffer
+
+    def put(self, buffer: bytearray) -> None:
+        """Return buffer.
+
+        Args:
+            buffer (bytearray): buffer from get
+        """
+        with self._condition:
+            self._free.append(buffer)
+            self._in_use -= 1
+            self._condition.notify()
+
+
+def prefetch(chunks: Iterable[bytes], depth: int) -> Iterator[bytes]:
+    """Produce chunks in a background thread.
+
+    The producer runs ahead of the consumer by at most depth chunks, so
+    producing and consuming overlap with bounded memory. Exceptions of the
+    producer are raised in the consumer.
+
+    Args:
+        chunks (Iterable[bytes]): chunks to produce
+        depth (int): maximum number of chunks buffered
+
+    Yields:
+        bytes: chunks in order
+    """
+    queue: Queue = Queue(maxsize=depth)
+    stop = Event()
+    end = object()
+
+    def put(item) -> bool:
+        while not stop.is_set():
+            try:
+                queue.put(item, timeout=POLL_INTERVAL)
+                return True
+            except Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for chunk in chunks:
+                if not put(chunk):
+                    return
+            put(end)
+        except BaseException as error:  # pylint: disable=broad-except
+            put(error)
+
+    thread = Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while (item := queue.get()) is not end:
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+
+
+def parallel_map(
+    executor: Executor,
+    func: Callable[[Any], Any],
+    items: Iterable[Any],
+    max_in_flight: int
+) -> Iterator[Any]:
+    """Apply func to items on executor and yield results in order.
+
+    Unlike Executor.map the items are consumed lazily. At most max_in_flight
+    items are submitted and not yet yielded, which bounds memory usage.
+
+    Args:
+        executor (Executor): thread or process pool
+        func (Callable[[Any], Any]): function to apply, picklable for
+            process pools
+        items (Iterable[Any]): input items
+        max_in_flight (int): maximum number of pending items
+
+    Yields:
+        Any: results in order of items
+    """
+    pending: deque = deque()
+    try:
+        for item in items:
+            if len(pending) >= max_in_flight:
+                yield pending.popleft().result()
+            pending.append(executor.submit(func, item))
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        for future in pending:
+            future.cancel()
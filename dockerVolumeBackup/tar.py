@@ -3,12 +3,33 @@
 """Tar related procedures."""
 # Created on Fri Jan 28 2022 by Merlin Mittelbach.
 
+import errno
+import os
+from contextlib import contextmanager
+from fnmatch import fnmatchcase
+from io import BufferedReader
+from itertools import chain
 from logging import getLogger
-from pathlib import Path
-from tarfile import open as taropen
-from subprocess import CalledProcessError, run
-from typing import List
+from pathlib import Path, PurePosixPath
+from queue import Queue
+from tarfile import BLOCKSIZE, LNKTYPE, TarFile, TarInfo, open as taropen
+from tempfile import TemporaryFile
+from threading import Thread
+from subprocess import PIPE, CalledProcessError, Popen, run
+from typing import \
+    IO, Any, Callable, ContextManager, Iterable, Iterator, List, Optional, \
+    Sequence, Tuple
 
+from .streams import CheckedReader, IteratorReader
+from .throttle import TokenBucket, throttle
+
+# fields of members recorded by TarIndexer
+MEMBER_NAME, MEMBER_TYPE, MEMBER_LINKNAME, MEMBER_SIZE, MEMBER_MTIME, \
+    MEMBER_OFFSET, MEMBER_END = range(7)
+# store only the data extents of files with holes, which tar finds with
+# SEEK_DATA and SEEK_HOLE
+SPARSE_OPTION = "--sparse"
+COPY_SIZE = 2**20
 logger = getLogger(__file__)
 
 
@@ -37,15 +58,192 @@ def call_tar(cmd: List[str], raise_exc=False) -> bool:
         success = True
     except CalledProcessError as error:
         logger.warning(
-            "Running tar failed. stdout: '%s' stderr: '%s'",
-            error.stdout.encode("string_escape"),
-            error.stderr.encode("string_escape")
+            "Running tar failed. stdout: %r stderr: %r",
+            error.stdout, error.stderr
         )
         if raise_exc:
             raise error
     return success
 
 
+@contextmanager
+def popen_tar(
+    cmd: List[str],
+    **kwargs
+) -> Iterator[Tuple[Popen, Callable[[], None]]]:
+    """Run tar subprocess with piped in- or output.
+
+    Args:
+        cmd (List[str]): command parameters
+        kwargs: passed to Popen, usually stdin or stdout
+
+    Raises:
+        CalledProcessError: execution failed
+
+    Yields:
+        Tuple[Popen, Callable[[], None]]: process and a check which waits
+            for the process and raises on failure
+    """
+    cmd = ["tar", *map(str, cmd)]
+    with TemporaryFile() as stderr:
+        def check():
+            if process.wait():
+                stderr.seek(0)
+                raise CalledProcessError(
+                    process.returncode, cmd,
+                    stderr=stderr.read().decode(errors="replace")
+                )
+
+        with Popen(cmd, stderr=stderr, **kwargs) as process:
+            try:
+                yield process, check
+            except BaseException:
+                process.kill()
+                raise
+        check()
+
+
+def data_extents(descriptor: int, size: int) -> List[Tuple[int, int]]:
+    """Find the data extents of a file, skipping its holes.
+
+    Args:
+        descriptor (int): file descriptor
+        size (int): file size
+
+    Returns:
+        List[Tuple[int, int]]: offset and size of each extent, the whole
+            file if the file system cannot report holes
+    """
+    extents = []
+    offset = 0
+    try:
+        while offset < size:
+            try:
+                start = os.lseek(descriptor, offset, os.SEEK_DATA)
+            except OSError as error:
+                # only a hole is left
+                if error.errno == errno.ENXIO:
+                    break
+                raise
+            offset = min(os.lseek(descriptor, start, os.SEEK_HOLE), size)
+            extents.append((start, offset - start))
+    except OSError:
+        extents = [(0, size)]
+    os.lseek(descriptor, 0, os.SEEK_SET)
+    return extents
+
+
+def _read_extents(
+    file: IO[bytes],
+    extents: List[Tuple[int, int]]
+) -> Iterator[bytes]:
+    """Read data extents of a file.
+
+    Args:
+        file (IO[bytes]): seekable file
+        extents (List[Tuple[int, int]]): offset and size of each extent
+
+    Yields:
+        bytes: chunks of the extents in order
+    """
+    for offset, size in extents:
+        file.seek(offset)
+        while size:
+            chunk = file.read(min(size, COPY_SIZE))
+            if not chunk:
+                raise EOFError(f"{file.name} shrank while packing.")
+            size -= len(chunk)
+            yield chunk
+
+
+def add_file(archive: TarFile, path: Path) -> None:
+    """Add file to archive, storing only the data of sparse files.
+
+    Files with holes are stored in the PAX sparse format 1.0 of GNU tar,
+    which GNU tar and tarfile extract as sparse files again.
+
+    Args:
+        archive (TarFile): archive opened for writing in PAX format
+        path (Path): file, directory or link, added without content
+    """
+    member = archive.gettarinfo(path)
+    if not member.isreg():
+        archive.addfile(member)
+        return
+    with open(path, "rb") as file:
+        extents = data_extents(file.fileno(), member.size)
+        stored = sum(size for _, size in extents)
+        if stored == member.size:
+            archive.addfile(member, file)
+            return
+        # like GNU tar, an empty extent marks the size of a trailing hole
+        if not extents or sum(extents[-1]) < member.size:
+            extents.append((member.size, 0))
+        # the map of extents precedes their data, padded to full blocks
+        sparse_map = f"{len(extents)}\n".encode() + "".join(
+            f"{offset}\n{size}\n" for offset, size in extents
+        ).encode()
+        sparse_map += bytes(-len(sparse_map) % BLOCKSIZE)
+        sparse = TarInfo(str(PurePosixPath(
+            member.name
+        ).parent/"GNUSparseFile.0"/PurePosixPath(member.name).name))
+        for field in ("mode", "uid", "gid", "mtime", "uname", "gname"):
+            setattr(sparse, field, getattr(member, field))
+        sparse.size = len(sparse_map) + stored
+        sparse.pax_headers = {
+            "GNU.sparse.major": "1",
+            "GNU.sparse.minor": "0",
+            "GNU.sparse.name": member.name,
+            "GNU.sparse.realsize": str(member.size)
+        }
+        archive.addfile(sparse, BufferedReader(IteratorReader(
+            chain((sparse_map,), _read_extents(file, extents))
+        )))
+
+
+def add_tree(archive: TarFile, path: Path) -> None:
+    """Add directory tree to archive like TarFile.add, keeping holes.
+
+    Args:
+        archive (TarFile): archive opened for writing in PAX format
+        path (Path): file or directory
+    """
+    add_file(archive, path)
+    if path.is_dir() and not path.is_symlink():
+        for child in sorted(os.listdir(path)):
+            add_tree(archive, path/child)
+
+
+def pack(
+    path: Path,
+    archive_path: Path,
+    options: Sequence[str] = ()
+) -> None:
+    """Create tar archive.
+
+    Args:
+        path (Path): file(s) to pack
+        archive_path (Path): path to archive
+        options (Sequence[str], optional): additional tar options, e.g. the
+            compression program. Defaults to uncompressed.
+    """
+    call_tar(
+        ["-c", SPARSE_OPTION, *options, "-f", archive_path, path],
+        raise_exc=True
+    )
+
+
+def unpack(archive_path: Path, options: Sequence[str] = ()) -> None:
+    """Unpack tar archive.
+
+    Args:
+        archive_path (Path): path to archive
+        options (Sequence[str], optional): additional tar options, e.g. the
+            compression program. Defaults to uncompressed.
+    """
+    call_tar(["-x", *options, "-f", archive_path], raise_exc=True)
+
+
 def pack_bzip2(path: Path, archive_path: Path) -> None:
     """Create bzip2 compressed tar archive.
 
@@ -53,7 +251,7 @@ def pack_bzip2(path: Path, archive_path: Path) -> None:
         path (Path): file(s) to compress
         archive_path (Path): path to archive
     """
-    call_tar(["-c", "-Ipbzip2", "-f", archive_path, path], raise_exc=True)
+    pack(path, archive_path, ["-Ipbzip2"])
 
 
 def unpack_bzip2(archive_path: Path) -> None:
@@ -62,7 +260,7 @@ def unpack_bzip2(archive_path: Path) -> None:
     Args:
         archive_path (Path): path to archive
     """
-    call_tar(["-x", "-Ipbzip2", "-f", archive_path], raise_exc=True)
+    unpack(archive_path, ["-Ipbzip2"])
 
 
 def pack_lzma(path: Path, archive_path: Path):
@@ -74,10 +272,10 @@ def pack_lzma(path: Path, archive_path: Path):
         path (Path): file(s) to compress
         archive_path (Path): path to archive
     """
-    if not call_tar(["cJf", archive_path, path]):
+    if not call_tar(["-cJ", SPARSE_OPTION, "-f", archive_path, path]):
         # fall back to python
         with taropen(archive_path, "w|xz") as archive:
-            archive.add(path)
+            add_tree(archive, path)
 
 
 def unpack_lzma(archive_path: Path):
@@ -90,3 +288,230 @@ def unpack_lzma(archive_path: Path):
         # fall back to python
         with taropen(archive_path, "r|xz") as archive:
             archive.extractall(path="/")
+
+
+@contextmanager
+def pack_stream(
+    path: Path,
+    options: Sequence[str] = (),
+    read_limit: Optional[TokenBucket] = None
+) -> Iterator[IO[bytes]]:
+    """Stream tar archive without writing it to disk.
+
+    The stream raises CalledProcessError at its end if tar failed.
+
+    Args:
+        path (Path): file(s) to pack
+        options (Sequence[str], optional): additional tar options, e.g. the
+            compression program. Defaults to uncompressed.
+        read_limit (Optional[TokenBucket], optional): Rate limit of the
+            archive stream, which slows down tar. Defaults to unlimited.
+
+    Yields:
+        IO[bytes]: readable archive stream
+    """
+    with popen_tar(
+        ["-c", SPARSE_OPTION, *options, "-f", "-", path], stdout=PIPE
+    ) as (process, check):
+        yield BufferedReader(CheckedReader(
+            throttle(process.stdout, read_limit), check
+        ))
+
+
+@contextmanager
+def pack_files_stream(
+    paths: Iterable[Path],
+    options: Sequence[str] = (),
+    read_limit: Optional[TokenBucket] = None
+) -> Iterator[IO[bytes]]:
+    """Stream tar archive of the listed paths only.
+
+    Directories are added without their content. The list is passed to
+    tar on stdin, so it may be arbitrarily long.
+
+    Args:
+        paths (Iterable[Path]): files and directories to pack
+        options (Sequence[str], optional): additional tar options, e.g. the
+            compression program. Defaults to uncompressed.
+        read_limit (Optional[TokenBucket], optional): Rate limit of the
+            archive stream, which slows down tar. Defaults to unlimited.
+
+    Yields:
+        IO[bytes]: readable archive stream
+    """
+    with TemporaryFile() as file_list:
+        for path in paths:
+            file_list.write(bytes(path) + b"\0")
+        file_list.seek(0)
+        with popen_tar(
+            [
+                "-c", SPARSE_OPTION, *options, "--null", "--no-recursion",
+                "-T", "-", "-f", "-"
+            ],
+            stdin=file_list, stdout=PIPE
+        ) as (process, check):
+            yield BufferedReader(CheckedReader(
+                throttle(process.stdout, read_limit), check
+            ))
+
+
+@contextmanager
+def unpack_stream(options: Sequence[str] = ()) -> Iterator[IO[bytes]]:
+    """Unpack tar archive written to the stream.
+
+    Existing files are overwritten, so the target need not be empty.
+
+    Args:
+        options (Sequence[str], optional): additional tar options, e.g. the
+            compression program. Defaults to uncompressed.
+
+    Raises:
+        CalledProcessError: execution failed
+
+    Yields:
+        IO[bytes]: writable archive stream
+    """
+    with popen_tar(
+        ["-x", *options, "-f", "-"], stdin=PIPE
+    ) as (process, _):
+        yield process.stdin
+        process.stdin.close()
+
+
+def pack_bzip2_stream(path: Path) -> ContextManager[IO[bytes]]:
+    """Stream bzip2 compressed tar archive without writing it to disk.
+
+    Args:
+        path (Path): file(s) to compress
+
+    Returns:
+        ContextManager[IO[bytes]]: readable archive stream
+    """
+    return pack_stream(path, ["-Ipbzip2"])
+
+
+def unpack_bzip2_stream() -> ContextManager[IO[bytes]]:
+    """Decompress bzip2 compressed tar archive written to the stream.
+
+    Returns:
+        ContextManager[IO[bytes]]: writable archive stream
+    """
+    return unpack_stream(["-Ipbzip2"])
+
+
+class TarIndexer:
+    """Index members of a tar stream passing through.
+
+    Chunks fed to the indexer are parsed by tarfile in a background thread.
+    At most depth chunks are queued.
+    """
+
+    def __init__(self, depth: int = 16) -> None:
+        """TarIndexer constructor. Starts the parsing thread.
+
+        Args:
+            depth (int, optional): Maximum number of queued chunks.
+                Defaults to 16.
+        """
+        self.members: List[List[Any]] = []
+        self._queue: Queue = Queue(maxsize=depth)
+        self._error: Optional[BaseException] = None
+        self._thread = Thread(target=self._index, daemon=True)
+        self._thread.start()
+
+    def _index(self) -> None:
+        """Parse tar stream and record members."""
+        chunks = iter(self._queue.get, None)
+        try:
+            with taropen(
+                fileobj=BufferedReader(IteratorReader(chunks)), mode="r|"
+            ) as archive:
+                for member in archive:
+                    self.members.append([
+                        member.name, member.type.decode(), member.linkname,
+                        member.size, int(member.mtime), member.offset, None
+                    ])
+                end = archive.offset
+            # members end where the next one starts, which also covers
+            # sparse and extended headers
+            for member, next_member in zip(self.members, self.members[1:]):
+                member[MEMBER_END] = next_member[MEMBER_OFFSET]
+            if self.members:
+                self.members[-1][MEMBER_END] = end
+        except BaseException as error:  # pylint: disable=broad-except
+            self._error = error
+        # consume remaining zero blocks
+        for _ in chunks:
+            pass
+
+    def feed(self, chunk: bytes) -> None:
+        """Pass chunk of the tar stream.
+
+        Args:
+            chunk (bytes): next bytes of the stream
+        """
+        self._queue.put(chunk)
+
+    def close(self) -> List[List[Any]]:
+        """Finish parsing.
+
+        Raises:
+            BaseException: parsing failed
+
+        Returns:
+            List[List[Any]]: name, type, link name, size, mtime, offset of
+                first header and end offset per member
+        """
+        self._queue.put(None)
+        self._thread.join()
+        if self._error is not None:
+            raise self._error
+        return self.members
+
+
+def select_members(
+    members: List[List[Any]],
+    patterns: Iterable[str],
+    root: Path
+) -> List[List[Any]]:
+    """Select members matching glob patterns.
+
+    Patterns are relative to root. A member matches if its path or any of
+    its parent directories matches, so directories select whole subtrees.
+    Hard link targets of selected members are selected as well.
+
+    Args:
+        members (List[List[Any]]): members recorded by TarIndexer
+        patterns (Iterable[str]): glob patterns
+        root (Path): directory the archive was created from
+
+    Returns:
+        List[List[Any]]: selected members ordered by offset
+    """
+    prefix = str(root).strip("/") + "/"
+    patterns = [
+        pattern.strip("/").removeprefix(prefix)
+        for pattern in patterns
+    ]
+
+    def matches(name: str) -> bool:
+        path = PurePosixPath(name.rstrip("/").removeprefix(prefix))
+        return any(
+            fnmatchcase(str(candidate), pattern)
+            for candidate in (path, *path.parents)
+            for pattern in patterns
+        )
+
+    selected = {
+        member[MEMBER_NAME]: member
+        for member in members
+        if matches(member[MEMBER_NAME])
+    }
+    by_name = {member[MEMBER_NAME]: member for member in members}
+    for member in list(selected.values()):
+        if member[MEMBER_TYPE] == LNKTYPE.decode() and \
+                member[MEMBER_LINKNAME] in by_name:
+            selected.setdefault(
+                member[MEMBER_LINKNAME], by_name[member[MEMBER_LINKNAME]]
+            )
+    return sorted(selected.values(), key=lambda member: member[MEMBER_OFFSET])
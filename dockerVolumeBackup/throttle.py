@@ -0,0 +1,268 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Limits keeping backups from starving services on the same host.
+
+Bandwidth of up- and downloads and the read rate of tar are limited by
+token buckets. A CPU limit caps encryption workers and compressor threads,
+and nice and ionice lower the priority of this process, which tar, the
+compressors and the workers inherit. All limits may be restricted to hours
+of the day. Token buckets follow the clock, so a run is throttled only while
+the hours last. Workers and priorities cannot change while running, they
+are set when a run starts.
+"""
+
+import os
+import re
+from datetime import datetime
+from io import RawIOBase
+from logging import getLogger
+from shutil import which
+from subprocess import CalledProcessError, run
+from threading import Lock
+from time import monotonic, sleep
+from typing import IO, Callable, Optional, Tuple
+
+# I/O scheduling classes of ionice
+IONICE_CLASSES = {"best-effort": ["-c2", "-n7"], "idle": ["-c3"]}
+HOURS_PATTERN = re.compile(r"(\d{1,2}):(\d{2})-(\d{1,2}):(\d{2})")
+logger = getLogger(__file__)
+
+
+def parse_hours(value: str) -> str:
+    """Validate hours of the day like "08:00-20:00".
+
+    Args:
+        value (str): start and end, the end may be past midnight
+
+    Raises:
+        ValueError: invalid hours
+
+    Returns:
+        str: hours
+    """
+    match = HOURS_PATTERN.fullmatch(str(value).strip())
+    # 24:00 is the only time past 23:59, the end of the day
+    if match is None or any(
+        int(minute) > 59 or int(hour) > 23 and (hour, minute) != ("24", "00")
+        for hour, minute in (match.group(1, 2), match.group(3, 4))
+    ):
+        raise ValueError(f"Expected hours like 08:00-20:00, got {value}.")
+    return match[0]
+
+
+def is_active(hours: Optional[str], now: Optional[datetime] = None) -> bool:
+    """Check if limits apply at a time.
+
+    Args:
+        hours (Optional[str]): hours of the day limits apply, None for
+            always
+        now (Optional[datetime], optional): Local time. Defaults to now.
+
+    Returns:
+        bool: True if limits apply
+    """
+    if hours is None:
+        return True
+    if now is None:
+        now = datetime.now()
+    match = HOURS_PATTERN.fullmatch(hours)
+    start = int(match[1])*60 + int(match[2])
+    end = int(match[3])*60 + int(match[4])
+    minute = now.hour*60 + now.minute
+    if start <= end:
+        return start <= minute < end
+    return minute >= start or minute < end
+
+
+class TokenBucket:
+    """Limit the rate of bytes passing, shared by threads.
+
+    Callers take tokens for the bytes they are about to pass and sleep
+    until the bucket refills. Bursts of up to a second at the full rate
+    pass without waiting.
+    """
+
+    def __init__(
+        self,
+        rate: int,
+        hours: Optional[str] = None,
+        clock: Callable[[], float] = monotonic,
+        wait: Callable[[float], None] = sleep
+    ) -> None:
+        """TokenBucket constructor.
+
+        Args:
+            rate (int): bytes per second
+            hours (Optional[str], optional): Hours of the day the limit
+                applies, checked on every call. Defaults to always.
+            clock (Callable[[], float], optional): Seconds of a monotonic
+                clock. Defaults to time.monotonic.
+            wait (Callable[[float], None], optional): Sleeps for seconds.
+                Defaults to time.sleep.
+        """
+        self.rate = rate
+        self.hours = hours
+        self._clock = clock
+        self._wait = wait
+        self._lock = Lock()
+        self._tokens = float(rate)
+        self._last = clock()
+
+    def consume(self, size: int) -> None:
+        """Take tokens for size bytes, waiting until they are available.
+
+        Args:
+            size (int): number of bytes
+        """
+        if not is_active(self.hours):
+            return
+        with self._lock:
+            now = self._clock()
+            self._tokens = min(
+                self.rate, self._tokens + (now - self._last)*self.rate
+            )
+            self._last = now
+            # take tokens ahead, later callers wait behind this one
+            self._tokens -= size
+            delay = -self._tokens / self.rate
+        if delay > 0:
+            self._wait(delay)
+
+
+def rate_limit(
+    rate: Optional[int],
+    hours: Optional[str] = None
+) -> Optional[TokenBucket]:
+    """Create token bucket if a rate is configured.
+
+    Args:
+        rate (Optional[int]): bytes per second, None for unlimited
+        hours (Optional[str], optional): Hours of the day the limit
+            applies. Defaults to always.
+
+    Returns:
+        Optional[TokenBucket]: token bucket, None if unlimited
+    """
+    return None if rate is None else TokenBucket(rate, hours)
+
+
+class _ThrottledReader(RawIOBase):
+    """Readable stream passing bytes at a limited rate."""
+
+    def __init__(self, bytesio: IO[bytes], bucket: TokenBucket) -> None:
+        """_ThrottledReader constructor.
+
+        Args:
+            bytesio (IO[bytes]): readable stream
+            bucket (TokenBucket): rate limit
+        """
+        self._bytesio = bytesio
+        self._bucket = bucket
+
+    def readable(self) -> bool:
+        """Stream is readable.
+
+        Returns:
+            bool: True
+        """
+        return True
+
+    def readinto(self, buffer: memoryview) -> int:
+        """Read into buffer, waiting for tokens afterwards.
+
+        Args:
+            buffer (memoryview): buffer to fill
+
+        Returns:
+            int: number of bytes read, 0 at end of stream
+        """
+        size = self._bytesio.readinto(buffer)
+        if size:
+            self._bucket.consume(size)
+        return size
+
+
+def throttle(
+    bytesio: IO[bytes],
+    bucket: Optional[TokenBucket]
+) -> IO[bytes]:
+    """Limit the read rate of a stream.
+
+    Reading slower than the producer writes stops a producing subprocess,
+    e.g. tar, once the pipe is full.
+
+    Args:
+        bytesio (IO[bytes]): readable stream
+        bucket (Optional[TokenBucket]): rate limit, None for unlimited
+
+    Returns:
+        IO[bytes]: readable stream
+    """
+    if bucket is None:
+        return bytesio
+    return _ThrottledReader(bytesio, bucket)
+
+
+def limit_cpu(
+    workers: int,
+    cpu_limit: Optional[int],
+    hours: Optional[str] = None,
+    now: Optional[datetime] = None
+) -> Tuple[int, Optional[int]]:
+    """Cap workers and compressor threads at the CPU limit.
+
+    Args:
+        workers (int): requested number of workers
+        cpu_limit (Optional[int]): maximum number of cores, None for
+            unlimited
+        hours (Optional[str], optional): Hours of the day the limit
+            applies. Defaults to always.
+        now (Optional[datetime], optional): Local start time of the run.
+            Defaults to now.
+
+    Returns:
+        Tuple[int, Optional[int]]: number of workers and of compressor
+            threads, None for all cores
+    """
+    if cpu_limit is None or not is_active(hours, now):
+        return workers, None
+    return max(1, min(workers, cpu_limit)), max(1, cpu_limit)
+
+
+def lower_priority(
+    nice: Optional[int],
+    ionice: Optional[str],
+    hours: Optional[str] = None,
+    now: Optional[datetime] = None
+) -> None:
+    """Lower CPU and I/O priority of this process and future children.
+
+    Setting the priority again has no further effect. Failures are logged,
+    e.g. if ionice is not installed.
+
+    Args:
+        nice (Optional[int]): niceness, None to keep it
+        ionice (Optional[str]): one of IONICE_CLASSES, None to keep it
+        hours (Optional[str], optional): Hours of the day the priority is
+            lowered. Defaults to always.
+        now (Optional[datetime], optional): Local start time of the run.
+            Defaults to now.
+    """
+    if not is_active(hours, now):
+        return
+    if nice is not None:
+        try:
+            os.setpriority(os.PRIO_PROCESS, 0, nice)
+        except PermissionError:
+            logger.warning("Not permitted to set niceness %d.", nice)
+    if ionice is not None:
+        if which("ionice") is None:
+            logger.warning("ionice is not installed.")
+            return
+        try:
+            run(
+                ["ionice", *IONICE_CLASSES[ionice], "-p", str(os.getpid())],
+                check=True, capture_output=True, text=True
+            )
+        except CalledProcessError as error:
+            logger.warning("Running ionice failed: %s", error.stderr)
@@ -0,0 +1,369 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Check backups in the bucket without restoring them.
+
+A full check streams every container and authenticates each of its blocks
+in parallel worker processes, then compares the block index at its end
+with the blocks read. Optionally the archive is decompressed and parsed,
+discarding the data. Nothing is written to disk and memory is bounded like
+a streamed restore.
+
+A fast check reads only the header, the block index and the first and
+last block of each container and asks S3 for the checksum it validated on
+upload. Manifests of deduplicated, incremental and sharded backups are
+decrypted and the files they reference are checked to exist.
+"""
+
+import tarfile
+from io import BufferedReader, BytesIO
+from logging import getLogger
+from time import perf_counter
+from typing import IO, Any, Callable, Dict, Iterator, List, NamedTuple, \
+    Optional
+
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+from .catalog import BackupInfo
+from .compression import LEGACY_CODEC, get_codec
+from .dedup import CHUNK_PREFIX
+from .documents import \
+    FILES_SUFFIX, INDEX_SUFFIX, MANIFEST_SUFFIX, SHARDS_SUFFIX, \
+    download_document
+from .frames import decompress_frames
+from .incremental import LEVEL_SUFFIX
+from .mycrypt import \
+    BLOCK_HEADER_SIZE, FOOTER, HEADER_PREFETCH, INDEX_ENTRY, INDEX_MAGIC, \
+    PADDING, TAG_SIZE, SeekableDecryptor, decrypt_stream, \
+    open_decrypt_stream, read_header
+from .storage import AWSBucket
+from .streams import IteratorReader
+
+DOCUMENT_SUFFIXES = \
+    (INDEX_SUFFIX, MANIFEST_SUFFIX, FILES_SUFFIX, SHARDS_SUFFIX)
+READ_SIZE = 2**20
+logger = getLogger(__file__)
+
+
+class VerifyError(Exception):
+    """Backup is damaged or incomplete."""
+
+
+class VerifyResult(NamedTuple):
+    """Outcome of checking a file."""
+
+    name: str
+    # None on success
+    error: Optional[str]
+    # bytes downloaded
+    size: int
+    seconds: float
+
+
+def _check_index(
+    trailer: bytes,
+    header_size: int,
+    block_size: int,
+    plain_sizes: List[int]
+) -> None:
+    """Compare block index recorded at backup time with the blocks read.
+
+    Args:
+        trailer (bytes): bytes after the final block
+        header_size (int): size of container header
+        block_size (int): plain text size of all but the last block
+        plain_sizes (List[int]): plain text size of each block read
+
+    Raises:
+        VerifyError: index differs
+    """
+    if any(size != block_size for size in plain_sizes[:-1]):
+        raise VerifyError("Blocks differ from the block size of the header.")
+    index = []
+    offset = header_size
+    plain_offset = 0
+    for size in plain_sizes:
+        index.append(INDEX_ENTRY.pack(offset, plain_offset))
+        offset += BLOCK_HEADER_SIZE + size + TAG_SIZE
+        plain_offset += size
+    if trailer != b"".join(index) + \
+            FOOTER.pack(len(plain_sizes), plain_offset, INDEX_MAGIC):
+        raise VerifyError("Block index does not match the blocks.")
+
+
+def _parse_archive(
+    metadata: Dict[str, Any],
+    bytesio: IO[bytes],
+    workers: int,
+    max_frames_in_flight: Optional[int] = None
+) -> int:
+    """Decompress and parse tar archive, discarding the data.
+
+    Args:
+        metadata (Dict[str, Any]): container metadata
+        bytesio (IO[bytes]): readable decrypted archive
+        workers (int): number of decompressing threads of framed archives
+        max_frames_in_flight (Optional[int], optional): Maximum number of
+            frames being decompressed. Defaults to two per worker.
+
+    Raises:
+        tarfile.TarError: archive is damaged
+
+    Returns:
+        int: number of members
+    """
+    codec = metadata.get("compression", LEGACY_CODEC)
+    if codec == "framed":
+        archive_bytes: IO[bytes] = BufferedReader(IteratorReader(
+            decompress_frames(bytesio, workers, max_frames_in_flight)
+        ))
+    else:
+        archive_bytes = get_codec(codec).decompress_stream(bytesio)
+    members = 0
+    with tarfile.open(fileobj=archive_bytes, mode="r|") as archive:
+        for _ in archive:
+            members += 1
+    return members
+
+
+def verify_container(
+    aws: AWSBucket,
+    name: str,
+    private_key: rsa.RSAPrivateKey,
+    workers: int = 1,
+    unpack: bool = False,
+    max_blocks_in_flight: Optional[int] = None,
+    max_frames_in_flight: Optional[int] = None,
+    count: Optional[Callable[[IO[bytes]], IO[bytes]]] = None
+) -> int:
+    """Download and authenticate every block of a container.
+
+    Args:
+        aws (AWSBucket): bucket connector
+        name (str): name of file in bucket
+        private_key (rsa.RSAPrivateKey): Private key used for encryption.
+        workers (int, optional): Number of decryption processes.
+            Defaults to 1.
+        unpack (bool, optional): Also decompress and parse the archive.
+            Defaults to False.
+        max_blocks_in_flight (Optional[int], optional): Maximum number of
+            blocks being decrypted. Defaults to BLOCKS_IN_FLIGHT_PER_WORKER
+            per worker.
+        max_frames_in_flight (Optional[int], optional): Maximum number of
+            frames being decompressed. Defaults to two per worker.
+        count (Optional[Callable[[IO[bytes]], IO[bytes]]], optional):
+            Wraps the downloaded stream, e.g. to count its bytes.
+            Defaults to None.
+
+    Raises:
+        VerifyError: block index does not match
+        cryptography.exceptions.InvalidTag: block is damaged
+        AsymmetricFernetError: container is truncated
+
+    Returns:
+        int: size of the container in bytes
+    """
+    reader = aws.range_reader(name)
+    bytesio = aws.download_stream(name, reader)
+    if count is not None:
+        bytesio = count(bytesio)
+    metadata, blocks = open_decrypt_stream(
+        private_key, bytesio, workers, max_blocks_in_flight
+    )
+    plain_sizes: List[int] = []
+
+    def plain_blocks() -> Iterator[bytes]:
+        for block in blocks:
+            plain_sizes.append(len(block))
+            yield block
+
+    plain = BufferedReader(IteratorReader(plain_blocks()))
+    if unpack:
+        members = _parse_archive(
+            metadata, plain, workers, max_frames_in_flight
+        )
+        logger.debug("%s: %d members.", name, members)
+    # also the end of archive padding not read by tarfile
+    while plain.read(READ_SIZE):
+        pass
+    trailer = bytesio.read()
+    if "block_size" in metadata:
+        _check_index(
+            trailer,
+            reader[1] - len(trailer) - sum(plain_sizes)
+            - len(plain_sizes)*(BLOCK_HEADER_SIZE + TAG_SIZE),
+            metadata["block_size"], plain_sizes
+        )
+    elif trailer:
+        raise VerifyError("Data after the last block.")
+    return reader[1]
+
+
+def verify_header(
+    aws: AWSBucket,
+    name: str,
+    private_key: rsa.RSAPrivateKey
+) -> int:
+    """Check checksum, block index, first and last block of a container.
+
+    Args:
+        aws (AWSBucket): bucket connector
+        name (str): name of file in bucket
+        private_key (rsa.RSAPrivateKey): Private key used for encryption.
+
+    Raises:
+        VerifyError: object has no checksum of the configured algorithm
+        AsymmetricFernetError: block index does not fit the container
+        cryptography.exceptions.InvalidTag: block is damaged
+
+    Returns:
+        int: number of bytes read
+    """
+    algorithm = aws.settings.checksum_algorithm
+    checksum = aws.checksum(name)
+    if algorithm is not None and \
+            (checksum is None or checksum[0] != algorithm):
+        raise VerifyError(f"Object has no {algorithm} checksum.")
+    read_at, size = aws.range_reader(name)
+    header_bytes = read_at(0, min(size, HEADER_PREFETCH))
+    version, _, key_encrypted, _ = read_header(BytesIO(header_bytes))
+    if version == 1:
+        # v1 containers have no index, only the key can be checked
+        private_key.decrypt(key_encrypted, PADDING)
+        return len(header_bytes)
+    SeekableDecryptor(private_key, read_at, size).check()
+    return len(header_bytes)
+
+
+def _referenced(name: str, document: Dict[str, Any]) -> List[str]:
+    """List files a manifest refers to.
+
+    Args:
+        name (str): name of document in bucket
+        document (Dict[str, Any]): decrypted document
+
+    Returns:
+        List[str]: names of files in bucket
+    """
+    if name.endswith(FILES_SUFFIX):
+        return [
+            name[:-len(FILES_SUFFIX)] + LEVEL_SUFFIX.format(level)
+            for level in range(len(document["chain"]))
+        ]
+    if name.endswith(SHARDS_SUFFIX):
+        return [shard["name"] for shard in document["shards"]]
+    if name.endswith(MANIFEST_SUFFIX):
+        return [CHUNK_PREFIX + chunk_id for chunk_id, _ in document["chunks"]]
+    return []
+
+
+def verify_backup(
+    aws: AWSBucket,
+    backup: BackupInfo,
+    private_key: rsa.RSAPrivateKey,
+    fast: bool = False,
+    **options: Any
+) -> List[VerifyResult]:
+    """Check all files of a backup and the files its manifests refer to.
+
+    Failing files do not stop the check of the others.
+
+    Args:
+        aws (AWSBucket): bucket connector
+        backup (BackupInfo): backup from the catalog
+        private_key (rsa.RSAPrivateKey): Private key used for encryption.
+        fast (bool, optional): Check only checksums, block indexes and
+            manifests. Defaults to False.
+        options (Any): passed to verify_container
+
+    Returns:
+        List[VerifyResult]: result per file, chunks of a deduplicated
+            backup in one result
+    """
+    results = []
+
+    def check(name: str, func: Callable[[], int]) -> None:
+        start = perf_counter()
+        error = None
+        size = 0
+        try:
+            size = func()
+        except Exception as exc:  # pylint: disable=broad-except
+            logger.debug("Checking %s failed.", name, exc_info=True)
+            error = str(exc) or type(exc).__name__
+        results.append(VerifyResult(name, error, size, perf_counter() - start))
+
+    def check_document(name: str, size: int) -> int:
+        referenced = _referenced(
+            name, download_document(aws, name, private_key)
+        )
+        if name.endswith(MANIFEST_SUFFIX):
+            chunks = set(aws.list_files(CHUNK_PREFIX))
+            missing = [
+                file_name for file_name in referenced
+                if file_name not in chunks
+            ]
+        else:
+            missing = [
+                file_name for file_name in referenced
+                if aws.stat(file_name) is None
+            ]
+        if missing:
+            raise VerifyError(
+                f"{len(missing)} referenced files are missing, "
+                f"e.g. {missing[0]}."
+            )
+        return size
+
+    def check_chunks(name: str) -> int:
+        size = 0
+        for file_name in sorted(set(_referenced(
+            name, download_document(aws, name, private_key)
+        ))):
+            data = aws.download_bytes(file_name)
+            for _ in decrypt_stream(private_key, BytesIO(data)):
+                pass
+            size += len(data)
+        return size
+
+    for name, size in backup.files:
+        if name.endswith(DOCUMENT_SUFFIXES):
+            check(
+                name,
+                lambda name=name, size=size: check_document(name, size)
+            )
+            if name.endswith(MANIFEST_SUFFIX) and not fast:
+                check(
+                    name + " chunks", lambda name=name: check_chunks(name)
+                )
+        elif fast:
+            check(
+                name, lambda name=name: verify_header(aws, name, private_key)
+            )
+        else:
+            check(name, lambda name=name: verify_container(
+                aws, name, private_key, **options
+            ))
+    return results
+
+
+def log_results(results: List[VerifyResult]) -> None:
+    """Log outcome of each check.
+
+    Args:
+        results (List[VerifyResult]): results of verify_backup
+    """
+    for result in results:
+        if result.error is None:
+            logger.info(
+                "OK     %s (%.1f MiB, %.1f s)",
+                result.name, result.size / 2**20, result.seconds
+            )
+        else:
+            logger.error(
+                "FAILED %s (%.1f s): %s",
+                result.name, result.seconds, result.error
+            )
+    failed = sum(result.error is not None for result in results)
+    logger.info(
+        "%d of %d files are intact.", len(results) - failed, len(results)
+    )
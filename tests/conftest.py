@@ -0,0 +1,27 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Fixtures shared by tests."""
+
+import pytest
+
+from dockerVolumeBackup.storage import AWSBucket
+
+
+@pytest.fixture(name="bucket")
+def fixture_bucket(monkeypatch: pytest.MonkeyPatch):
+    """Create bucket in mocked S3.
+
+    Args:
+        monkeypatch (pytest.MonkeyPatch): patch environment
+
+    Yields:
+        AWSBucket: connector to empty bucket
+    """
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "testing")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "testing")
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+    moto = pytest.importorskip("moto")
+    with moto.mock_aws():
+        from boto3 import client
+        client("s3").create_bucket(Bucket="test-bucket")
+        yield AWSBucket("test-bucket")
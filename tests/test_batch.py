@@ -0,0 +1,52 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Test batch backups."""
+
+from io import BytesIO, StringIO
+from pathlib import Path
+
+import pytest
+
+from dockerVolumeBackup.batch import Job, read_jobs, run_jobs
+from dockerVolumeBackup.mycrypt import \
+    decrypt_stream, gen_certificate, load_private_key, load_public_key
+from dockerVolumeBackup.storage import AWSBucket
+
+
+def test_read_jobs():
+    """Test parsing job lists."""
+    assert read_jobs(StringIO("# comment\n\n/data/0  volume-backup/a\n")) \
+        == [Job(Path("/data/0"), "volume-backup/a")]
+    with pytest.raises(ValueError):
+        read_jobs(StringIO("/data/0\n"))
+
+
+def test_run_jobs(bucket: AWSBucket, tmp_path: Path):
+    """Test that failing jobs do not affect others.
+
+    Args:
+        bucket (AWSBucket): mocked bucket
+        tmp_path (Path): temporary directory
+    """
+    priv, pub = gen_certificate()
+    for name in ("full", "empty"):
+        (tmp_path/name).mkdir()
+    (tmp_path/"full/file").write_text("content")
+    results = run_jobs(
+        bucket,
+        [
+            Job(tmp_path/"full", "a"), Job(tmp_path/"empty", "b"),
+            Job(tmp_path/"missing", "c"), Job(tmp_path/"full", "d")
+        ],
+        load_public_key(BytesIO(pub)), tmp_path/"tmp",
+        pack_slots=2, upload_slots=2, codec="none"
+    )
+    assert [result.error is None for result in results] == \
+        [True, False, False, True]
+    assert list(bucket.list_files()) == ["a", "d"]
+    assert list((tmp_path/"tmp").iterdir()) == []
+    archive = b"".join(decrypt_stream(
+        load_private_key(BytesIO(priv), None),
+        BytesIO(bucket.download_bytes("a"))
+    ))
+    assert b"content" in archive
@@ -0,0 +1,50 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Test benchmark suite."""
+
+import json
+from pathlib import Path
+
+from dockerVolumeBackup.benchmark import \
+    DATASETS, compare_reports, generate_dataset, run_benchmark, write_report
+from dockerVolumeBackup.storage import MiB, TransferSettings
+
+
+def test_generate_dataset(tmp_path: Path):
+    """Test that datasets are reproducible.
+
+    Args:
+        tmp_path (Path): temporary directory
+    """
+    for dataset in DATASETS:
+        size = generate_dataset(dataset, tmp_path/"a"/dataset, MiB)
+        assert size == generate_dataset(dataset, tmp_path/"b"/dataset, MiB)
+        files = sorted(
+            path.relative_to(tmp_path/"a")
+            for path in (tmp_path/"a"/dataset).rglob("*") if path.is_file()
+        )
+        assert files
+        for path in files:
+            assert (tmp_path/"a"/path).read_bytes() == \
+                (tmp_path/"b"/path).read_bytes()
+
+
+def test_run_benchmark(tmp_path: Path):
+    """Test measuring local stages and comparing reports.
+
+    Args:
+        tmp_path (Path): temporary directory
+    """
+    results = run_benchmark(
+        tmp_path/"work", None, TransferSettings(), ["compressible"],
+        ["pack", "encrypt", "decrypt", "upload"], ["none"], MiB
+    )
+    assert [result.stage for result in results] == \
+        ["pack_none", "encrypt", "decrypt"]
+    assert all(result.peak_rss > 0 for result in results)
+    assert not (tmp_path/"work").exists()
+
+    write_report(tmp_path/"report.json", results, {"size": MiB})
+    report = json.loads((tmp_path/"report.json").read_text())
+    assert report["results"][0]["bytes"] == MiB
+    assert len(compare_reports(report, report)) == 3
@@ -0,0 +1,79 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Test fitting pipeline buffers into a memory limit."""
+
+from threading import Thread
+
+import pytest
+
+from dockerVolumeBackup.budget import MIN_PART_SIZE, plan_memory
+from dockerVolumeBackup.storage import MAX_PARTS, MiB, TransferSettings
+from dockerVolumeBackup.streams import BufferPool
+
+
+def test_plan_memory():
+    """Test that windows shrink to the limit but not below minimums."""
+    unlimited = plan_memory(TransferSettings(), MiB, 4, framed=True)
+    assert unlimited.settings == TransferSettings()
+    assert (unlimited.blocks_in_flight, unlimited.frames_in_flight) == \
+        (8, 8)
+
+    for limit in (1024, 256, 64, 40):
+        settings = TransferSettings(max_memory=limit*MiB)
+        for upload in (True, False):
+            plan = plan_memory(settings, MiB, 4, upload, framed=True)
+            assert plan.size <= limit*MiB
+            assert plan.settings.part_size >= MIN_PART_SIZE
+            assert plan.settings.max_concurrency >= 1
+    # large limits keep the defaults
+    assert plan_memory(
+        TransferSettings(max_memory=1024*MiB), MiB, 4
+    ).settings.part_size == 64*MiB
+
+    with pytest.raises(ValueError):
+        plan_memory(TransferSettings(max_memory=20*MiB), MiB, 4)
+
+
+def test_plan_memory_parts():
+    """Test that parts fit large streams into MAX_PARTS or planning fails."""
+    stream_size = 400*10**9
+    settings = TransferSettings(max_memory=128*MiB)
+    # without a size, parts shrink below what the stream needs
+    assert plan_memory(settings, MiB, 4).settings.part_size*MAX_PARTS < \
+        stream_size
+    plan = plan_memory(settings, MiB, 4, stream_size=stream_size)
+    assert plan.settings.part_size*MAX_PARTS >= stream_size
+    assert plan.size <= 128*MiB
+    # block and frame windows make room for the parts
+    assert plan.blocks_in_flight < 8
+    # parts grow beyond the default for streams larger than 640 GB
+    assert plan_memory(
+        TransferSettings(), MiB, 4, stream_size=10**12
+    ).settings.part_size*MAX_PARTS >= 10**12
+
+    # frames or shards sharing the limit leave no room for such parts
+    with pytest.raises(ValueError):
+        plan_memory(settings, MiB, 4, framed=True, stream_size=stream_size)
+    with pytest.raises(ValueError):
+        plan_memory(
+            settings, MiB, 4, pipelines=4, stream_size=stream_size // 4
+        )
+
+
+def test_buffer_pool():
+    """Test that taking a buffer waits until one is returned."""
+    pool = BufferPool(2, 10)
+    first, second = pool.get(), pool.get()
+    assert pool.in_flight == 20
+    taken = []
+    thread = Thread(target=lambda: taken.append(pool.get()))
+    thread.start()
+    thread.join(0.1)
+    assert not taken
+    pool.put(first)
+    thread.join()
+    assert taken == [first]
+    pool.put(second)
+    pool.put(taken[0])
+    assert pool.in_flight == 0
+    assert pool.peak == 20
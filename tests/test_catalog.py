@@ -0,0 +1,80 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Test local catalog of backups."""
+
+from io import BytesIO
+from pathlib import Path
+
+import pytest
+
+from dockerVolumeBackup.catalog import Catalog
+from dockerVolumeBackup.mycrypt import \
+    encrypt_stream, gen_certificate, load_public_key
+from dockerVolumeBackup.storage import AWSBucket
+
+
+def test_catalog(bucket: AWSBucket, tmp_path: Path):
+    """Test grouping files to backups and resuming syncs.
+
+    Args:
+        bucket (AWSBucket): mocked bucket
+        tmp_path (Path): temporary directory
+    """
+    public_key = load_public_key(BytesIO(gen_certificate()[1]))
+
+    def container(codec: str) -> bytes:
+        return b"".join(encrypt_stream(
+            BytesIO(b"data"), public_key, metadata={"compression": codec}
+        ))
+
+    bucket.upload_bytes(container("zstd"), "vol")
+    bucket.upload_bytes(container("framed"), "sub/framed")
+    bucket.upload_bytes(b"index", "sub/framed.index")
+    bucket.upload_bytes(b"manifest", "dedup.dedup")
+    bucket.upload_bytes(b"chunk", "chunks/0123")
+    bucket.upload_bytes(b"files", "chain.files")
+    bucket.upload_bytes(container("framed"), "chain.0000")
+    bucket.upload_bytes(b"shards", "sharded.shards")
+    bucket.upload_bytes(container("lz4"), "sharded.shard0000")
+
+    list_page = bucket.list_page
+    listed = []
+
+    def failing_list_page(prefix, delimiter, token):
+        if prefix == "sub/":
+            raise OSError("interrupted")
+        listed.append(prefix)
+        return list_page(prefix, delimiter, token)
+
+    catalog = Catalog(tmp_path/"catalog.sqlite")
+    bucket.list_page = failing_list_page
+    with pytest.raises(OSError):
+        catalog.sync(bucket)
+    assert not catalog.is_synced()
+    bucket.list_page = list_page
+    catalog.sync(bucket)
+    assert catalog.is_synced()
+    # the root prefix was listed before the interruption only
+    assert listed == [""]
+    assert [
+        (backup.name, backup.kind, backup.codec)
+        for backup in catalog.backups()
+    ] == [
+        ("chain", "incremental", "framed"),
+        ("dedup", "dedup", None),
+        ("sharded", "sharded", "lz4"),
+        ("sub/framed", "framed", "framed"),
+        ("vol", "archive", "zstd"),
+    ]
+    assert catalog.info("sub/framed").files == [
+        ("sub/framed", len(container("framed"))),
+        ("sub/framed.index", 5)
+    ]
+
+    bucket.delete(["vol"])
+    catalog.update(bucket, ["vol"])
+    assert catalog.info("vol") is None
+    bucket.delete(["dedup.dedup"])
+    catalog.sync(bucket)
+    assert [backup.name for backup in catalog.backups()] == \
+        ["chain", "sharded", "sub/framed"]
@@ -0,0 +1,43 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Test compression codec registry."""
+
+from random import randbytes
+
+import pytest
+
+from dockerVolumeBackup import compression
+from dockerVolumeBackup.compression import CODECS, select_codec, tar_options
+from dockerVolumeBackup.frames import decode_frame, encode_frame
+
+
+def test_codecs():
+    """Test frame roundtrip, tar options and codec selection."""
+    test_bytes = randbytes(1000) + bytes(10000)
+    for codec in CODECS:
+        assert decode_frame(encode_frame(test_bytes, codec)) == test_bytes
+        assert decode_frame(encode_frame(test_bytes, codec, 1)) == test_bytes
+    assert tar_options("none") == []
+    assert tar_options("zstd", 19) == ["-Izstd -T0 -19"]
+    assert tar_options("zstd", 19, decompress=True) == ["-Izstd -T0"]
+    assert tar_options("pbzip2", threads=2) == ["-Ipbzip2 -p2 -9"]
+    assert tar_options("lz4", threads=2) == ["-Ilz4 -1"]
+
+    assert select_codec(test_bytes, float("inf")) == "none"
+    assert select_codec(test_bytes, 0) != "none"
+
+
+def test_select_available_codec(monkeypatch: pytest.MonkeyPatch):
+    """Test that codecs without installed program are not selected.
+
+    Args:
+        monkeypatch (pytest.MonkeyPatch): hide programs
+    """
+    test_bytes = randbytes(1000) + bytes(10000)
+    monkeypatch.setattr(
+        compression, "which",
+        lambda program: "/usr/bin/lz4" if program == "lz4" else None
+    )
+    assert select_codec(test_bytes, 0) == "lz4"
+    monkeypatch.setattr(compression, "which", lambda program: None)
+    assert select_codec(test_bytes, 0) == "none"
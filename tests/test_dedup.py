@@ -0,0 +1,130 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Test deduplicating backup store."""
+
+from datetime import datetime, timedelta, timezone
+from io import BytesIO
+from pathlib import Path
+from random import Random
+
+import pytest
+
+from dockerVolumeBackup import dedup
+from dockerVolumeBackup.dedup import \
+    CHUNK_PREFIX, MAX_CHUNK_SIZE, ChunkIndex, ConcurrentRunError, \
+    backup_dedup, chunk_stream, collect_garbage
+from dockerVolumeBackup.documents import MANIFEST_SUFFIX
+from dockerVolumeBackup.mycrypt import \
+    gen_certificate, load_private_key, load_public_key
+from dockerVolumeBackup.storage import AWSBucket
+
+
+def test_chunk_stream():
+    """Test that chunks survive an insertion before them."""
+    test_bytes = Random(0).randbytes(20*2**20)
+    chunks = list(chunk_stream(BytesIO(test_bytes)))
+    assert b"".join(chunks) == test_bytes
+    assert max(len(chunk) for chunk in chunks) <= MAX_CHUNK_SIZE
+    assert len(chunks) > 4
+
+    shifted = list(chunk_stream(BytesIO(b"inserted" + test_bytes)))
+    assert b"".join(shifted) == b"inserted" + test_bytes
+    # only chunks up to the first content defined boundary change
+    assert set(chunks[2:]) <= set(shifted)
+
+
+def test_collect_garbage(
+    bucket: AWSBucket,
+    tmp_path: Path,
+    monkeypatch: pytest.MonkeyPatch
+):
+    """Test that backups with an index older than a collection reupload.
+
+    Args:
+        bucket (AWSBucket): mocked bucket
+        tmp_path (Path): temporary directory
+        monkeypatch (pytest.MonkeyPatch): patch grace period and working
+            directory
+    """
+    monkeypatch.setattr(dedup, "GC_GRACE_PERIOD", timedelta(seconds=-5))
+    monkeypatch.chdir(tmp_path)
+    (tmp_path/"data").mkdir()
+    (tmp_path/"data"/"file").write_bytes(Random(0).randbytes(2**20))
+    priv, pub = gen_certificate()
+    public_key = load_public_key(BytesIO(pub))
+    private_key = load_private_key(BytesIO(priv), None)
+    stale_index = ChunkIndex(tmp_path/"stale.sqlite")
+    backup_dedup(bucket, Path("data"), "old", public_key, stale_index)
+    chunks = set(bucket.list_files(CHUNK_PREFIX))
+    assert chunks
+
+    # another host collects the chunks once the only backup is deleted
+    bucket.delete(["old" + MANIFEST_SUFFIX])
+    assert len(collect_garbage(
+        bucket, private_key, ChunkIndex(tmp_path/"other.sqlite")
+    )) == len(chunks)
+    assert not list(bucket.list_files(CHUNK_PREFIX))
+    backup_dedup(bucket, Path("data"), "new", public_key, stale_index)
+    assert set(bucket.list_files(CHUNK_PREFIX)) == chunks
+
+    # backups and collections exclude each other
+    bucket.upload_bytes(b"{}", dedup.BACKUP_LOCK_PREFIX + "running")
+    with pytest.raises(ConcurrentRunError):
+        collect_garbage(bucket, private_key, stale_index)
+    bucket.delete([dedup.BACKUP_LOCK_PREFIX + "running"])
+    dedup._write_gc_marker(
+        bucket, "running", True, datetime.now(timezone.utc)
+    )
+    with pytest.raises(ConcurrentRunError):
+        backup_dedup(bucket, Path("data"), "new", public_key, stale_index)
+    assert not list(bucket.list_files(dedup.BACKUP_LOCK_PREFIX))
+
+
+def test_collect_garbage_errors(
+    bucket: AWSBucket,
+    tmp_path: Path,
+    monkeypatch: pytest.MonkeyPatch
+):
+    """Test that chunks which were not deleted stay in the index.
+
+    Args:
+        bucket (AWSBucket): mocked bucket
+        tmp_path (Path): temporary directory
+        monkeypatch (pytest.MonkeyPatch): patch grace period, working
+            directory and deletion
+    """
+    monkeypatch.setattr(dedup, "GC_GRACE_PERIOD", timedelta(seconds=-5))
+    monkeypatch.chdir(tmp_path)
+    priv, pub = gen_certificate()
+    public_key = load_public_key(BytesIO(pub))
+    private_key = load_private_key(BytesIO(priv), None)
+    index = ChunkIndex(tmp_path/"index.sqlite")
+    chunks = []
+    for seed, name in enumerate(("host/kept", "old")):
+        (tmp_path/name).mkdir(parents=True)
+        (tmp_path/name/"file").write_bytes(Random(seed).randbytes(2**20))
+        backup_dedup(bucket, Path(name), name, public_key, index)
+        chunks.append(set(bucket.list_files(CHUNK_PREFIX)))
+    kept = chunks[0]
+    garbage = chunks[1] - kept
+    bucket.delete(["old" + MANIFEST_SUFFIX])
+    denied = min(garbage)
+    delete_objects = bucket.client.delete_objects
+
+    def deny(Delete, **kwargs):
+        objects = [
+            item for item in Delete["Objects"] if item["Key"] != denied
+        ]
+        if objects:
+            delete_objects(Delete={**Delete, "Objects": objects}, **kwargs)
+        return {"Errors": [
+            {"Key": denied, "Code": "AccessDenied", "Message": "Denied"}
+        ]}
+
+    monkeypatch.setattr(bucket.client, "delete_objects", deny)
+    # manifests below directories are read, the chunks are skipped
+    collected = collect_garbage(bucket, private_key, index)
+    assert sorted(CHUNK_PREFIX + chunk_id for chunk_id in collected) == \
+        sorted(garbage - {denied})
+    assert set(bucket.list_files(CHUNK_PREFIX)) == kept | {denied}
+    assert denied.removeprefix(CHUNK_PREFIX) in index
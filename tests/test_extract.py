@@ -0,0 +1,150 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Test extraction of tar streams with parallel writers."""
+
+import os
+import tarfile
+from io import BytesIO
+from pathlib import Path
+
+import pytest
+
+from dockerVolumeBackup.compression import get_codec
+from dockerVolumeBackup.extract import SMALL_FILE_SIZE, extract_stream
+from dockerVolumeBackup.incremental import scan_tree
+from dockerVolumeBackup.tar import pack_stream
+
+
+@pytest.mark.parametrize("codec", ["none", "zstd"])
+def test_extract_roundtrip(
+    tmp_path: Path,
+    monkeypatch: pytest.MonkeyPatch,
+    codec: str
+):
+    """Test content, links and metadata of extracted files.
+
+    Args:
+        tmp_path (Path): temporary directory
+        monkeypatch (pytest.MonkeyPatch): patch working directory
+        codec (str): codec name
+    """
+    root = tmp_path/"data"
+    (root/"dir/sub").mkdir(parents=True)
+    for index in range(50):
+        (root/"dir"/f"{index}").write_bytes(os.urandom(index*100))
+    (root/"dir/large").write_bytes(os.urandom(SMALL_FILE_SIZE + 1))
+    os.link(root/"dir/7", root/"dir/sub/link")
+    (root/"symlink").symlink_to("dir/7")
+    (root/"dir/3").chmod(0o604)
+    os.utime(root/"dir/5", (1000000000, 1000000000))
+    (root/"dir/sub").chmod(0o700)
+    os.utime(root/"dir", (1000000000, 1000000000))
+
+    target = tmp_path/"restored"
+    target.mkdir()
+    # files in the way are overwritten, symlinks are not followed
+    (target/"data/dir").mkdir(parents=True)
+    (target/"data/dir/0").symlink_to(tmp_path/"outside")
+    monkeypatch.chdir(tmp_path)
+    compress = get_codec(codec).compress
+    with pack_stream(Path("data")) as bytesio:
+        data = compress(bytesio.read(), get_codec(codec).default_level)
+    with extract_stream(4, codec, target) as archive:
+        archive.write(data)
+
+    restored = target/"data"
+    assert not (tmp_path/"outside").exists()
+    assert scan_tree(restored).keys() == scan_tree(root).keys()
+    for index in (0, 10, 49):
+        assert (restored/"dir"/f"{index}").read_bytes() == \
+            (root/"dir"/f"{index}").read_bytes()
+    assert (restored/"dir/large").read_bytes() == \
+        (root/"dir/large").read_bytes()
+    assert (restored/"dir/7").stat().st_ino == \
+        (restored/"dir/sub/link").stat().st_ino
+    assert os.readlink(restored/"symlink") == "dir/7"
+    assert (restored/"dir/3").stat().st_mode & 0o777 == 0o604
+    assert (restored/"dir/5").stat().st_mtime == 1000000000
+    assert (restored/"dir/sub").stat().st_mode & 0o777 == 0o700
+    assert (restored/"dir").stat().st_mtime == 1000000000
+
+
+def test_extract_errors(tmp_path: Path):
+    """Test that truncated archives and unsafe names are not extracted.
+
+    Args:
+        tmp_path (Path): temporary directory
+    """
+    bytesio = BytesIO()
+    with tarfile.open(fileobj=bytesio, mode="w") as archive:
+        for name in ("../evil", "good"):
+            member = tarfile.TarInfo(name)
+            member.size = 4
+            archive.addfile(member, BytesIO(b"data"))
+    with extract_stream(2, root=tmp_path) as archive:
+        archive.write(bytesio.getvalue())
+    assert os.listdir(tmp_path) == ["good"]
+    assert not (tmp_path.parent/"evil").exists()
+
+    with pytest.raises(tarfile.TarError):
+        with extract_stream(2, root=tmp_path) as archive:
+            archive.write(bytesio.getvalue()[:700])
+
+
+def test_extract_sync(tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
+    """Test that sync writes only changed files and deletes missing ones.
+
+    Args:
+        tmp_path (Path): temporary directory
+        monkeypatch (pytest.MonkeyPatch): patch working directory
+    """
+    root = tmp_path/"data"
+    (root/"dir").mkdir(parents=True)
+    for index in range(5):
+        (root/"dir"/f"{index}").write_bytes(os.urandom(1000))
+    (root/"large").write_bytes(os.urandom(3*SMALL_FILE_SIZE))
+    (root/"symlink").symlink_to("dir/0")
+    os.link(root/"dir/1", root/"link")
+    # changes below must not happen in the second of the backup
+    for path in (*(root/"dir").iterdir(), root/"large"):
+        os.utime(path, (1000000000, 1000000000))
+    monkeypatch.chdir(tmp_path)
+    with pack_stream(Path("data")) as bytesio:
+        data = bytesio.read()
+
+    target = tmp_path/"restored"
+    with extract_stream(2, root=target) as archive:
+        archive.write(data)
+    restored = target/"data"
+    # unchanged, same content with another time, changed and extra files
+    unchanged = (restored/"dir/0").stat().st_ino
+    os.utime(restored/"dir/2", (0, 0))
+    (restored/"dir/3").write_bytes(b"changed")
+    with open(restored/"large", "r+b") as bytesio:
+        bytesio.seek(SMALL_FILE_SIZE)
+        bytesio.write(b"changed")
+    (restored/"extra/sub").mkdir(parents=True)
+    (restored/"extra/sub/file").write_bytes(b"extra")
+    (restored/"dir/extra").write_bytes(b"extra")
+    (restored/"symlink").unlink()
+    (restored/"symlink").symlink_to("dir/4")
+
+    with pytest.raises(FileNotFoundError):
+        with extract_stream(
+            2, root=target, sync=True, delete=tmp_path/"other"
+        ) as archive:
+            archive.write(data)
+    assert (restored/"extra").exists()
+    with extract_stream(
+        2, root=target, sync=True, delete=restored
+    ) as archive:
+        archive.write(data)
+    assert scan_tree(restored).keys() == scan_tree(root).keys()
+    for path in ("dir/2", "dir/3", "large"):
+        assert (restored/path).read_bytes() == (root/path).read_bytes()
+    assert (restored/"dir/2").stat().st_mtime == \
+        (root/"dir/2").stat().st_mtime
+    assert (restored/"dir/0").stat().st_ino == unchanged
+    assert os.readlink(restored/"symlink") == "dir/0"
+    assert (restored/"link").stat().st_ino == \
+        (restored/"dir/1").stat().st_ino
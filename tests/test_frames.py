@@ -0,0 +1,62 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Test frame compression module."""
+
+from io import BytesIO
+from random import randbytes
+
+from dockerVolumeBackup import frames
+from dockerVolumeBackup.frames import \
+    FRAME_HEADER, compress_frames, decode_frame, decompress_frames, \
+    encode_frame, read_regions
+
+
+def test_frames(monkeypatch):
+    """Test sequential and random access decompression.
+
+    Args:
+        monkeypatch (pytest.MonkeyPatch): patch frame size
+    """
+    monkeypatch.setattr(frames, "FRAME_SIZE", 1000)
+    test_bytes = randbytes(2000) + bytes(3500)
+    frame_table = []
+    compressed = b"".join(
+        compress_frames(BytesIO(test_bytes), frame_table, workers=2)
+    )
+    assert len(frame_table) == 6
+    assert b"".join(decompress_frames(BytesIO(compressed))) == test_bytes
+
+    read_count = 0
+
+    def read_ranges(ranges):
+        nonlocal read_count
+        for offset, size in ranges:
+            read_count += 1
+            yield compressed[offset:offset + size]
+
+    regions = [(10, 20), (990, 1010), (1500, 1600), (5400, 5500)]
+    assert list(
+        read_regions(read_ranges, frame_table, len(compressed), regions)
+    ) == [
+        test_bytes[10:20], test_bytes[990:1000], test_bytes[1000:1010],
+        test_bytes[1500:1600], test_bytes[5400:5500]
+    ]
+    # frames 0, 1 and 5, each read once
+    assert read_count == 3
+
+
+def test_incompressible_frames(monkeypatch):
+    """Test that incompressible frames are stored.
+
+    Args:
+        monkeypatch (pytest.MonkeyPatch): disable sampling
+    """
+    random_bytes = randbytes(2**20)
+    frame = encode_frame(random_bytes, "zstd")
+    assert FRAME_HEADER.unpack_from(frame) == (0, 2**20, 2**20)
+    assert decode_frame(frame) == random_bytes
+    assert FRAME_HEADER.unpack_from(encode_frame(bytes(2**20)))[0] != 0
+
+    # without sampling the compressed size decides
+    monkeypatch.setattr(frames, "INCOMPRESSIBLE_RATIO", None)
+    assert FRAME_HEADER.unpack_from(encode_frame(random_bytes))[0] == 0
@@ -0,0 +1,130 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Test incremental backup module."""
+
+import bz2
+import json
+import os
+from io import BytesIO
+from pathlib import Path
+from typing import Dict
+
+import pytest
+
+from dockerVolumeBackup.documents import FILES_SUFFIX, download_document
+from dockerVolumeBackup.incremental import \
+    FILE_TYPE, apply_deletions, backup_incremental, diff_trees, \
+    restore_incremental, scan_tree
+from dockerVolumeBackup.mycrypt import \
+    gen_certificate, load_private_key, load_public_key
+from dockerVolumeBackup.storage import AWSBucket
+
+
+def _contents(root: Path) -> Dict[str, bytes]:
+    """Read all regular files below root.
+
+    Args:
+        root (Path): directory
+
+    Returns:
+        Dict[str, bytes]: content of each path relative to root
+    """
+    return {
+        path: (root/path).read_bytes()
+        for path, fields in scan_tree(root).items() if fields[FILE_TYPE] == "f"
+    }
+
+
+def test_diff_trees(tmp_path: Path):
+    """Test change detection and deletion of changed files.
+
+    Args:
+        tmp_path (Path): temporary directory
+    """
+    (tmp_path/"dir/sub").mkdir(parents=True)
+    (tmp_path/"dir/sub/file").write_text("file")
+    (tmp_path/"kept").write_text("kept")
+    (tmp_path/"changed").write_text("changed")
+    (tmp_path/"link").symlink_to("kept")
+    previous = scan_tree(tmp_path, checksum=True)
+    assert set(previous) == \
+        {"dir", "dir/sub", "dir/sub/file", "kept", "changed", "link"}
+    assert diff_trees(previous, scan_tree(tmp_path)) == ([], [])
+
+    (tmp_path/"dir/sub/file").unlink()
+    (tmp_path/"dir/sub").rmdir()
+    (tmp_path/"changed").write_text("CHANGED")
+    (tmp_path/"link").unlink()
+    (tmp_path/"link").mkdir()
+    (tmp_path/"new").write_text("new")
+    changed, deleted = diff_trees(previous, scan_tree(tmp_path, True))
+    assert changed == ["changed", "dir", "link", "new"]
+    assert deleted == ["dir/sub", "dir/sub/file", "link"]
+
+    apply_deletions(tmp_path, ["dir", "kept", "missing"])
+    assert sorted(path.name for path in tmp_path.iterdir()) == \
+        ["changed", "link", "new"]
+
+
+def test_incremental_chain(
+    bucket: AWSBucket,
+    tmp_path: Path,
+    monkeypatch: pytest.MonkeyPatch
+):
+    """Test a chain of three levels, restoring the latest and an older one.
+
+    Args:
+        bucket (AWSBucket): mocked bucket
+        tmp_path (Path): temporary directory
+        monkeypatch (pytest.MonkeyPatch): patch working directory
+    """
+    root = tmp_path/"data"
+    (root/"dir").mkdir(parents=True)
+    (root/"dir/a").write_bytes(os.urandom(3000))
+    (root/"dir/b").write_text("b")
+    (root/"kept").write_text("kept")
+    cache_path = tmp_path/"cache/vol.files.bz2"
+    cache_path.parent.mkdir()
+    priv, pub = gen_certificate()
+    public_key = load_public_key(BytesIO(pub))
+    private_key = load_private_key(BytesIO(priv), None)
+    snapshots = []
+
+    def backup() -> str:
+        name = backup_incremental(
+            bucket, root, "vol", public_key, cache_path, True, codec="none"
+        )
+        snapshots.append(_contents(root))
+        return name
+
+    assert backup() == "vol.0000"
+    (root/"dir/a").write_bytes(os.urandom(3000))
+    (root/"dir/b").unlink()
+    (root/"new").write_text("new")
+    assert backup() == "vol.0001"
+    (root/"dir/a").unlink()
+    (root/"dir").rmdir()
+    (root/"dir").write_text("file replacing directory")
+    assert backup() == "vol.0002"
+
+    # the cache copy is the manifest in the bucket
+    cached = json.loads(bz2.decompress(cache_path.read_bytes()))
+    assert cached == \
+        download_document(bucket, "vol" + FILES_SUFFIX, private_key)
+    # changed files make their directory change as well
+    assert [entry["packed"] for entry in cached["chain"]] == [4, 3, 1]
+    assert [entry["deleted"] for entry in cached["chain"]] == \
+        [[], ["dir/b"], ["dir", "dir/a"]]
+    assert not (tmp_path/"cache/vol.files.bz2.partial").exists()
+
+    for level, snapshot in ((None, snapshots[2]), (1, snapshots[1])):
+        target = tmp_path/f"restored{level}"
+        target.mkdir()
+        monkeypatch.chdir(target)
+        restored = target/root.relative_to("/")
+        restore_incremental(bucket, restored, "vol", private_key, level)
+        assert _contents(restored) == snapshot
+
+    # a lost cache copy starts a new chain
+    cache_path.unlink()
+    assert backup() == "vol.0000"
@@ -0,0 +1,75 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Test stage metrics and run reports."""
+
+import json
+import os
+from io import BytesIO
+from pathlib import Path
+
+import pytest
+
+from dockerVolumeBackup.metrics import Progress, apparent_size, run_report
+
+
+def test_apparent_size(tmp_path: Path):
+    """Test that links are not counted twice.
+
+    Args:
+        tmp_path (Path): temporary directory
+    """
+    (tmp_path/"sub").mkdir()
+    (tmp_path/"sub"/"file").write_bytes(bytes(1000))
+    (tmp_path/"other").write_bytes(bytes(10))
+    os.link(tmp_path/"sub"/"file", tmp_path/"hardlink")
+    os.symlink("other", tmp_path/"symlink")
+    assert apparent_size(tmp_path) == 1010
+
+
+def test_run_report(tmp_path: Path):
+    """Test counting stages and writing reports of failed runs.
+
+    Args:
+        tmp_path (Path): temporary directory
+    """
+    json_path = tmp_path/"report.json"
+    prometheus_path = tmp_path/"report.prom"
+    with pytest.raises(OSError):
+        with run_report(
+            "backup", json_path, prometheus_path, bucket="b", name='n"1'
+        ) as metrics:
+            with metrics.stage("pack") as stage:
+                stage.bytes_in = 3000
+                assert stage.count(BytesIO(bytes(1000)), output=True) \
+                    .read() == bytes(1000)
+            with metrics.stage("upload"):
+                raise OSError("interrupted")
+
+    report = json.loads(json_path.read_text())
+    assert not report["success"]
+    assert report["error"] == "OSError('interrupted')"
+    assert [
+        (stage["stage"], stage["bytes_in"], stage["bytes_out"],
+         stage["ratio"])
+        for stage in report["stages"]
+    ] == [("pack", 3000, 1000, 3.0), ("upload", None, None, None)]
+    lines = prometheus_path.read_text().splitlines()
+    assert 'aws_backup_success{operation="backup",bucket="b",name="n\\"1"} 0'\
+        in lines
+    assert 'aws_backup_stage_bytes_out{operation="backup",bucket="b",' \
+        'name="n\\"1",stage="pack"} 1000' in lines
+    # unknown sizes are left out
+    assert not any(
+        line.startswith("aws_backup_stage_bytes_in") and "upload" in line
+        for line in lines
+    )
+
+
+def test_progress():
+    """Test progress line."""
+    progress = Progress("backup", 4*2**30, interactive=False)
+    progress.update(2**30)
+    line = progress.line()
+    assert line.startswith("backup: 1.0 GiB of 4.0 GiB, ")
+    assert ", ETA " in line
+    assert "ETA" not in Progress("backup", None, interactive=False).line()
@@ -6,8 +6,15 @@
 from io import BytesIO
 from pathlib import Path
 from random import randbytes
+
+import pytest
+
+from dockerVolumeBackup import mycrypt
 from dockerVolumeBackup.mycrypt import \
-    decrypt, encrypt, gen_certificate, load_public_key, load_private_key
+    MAGIC, AsymmetricFernetError, SeekableDecryptor, decrypt, decrypt_stream, \
+    encrypt, encrypt_stream, gen_certificate, load_public_key, \
+    load_private_key, prompt_private_key
+from dockerVolumeBackup.streams import BufferPool
 
 
 def test_encrypt(tmp_path: Path):
@@ -36,3 +43,137 @@ def test_encrypt(tmp_path: Path):
 
     with open(file_path, "rb") as textio:
         assert test_bytes == textio.read()
+
+
+def test_encrypt_stream():
+    """Test that streamed encryption matches the file format."""
+    priv, pub = gen_certificate()
+    public_key = load_public_key(BytesIO(pub))
+    private_key = load_private_key(BytesIO(priv), None)
+    test_bytes = randbytes(5000)
+
+    encrypted = b"".join(
+        encrypt_stream(BytesIO(test_bytes), public_key, block_size=1024)
+    )
+    assert b"".join(
+        decrypt_stream(private_key, BytesIO(encrypted))
+    ) == test_bytes
+
+
+def test_parallel_encrypt_stream(monkeypatch: pytest.MonkeyPatch):
+    """Test that parallel and serial crypto produce compatible streams.
+
+    Args:
+        monkeypatch (pytest.MonkeyPatch): record buffer pools
+    """
+    priv, pub = gen_certificate()
+    public_key = load_public_key(BytesIO(pub))
+    private_key = load_private_key(BytesIO(priv), None)
+    test_bytes = randbytes(5000)
+    pools = []
+
+    class RecordingPool(BufferPool):
+        def __init__(self, count: int, size: int) -> None:
+            super().__init__(count, size)
+            pools.append(self)
+
+    monkeypatch.setattr(mycrypt, "BufferPool", RecordingPool)
+    for test_input in (test_bytes, b""):
+        encrypted = b"".join(
+            encrypt_stream(
+                BytesIO(test_input), public_key, block_size=1024, workers=2,
+                max_blocks_in_flight=1
+            )
+        )
+        assert b"".join(
+            decrypt_stream(private_key, BytesIO(encrypted))
+        ) == test_input
+    # five blocks passed through three reused buffers
+    assert pools[0].count == 3
+    assert pools[0].peak == 3*1024
+    assert pools[0].in_flight == 0
+
+    encrypted = b"".join(
+        encrypt_stream(BytesIO(test_bytes), public_key, block_size=1024)
+    )
+    assert b"".join(
+        decrypt_stream(
+            private_key, BytesIO(encrypted), workers=2, max_blocks_in_flight=1
+        )
+    ) == test_bytes
+
+
+def test_container_versions():
+    """Test that v1 containers still decrypt and v2 detects truncation."""
+    priv, pub = gen_certificate()
+    public_key = load_public_key(BytesIO(pub))
+    private_key = load_private_key(BytesIO(priv), None)
+    test_bytes = randbytes(5000)
+
+    encrypted_v1 = b"".join(
+        encrypt_stream(
+            BytesIO(test_bytes), public_key, block_size=1024, version=1
+        )
+    )
+    assert b"".join(
+        decrypt_stream(private_key, BytesIO(encrypted_v1))
+    ) == test_bytes
+
+    encrypted_v2 = b"".join(
+        encrypt_stream(BytesIO(test_bytes), public_key, block_size=1024)
+    )
+    assert encrypted_v2.startswith(MAGIC)
+    assert len(encrypted_v2) < len(encrypted_v1)
+    # drop final block and index of 5 blocks
+    with pytest.raises(AsymmetricFernetError):
+        b"".join(decrypt_stream(
+            private_key,
+            BytesIO(encrypted_v2[:-(5000 % 1024 + 33 + 5*16 + 24)])
+        ))
+
+
+def test_seekable_decryptor():
+    """Test random access to plain text ranges."""
+    priv, pub = gen_certificate()
+    public_key = load_public_key(BytesIO(pub))
+    private_key = load_private_key(BytesIO(priv), None)
+    test_bytes = randbytes(5000)
+    encrypted = b"".join(
+        encrypt_stream(BytesIO(test_bytes), public_key, block_size=1024)
+    )
+    assert b"".join(
+        decrypt_stream(private_key, BytesIO(encrypted))
+    ) == test_bytes
+
+    decryptor = SeekableDecryptor(
+        private_key,
+        lambda offset, size: encrypted[offset:offset + size],
+        len(encrypted)
+    )
+    assert decryptor.size == len(test_bytes)
+    ranges = [(0, 10), (1000, 100), (1023, 2), (4000, 2000), (6000, 1)]
+    assert list(decryptor.read_ranges(ranges)) == [
+        test_bytes[start:start + size] for start, size in ranges
+    ]
+
+
+def test_prompt_private_key_without_tty(
+    tmp_path: Path,
+    monkeypatch: pytest.MonkeyPatch
+):
+    """Test that a key without password loads without a terminal.
+
+    Args:
+        tmp_path (Path): temp dir
+        monkeypatch (pytest.MonkeyPatch): patch password prompt
+    """
+    priv, pub = gen_certificate()
+    (tmp_path/"key.pem").write_bytes(priv)
+
+    def no_tty(prompt: str) -> str:
+        raise EOFError
+
+    monkeypatch.setattr(mycrypt, "getpass", no_tty)
+    private_key = prompt_private_key(tmp_path/"key.pem")
+    assert private_key.public_key().public_numbers() == \
+        load_public_key(BytesIO(pub)).public_numbers()
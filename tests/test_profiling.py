@@ -0,0 +1,40 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Test profiling per stage."""
+
+import pstats
+import tracemalloc
+from pathlib import Path
+
+from dockerVolumeBackup.metrics import run_report
+from dockerVolumeBackup.profiling import Profiler
+
+
+def test_profiler(tmp_path: Path):
+    """Test that stages of a run are profiled separately.
+
+    Args:
+        tmp_path (Path): temporary directory
+    """
+    profiler = Profiler("cprofile")
+    profiler.start()
+    with run_report(
+        "backup", tmp_path/"run.backup.json", profiler=profiler
+    ) as metrics:
+        with metrics.stage("allocate"):
+            data = [bytes(1000) for _ in range(1000)]
+    assert not tracemalloc.is_tracing()
+    assert len(data) == 1000
+
+    directory = tmp_path/"run.backup.profile"
+    assert profiler.written == directory
+    assert [segment.name for segment in profiler.segments] == \
+        ["00-start", "01-allocate", "02-after_allocate"]
+    stats = pstats.Stats(str(directory/"01-allocate.prof"))
+    assert any(
+        file_name.endswith("test_profiling.py")
+        for file_name, _, _ in stats.stats
+    )
+    pstats.Stats(str(directory/"run.prof"))
+    tracemalloc.Snapshot.load(str(directory/"01-allocate.tracemalloc"))
+    assert "01-allocate: " in (directory/"memory.txt").read_text()
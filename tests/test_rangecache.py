@@ -0,0 +1,69 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Test the local cache of downloaded ranges."""
+
+import os
+from pathlib import Path
+
+from dockerVolumeBackup.rangecache import RangeCache
+from dockerVolumeBackup.storage import AWSBucket
+
+
+def test_range_cache(tmp_path: Path):
+    """Test LRU eviction, size limit and dropping of damaged entries.
+
+    Args:
+        tmp_path (Path): temporary directory
+    """
+    cache = RangeCache(tmp_path/"cache", 3000)
+    for key in ("a", "b", "c"):
+        cache.put(key, key.encode()*1000)
+    assert cache.get("a") == b"a"*1000
+    cache.put("d", b"d"*1000)
+    assert cache.get("b") is None
+    assert cache.get("c") == b"c"*1000
+    # too large for the cache
+    cache.put("e", b"e"*3001)
+    assert cache.get("e") is None
+    assert cache.get("a") == b"a"*1000
+
+    cache._path("d").write_bytes(b"x"*1000)
+    assert cache.get("d") is None
+    assert not cache._path("d").exists()
+    # entries survive a new instance, e.g. the next run
+    assert RangeCache(tmp_path/"cache", 3000).get("c") == b"c"*1000
+    assert len(list((tmp_path/"cache").iterdir())) == 3
+
+
+def test_cached_download(bucket: AWSBucket, tmp_path: Path):
+    """Test that repeated downloads read from the cache until a new upload.
+
+    Args:
+        bucket (AWSBucket): mocked bucket
+        tmp_path (Path): temporary directory
+    """
+    bucket.settings = bucket.settings._replace(range_size=1000)
+    bucket.cache = RangeCache(tmp_path/"cache", 2**20)
+    data = os.urandom(5500)
+    bucket.upload_bytes(data, "vol")
+    requests = []
+    get_object = bucket.client.get_object
+
+    def counting_get_object(**kwargs):
+        requests.append(kwargs["Range"])
+        return get_object(**kwargs)
+
+    bucket.client.get_object = counting_get_object
+    assert bucket.download_stream("vol").read() == data
+    assert len(requests) == 6
+    bucket.download("vol", tmp_path/"vol")
+    assert (tmp_path/"vol").read_bytes() == data
+    read_at, _ = bucket.range_reader("vol")
+    assert read_at(2000, 1000) == data[2000:3000]
+    assert len(requests) == 6
+    assert (bucket.cache.hits, bucket.cache.misses) == (6500, 5500)
+
+    changed = os.urandom(5500)
+    bucket.upload_bytes(changed, "vol")
+    assert bucket.download_stream("vol").read() == changed
+    assert len(requests) == 12
@@ -0,0 +1,113 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Test resuming interrupted transfers."""
+
+import json
+from io import BytesIO
+from pathlib import Path
+from random import Random
+
+import pytest
+
+from dockerVolumeBackup.mycrypt import \
+    decrypt_stream, gen_certificate, load_private_key, load_public_key
+from dockerVolumeBackup.resume import ResumeError, upload_resumable
+from dockerVolumeBackup.storage import MiB, AWSBucket
+from dockerVolumeBackup.streams import IteratorReader
+
+
+def _interrupted(data: bytes, size: int) -> IteratorReader:
+    """Stream of data failing after size bytes."""
+    def chunks():
+        yield from (data[i:i + MiB] for i in range(0, size, MiB))
+        raise OSError("interrupted")
+    return IteratorReader(chunks())
+
+
+def test_upload_resumable(bucket: AWSBucket, tmp_path: Path):
+    """Test that resumed uploads skip uploaded parts.
+
+    Args:
+        bucket (AWSBucket): mocked bucket
+        tmp_path (Path): temporary directory
+    """
+    bucket.settings = bucket.settings._replace(
+        part_size=5*MiB, max_concurrency=1
+    )
+    priv, pub = gen_certificate()
+    public_key = load_public_key(BytesIO(pub))
+    checkpoint_path = tmp_path/"checkpoint"
+    test_bytes = Random(0).randbytes(16*MiB + 100)
+
+    with pytest.raises(OSError):
+        upload_resumable(
+            bucket, _interrupted(test_bytes, 15*MiB), "test.file",
+            public_key, checkpoint_path
+        )
+    checkpoint = json.loads(checkpoint_path.read_text())
+    assert checkpoint["blocks"] == 5
+    assert checkpoint_path.stat().st_mode & 0o077 == 0
+
+    # changed data discards the upload
+    with pytest.raises(ResumeError):
+        upload_resumable(
+            bucket, BytesIO(b"changed" + test_bytes), "test.file",
+            public_key, checkpoint_path
+        )
+    assert not checkpoint_path.exists()
+    assert bucket.list_parts("test.file", checkpoint["upload_id"]) is None
+
+    with pytest.raises(OSError):
+        upload_resumable(
+            bucket, _interrupted(test_bytes, 15*MiB), "test.file",
+            public_key, checkpoint_path
+        )
+    upload_resumable(
+        bucket, BytesIO(test_bytes), "test.file", public_key,
+        checkpoint_path
+    )
+    assert not checkpoint_path.exists()
+    assert b"".join(decrypt_stream(
+        load_private_key(BytesIO(priv), None),
+        BytesIO(bucket.download_bytes("test.file"))
+    )) == test_bytes
+
+
+def test_download_resumable(bucket: AWSBucket, tmp_path: Path):
+    """Test that resumed downloads fetch only missing ranges.
+
+    Args:
+        bucket (AWSBucket): mocked bucket
+        tmp_path (Path): temporary directory
+    """
+    bucket.settings = bucket.settings._replace(
+        range_size=1000, max_concurrency=1
+    )
+    test_bytes = Random(0).randbytes(3000)
+    bucket.upload_bytes(test_bytes, "test.file")
+    get_object = bucket.client.get_object
+    fetched = []
+
+    def failing_get_object(**kwargs):
+        if kwargs["Range"].startswith("bytes=2000-"):
+            raise OSError("interrupted")
+        return get_object(**kwargs)
+
+    def counting_get_object(**kwargs):
+        fetched.append(kwargs["Range"])
+        return get_object(**kwargs)
+
+    path = tmp_path/"test.file"
+    journal_path = tmp_path/"journal"
+    bucket.client.get_object = failing_get_object
+    with pytest.raises(OSError):
+        bucket.download_resumable("test.file", path, journal_path)
+    # damaged ranges are fetched again
+    with open(path, "r+b") as bytesio:
+        bytesio.write(b"damaged")
+
+    bucket.client.get_object = counting_get_object
+    bucket.download_resumable("test.file", path, journal_path)
+    assert fetched == ["bytes=0-999", "bytes=2000-2999"]
+    assert path.read_bytes() == test_bytes
+    assert not journal_path.exists()
@@ -0,0 +1,142 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Test sharded backups against an in-process S3 stand-in."""
+
+import os
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+from pathlib import Path
+from typing import IO
+
+import pytest
+
+from dockerVolumeBackup import mycrypt
+from dockerVolumeBackup.documents import SHARDS_SUFFIX, download_document
+from dockerVolumeBackup.incremental import scan_tree
+from dockerVolumeBackup.mycrypt import \
+    gen_certificate, load_private_key, load_public_key
+from dockerVolumeBackup.shards import \
+    backup_sharded, partition_tree, restore_sharded
+from dockerVolumeBackup.storage import AWSBucket
+
+
+def test_partition_tree(tmp_path: Path):
+    """Test balancing of shards and keeping links together.
+
+    Args:
+        tmp_path (Path): temporary directory
+    """
+    (tmp_path/"dir").mkdir()
+    for index, size in enumerate((600, 500, 400, 300, 200)):
+        (tmp_path/"dir"/f"{index}").write_bytes(bytes(size*1000))
+    os.link(tmp_path/"dir/0", tmp_path/"link")
+    (tmp_path/"symlink").symlink_to("dir")
+    shards, directories = partition_tree(scan_tree(tmp_path), 2)
+    assert directories == ["dir"]
+    assert sorted(shards) == \
+        [["dir/0", "dir/3", "link", "symlink"], ["dir/1", "dir/2", "dir/4"]]
+    # never more shards than files
+    assert len(partition_tree(scan_tree(tmp_path), 10)[0]) == 6
+
+
+def test_sharded_roundtrip(
+    bucket: AWSBucket,
+    tmp_path: Path,
+    monkeypatch: pytest.MonkeyPatch
+):
+    """Test parallel backup and restore and abort on a failed shard.
+
+    Args:
+        bucket (AWSBucket): mocked bucket
+        tmp_path (Path): temporary directory
+        monkeypatch (pytest.MonkeyPatch): patch working directory
+    """
+    root = tmp_path/"data"
+    (root/"dir/sub").mkdir(parents=True)
+    for index in range(8):
+        (root/"dir"/f"{index}").write_bytes(os.urandom(index*1000))
+    os.link(root/"dir/7", root/"dir/sub/link")
+    (root/"symlink").symlink_to("dir/7")
+    (root/"dir").chmod(0o750)
+    priv, pub = gen_certificate()
+    public_key = load_public_key(BytesIO(pub))
+    private_key = load_private_key(BytesIO(priv), None)
+
+    uploaded = backup_sharded(
+        bucket, root, "vol", public_key, 3, codec="none"
+    )
+    assert uploaded == [
+        "vol" + SHARDS_SUFFIX, "vol.shard0000", "vol.shard0001",
+        "vol.shard0002", "vol.shard0003"
+    ]
+    manifest = download_document(bucket, "vol" + SHARDS_SUFFIX, private_key)
+    assert sum(shard["size"] for shard in manifest["shards"]) == 28000
+
+    target = tmp_path/"restored"
+    target.mkdir()
+    monkeypatch.chdir(target)
+    restore_sharded(bucket, manifest, private_key, 2)
+    restored = target/root.relative_to("/")
+    assert scan_tree(restored).keys() == scan_tree(root).keys()
+    assert (restored/"dir/5").read_bytes() == (root/"dir/5").read_bytes()
+    assert (restored/"dir/7").stat().st_ino == \
+        (restored/"dir/sub/link").stat().st_ino
+    assert (restored/"dir").stat().st_mode & 0o777 == 0o750
+
+    def failing(bytesio: IO[bytes]) -> IO[bytes]:
+        if failing.calls == 1:
+            raise OSError("disk failed")
+        failing.calls += 1
+        return bytesio
+
+    failing.calls = 0
+    with pytest.raises(OSError):
+        backup_sharded(
+            bucket, root, "failed", public_key, 3, codec="none",
+            count=failing
+        )
+    assert bucket.stat("failed" + SHARDS_SUFFIX) is None
+
+
+def test_shards_share_workers(
+    bucket: AWSBucket,
+    tmp_path: Path,
+    monkeypatch: pytest.MonkeyPatch
+):
+    """Test that more shards than workers share one process pool.
+
+    Args:
+        bucket (AWSBucket): mocked bucket
+        tmp_path (Path): temporary directory
+        monkeypatch (pytest.MonkeyPatch): count pools, working directory
+    """
+    root = tmp_path/"data"
+    root.mkdir()
+    for index in range(6):
+        (root/f"{index}").write_bytes(os.urandom(3000 + index))
+    priv, pub = gen_certificate()
+    public_key = load_public_key(BytesIO(pub))
+    private_key = load_private_key(BytesIO(priv), None)
+    pools = []
+
+    class CountingPool(ProcessPoolExecutor):
+        def __init__(self, *args, **kwargs) -> None:
+            super().__init__(*args, **kwargs)
+            pools.append(kwargs["max_workers"])
+
+    monkeypatch.setattr(mycrypt, "ProcessPoolExecutor", CountingPool)
+    backup_sharded(bucket, root, "vol", public_key, 4, 2, codec="none")
+    assert pools == [2]
+
+    target = tmp_path/"restored"
+    target.mkdir()
+    monkeypatch.chdir(target)
+    restore_sharded(
+        bucket, download_document(bucket, "vol" + SHARDS_SUFFIX, private_key),
+        private_key, 2
+    )
+    assert pools == [2, 2]
+    restored = target/root.relative_to("/")
+    for index in range(6):
+        assert (restored/f"{index}").read_bytes() == \
+            (root/f"{index}").read_bytes()
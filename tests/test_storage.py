@@ -0,0 +1,105 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Test storage module against an in-process S3 stand-in."""
+
+from pathlib import Path
+from random import randbytes
+
+import pytest
+
+from dockerVolumeBackup.storage import \
+    MiB, AWSBucket, TransferSettings, load_transfer_settings
+from dockerVolumeBackup.streams import IteratorReader
+
+
+def test_stream_roundtrip(bucket: AWSBucket):
+    """Test upload and parallel ranged download of streams.
+
+    Args:
+        bucket (AWSBucket): mocked bucket
+    """
+    bucket.settings = bucket.settings._replace(
+        range_size=1000, checksum_algorithm="SHA256"
+    )
+    test_bytes = randbytes(3000)
+    bucket.upload_stream(
+        IteratorReader(test_bytes[i:i+100] for i in range(0, 3000, 100)),
+        "test.file"
+    )
+    assert bucket.download_stream("test.file").read() == test_bytes
+
+
+def test_stream_multipart(bucket: AWSBucket):
+    """Test that multipart stream uploads reuse a bounded set of buffers.
+
+    Args:
+        bucket (AWSBucket): mocked bucket
+    """
+    bucket.settings = bucket.settings._replace(
+        part_size=5*MiB, max_concurrency=2
+    )
+    test_bytes = randbytes(17*MiB)
+    bucket.upload_stream(
+        IteratorReader(
+            test_bytes[i:i+MiB] for i in range(0, len(test_bytes), MiB)
+        ),
+        "test.file"
+    )
+    assert bucket.download_stream("test.file").read() == test_bytes
+    assert bucket.buffers is not None
+    assert 5*MiB <= bucket.buffers.peak <= 3*5*MiB
+    assert bucket.buffers.in_flight == 0
+
+
+def test_stream_failure(bucket: AWSBucket):
+    """Test that a failing stream does not create an object.
+
+    Args:
+        bucket (AWSBucket): mocked bucket
+    """
+    def failing():
+        yield b"data"
+        raise OSError("producer died")
+
+    with pytest.raises(OSError):
+        bucket.upload_stream(IteratorReader(failing()), "test.file")
+    with pytest.raises(Exception):
+        bucket.download_stream("test.file").read()
+
+
+def test_transfer_settings(
+    tmp_path: Path,
+    monkeypatch: pytest.MonkeyPatch
+):
+    """Test precedence of transfer setting sources.
+
+    Args:
+        tmp_path (Path): temporary directory
+        monkeypatch (pytest.MonkeyPatch): patch environment
+    """
+    config_path = tmp_path/"transfer.ini"
+    config_path.write_text(
+        "[transfer]\npart_size = 16\nmax_concurrency = 2\n"
+        "checksum_algorithm = crc32c\npreflight = off\n"
+    )
+    monkeypatch.setenv("AWS_BACKUP_MAX_CONCURRENCY", "8")
+    assert load_transfer_settings(
+        config_path, {"range_size": 0.5, "max_pool_connections": None}
+    ) == TransferSettings(
+        part_size=16*MiB, max_concurrency=8, range_size=MiB // 2,
+        checksum_algorithm="CRC32C", preflight=False
+    )
+    assert load_transfer_settings(tmp_path/"missing.ini") == \
+        TransferSettings(max_concurrency=8)
+    with pytest.raises(ValueError):
+        load_transfer_settings(overrides={"checksum_algorithm": "md5"})
+    with pytest.raises(ValueError):
+        load_transfer_settings(overrides={"preflight": "maybe"})
+    assert load_transfer_settings(overrides={
+        "upload_limit": 2, "ionice": "IDLE", "throttle_hours": "22:00-6:00"
+    }) == TransferSettings(
+        max_concurrency=8, upload_limit=2*MiB, ionice="idle",
+        throttle_hours="22:00-6:00"
+    )
+    with pytest.raises(ValueError):
+        load_transfer_settings(overrides={"throttle_hours": "8-20"})
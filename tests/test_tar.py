@@ -4,11 +4,20 @@
 # Created on Thu Feb 03 2022 by Merlin Mittelbach.
 
 from base64 import b64encode
+from io import BytesIO
 from pathlib import Path
 from random import randbytes
 from shutil import rmtree
+from subprocess import CalledProcessError
+from tarfile import open as taropen
 
-from dockerVolumeBackup.tar import pack_lzma, unpack_lzma
+import pytest
+
+from dockerVolumeBackup.extract import extract_stream
+from dockerVolumeBackup.tar import \
+    MEMBER_END, MEMBER_NAME, MEMBER_OFFSET, TarIndexer, add_tree, \
+    call_tar, data_extents, pack_lzma, pack_stream, select_members, \
+    unpack_lzma, unpack_stream
 
 
 def test_tar(tmp_path: Path):
@@ -39,3 +48,111 @@ def test_tar(tmp_path: Path):
         assert rand_str1 == textio.read()
     with open(test_dir.joinpath("test2")) as textio:
         assert rand_str2 == textio.read()
+
+
+@pytest.mark.parametrize("packer", ["tar", "tarfile"])
+@pytest.mark.parametrize("writers", [1, 4])
+def test_sparse(
+    tmp_path: Path,
+    monkeypatch: pytest.MonkeyPatch,
+    packer: str,
+    writers: int
+):
+    """Test that holes are neither stored nor allocated on restore.
+
+    Args:
+        tmp_path (Path): temp directory
+        monkeypatch (pytest.MonkeyPatch): patch working directory
+        packer (str): pack with tar or the tarfile fallback
+        writers (int): unpack with tar or the parallel extractor
+    """
+    test_dir = tmp_path.joinpath("data")
+    test_dir.mkdir()
+    image = test_dir.joinpath("image")
+    with open(image, "wb") as bytesio:
+        bytesio.truncate(64 * 2**20)
+        bytesio.seek(2**20)
+        bytesio.write(randbytes(5000))
+        bytesio.seek(40 * 2**20)
+        bytesio.write(randbytes(70000))
+    with open(image, "rb") as bytesio:
+        extents = data_extents(bytesio.fileno(), 64 * 2**20)
+    if sum(size for _, size in extents) == 64 * 2**20:
+        pytest.skip("file system does not report holes")
+    test_dir.joinpath("link").hardlink_to(image)
+
+    monkeypatch.chdir(tmp_path)
+    if packer == "tar":
+        with pack_stream(Path("data")) as bytesio:
+            archive_bytes = bytesio.read()
+    else:
+        archive = BytesIO()
+        with taropen(fileobj=archive, mode="w") as tarfile:
+            add_tree(tarfile, Path("data"))
+        archive_bytes = archive.getvalue()
+    assert len(archive_bytes) < 2**20
+
+    target = tmp_path.joinpath("restored")
+    target.mkdir()
+    monkeypatch.chdir(target)
+    with (extract_stream(writers) if writers > 1 else unpack_stream()) \
+            as archive:
+        archive.write(archive_bytes)
+    restored = target.joinpath("data/image")
+    assert restored.read_bytes() == image.read_bytes()
+    assert restored.stat().st_blocks * 512 < 2**20
+    assert restored.stat().st_ino == \
+        target.joinpath("data/link").stat().st_ino
+
+
+def test_tar_indexer(tmp_path: Path):
+    """Test indexing of tar stream and member selection.
+
+    Args:
+        tmp_path (Path): temp directory
+    """
+    test_dir = tmp_path.joinpath("data")
+    test_dir.joinpath("etc/app").mkdir(parents=True)
+    test_dir.joinpath("etc/app/app.conf").write_text("conf")
+    test_dir.joinpath("etc/other.conf").write_text("other" * 1000)
+    test_dir.joinpath("etc/app/link").hardlink_to(
+        test_dir.joinpath("etc/other.conf")
+    )
+    archive_bytes = BytesIO()
+    with taropen(fileobj=archive_bytes, mode="w") as archive:
+        archive.add(test_dir, arcname=str(test_dir).strip("/"))
+    archive_bytes = archive_bytes.getvalue()
+
+    indexer = TarIndexer()
+    for start in range(0, len(archive_bytes), 1000):
+        indexer.feed(archive_bytes[start:start + 1000])
+    members = indexer.close()
+    assert len(members) == 6
+
+    # tarfile adds sorted, so etc/other.conf is a hard link to etc/app/link
+    selected = select_members(
+        members, ["/etc/app/*.conf", "etc/other*"], test_dir
+    )
+    assert [
+        member[MEMBER_NAME].removeprefix(str(test_dir).strip("/"))
+        for member in selected
+    ] == ["/etc/app/app.conf", "/etc/app/link", "/etc/other.conf"]
+    assert len(select_members(members, ["etc/app"], test_dir)) == 3
+    for member in selected:
+        with taropen(
+            fileobj=BytesIO(
+                archive_bytes[member[MEMBER_OFFSET]:member[MEMBER_END]]
+            )
+        ) as archive:
+            assert archive.getnames() == [member[MEMBER_NAME]]
+
+
+def test_call_tar_failure(tmp_path: Path):
+    """Test that a failing tar is reported instead of raising.
+
+    Args:
+        tmp_path (Path): temp dir
+    """
+    assert not call_tar(["-xf", str(tmp_path/"missing.tar")])
+    with pytest.raises(CalledProcessError):
+        call_tar(["-xf", str(tmp_path/"missing.tar")], raise_exc=True)
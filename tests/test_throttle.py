@@ -0,0 +1,113 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Test rate and CPU limits."""
+
+import os
+from datetime import datetime
+from io import BytesIO
+from typing import List
+
+import pytest
+
+from dockerVolumeBackup import throttle as throttle_module
+from dockerVolumeBackup.storage import AWSBucket
+from dockerVolumeBackup.throttle import \
+    TokenBucket, is_active, limit_cpu, parse_hours, rate_limit, throttle
+
+
+def test_token_bucket():
+    """Test waiting for tokens, bursts and hours of the day."""
+    now = [0.0]
+    waits: List[float] = []
+
+    def wait(seconds: float) -> None:
+        waits.append(seconds)
+        now[0] += seconds
+
+    bucket = TokenBucket(1000, clock=lambda: now[0], wait=wait)
+    # a second of burst passes at once
+    bucket.consume(1000)
+    assert waits == []
+    bucket.consume(500)
+    assert waits == [0.5]
+    now[0] += 10
+    bucket.consume(1500)
+    assert waits == [0.5, 0.5]
+    assert throttle(BytesIO(bytes(3000)), bucket).read() == bytes(3000)
+    assert sum(waits) == 4
+
+    assert is_active("08:00-20:00", datetime(2026, 1, 1, 8))
+    assert not is_active("08:00-20:00", datetime(2026, 1, 1, 20))
+    assert is_active("22:00-6:00", datetime(2026, 1, 1, 5, 59))
+    assert not is_active("22:00-6:00", datetime(2026, 1, 1, 12))
+    assert is_active(None)
+    assert limit_cpu(8, 2) == (2, 2)
+    assert limit_cpu(8, None) == (8, None)
+
+
+def test_throttle_hours(monkeypatch: pytest.MonkeyPatch):
+    """Test that rates follow the clock and CPU limits the start of a run.
+
+    Args:
+        monkeypatch (pytest.MonkeyPatch): patch wall clock
+    """
+    hours = "08:00-20:00"
+    before, start, end = (
+        datetime(2026, 1, 1, 7, 59), datetime(2026, 1, 1, 8),
+        datetime(2026, 1, 1, 20)
+    )
+    assert limit_cpu(8, 2, hours, before) == (8, None)
+    assert limit_cpu(8, 2, hours, start) == (2, 2)
+    assert parse_hours("22:00-24:00") == "22:00-24:00"
+    for invalid in ("08:00-24:30", "25:00-06:00", "08:60-20:00", "8-20"):
+        with pytest.raises(ValueError):
+            parse_hours(invalid)
+
+    class Clock(datetime):
+        current = before
+
+        @classmethod
+        def now(cls, tz=None):
+            return cls.current
+
+    monkeypatch.setattr(throttle_module, "datetime", Clock)
+    waits: List[float] = []
+    bucket = rate_limit(1000, hours)
+    bucket._wait = waits.append
+    # a run starting off-peak is throttled once the hours begin
+    bucket.consume(3000)
+    assert not waits
+    Clock.current = start
+    bucket.consume(3000)
+    assert waits
+    # and goes at full speed again once they end
+    Clock.current = end
+    bucket.consume(3000)
+    assert len(waits) == 1
+
+
+def test_bandwidth_limit(bucket: AWSBucket):
+    """Test that all transfers take tokens for their bytes.
+
+    Args:
+        bucket (AWSBucket): mocked bucket
+    """
+    class Counter:
+        def __init__(self) -> None:
+            self.size = 0
+
+        def consume(self, size: int) -> None:
+            self.size += size
+
+    bucket.upload_rate = Counter()
+    bucket.download_rate = Counter()
+    bucket.settings = bucket.settings._replace(
+        part_size=5*2**20, range_size=2**20
+    )
+    data = os.urandom(6*2**20)
+    bucket.upload_stream(BytesIO(data), "stream")
+    bucket.upload_bytes(data[:1000], "small")
+    assert bucket.upload_rate.size == len(data) + 1000
+    assert bucket.download_stream("stream").read() == data
+    assert bucket.download_bytes("small") == data[:1000]
+    assert bucket.download_rate.size == len(data) + 1000
@@ -0,0 +1,84 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""Test checking backups without restoring them."""
+
+import os
+from io import BytesIO
+from pathlib import Path
+
+import pytest
+
+from dockerVolumeBackup.catalog import Catalog
+from dockerVolumeBackup.documents import SHARDS_SUFFIX
+from dockerVolumeBackup.mycrypt import \
+    encrypt_stream, gen_certificate, load_private_key, load_public_key
+from dockerVolumeBackup.shards import backup_sharded
+from dockerVolumeBackup.storage import AWSBucket
+from dockerVolumeBackup.tar import pack_stream
+from dockerVolumeBackup.verify import verify_backup, verify_container
+
+
+def test_verify(
+    bucket: AWSBucket,
+    tmp_path: Path,
+    monkeypatch: pytest.MonkeyPatch
+):
+    """Test full and fast checks of intact, damaged and incomplete backups.
+
+    Args:
+        bucket (AWSBucket): mocked bucket
+        tmp_path (Path): temporary directory
+        monkeypatch (pytest.MonkeyPatch): patch working directory
+    """
+    bucket.settings = bucket.settings._replace(checksum_algorithm="SHA256")
+    root = tmp_path/"data"
+    root.mkdir()
+    for index in range(4):
+        (root/f"{index}").write_bytes(os.urandom(3000))
+    priv, pub = gen_certificate()
+    public_key = load_public_key(BytesIO(pub))
+    private_key = load_private_key(BytesIO(priv), None)
+    monkeypatch.chdir(tmp_path)
+    with pack_stream(Path("data")) as bytesio:
+        archive = bytesio.read()
+    container = b"".join(encrypt_stream(
+        BytesIO(archive), public_key, block_size=1000,
+        metadata={"compression": "none"}
+    ))
+    bucket.upload_bytes(container, "vol")
+    backup_sharded(bucket, root, "shards", public_key, 2, codec="none")
+    catalog = Catalog(tmp_path/"catalog.db")
+    catalog.sync(bucket)
+    backups = catalog.backups()
+    assert [backup.name for backup in backups] == ["shards", "vol"]
+
+    counted = []
+    assert verify_container(
+        bucket, "vol", private_key, 2, unpack=True,
+        count=lambda bytesio: counted.append(1) or bytesio
+    ) == len(container)
+    assert counted == [1]
+    for fast in (False, True):
+        for backup in backups:
+            results = verify_backup(
+                bucket, backup, private_key, fast, unpack=True
+            )
+            assert len(results) == len(backup.files)
+            assert all(result.error is None for result in results)
+
+    # damaged middle block, only found by reading it
+    damaged = bytearray(container)
+    damaged[len(container) // 2] ^= 1
+    bucket.upload_bytes(bytes(damaged), "vol")
+    assert verify_backup(bucket, backups[1], private_key, True)[0].error \
+        is None
+    assert verify_backup(bucket, backups[1], private_key)[0].error
+
+    # truncated container and missing shard
+    bucket.upload_bytes(container[:-100], "vol")
+    assert verify_backup(bucket, backups[1], private_key, True)[0].error
+    bucket.client.delete_object(Bucket=bucket.bucket, Key="shards.shard0001")
+    results = verify_backup(bucket, backups[0], private_key, True)
+    assert {
+        result.name for result in results if result.error is not None
+    } == {"shards" + SHARDS_SUFFIX, "shards.shard0001"}